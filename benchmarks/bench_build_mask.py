@@ -0,0 +1,108 @@
+""" Benchmark the QC mask of netcdf.utils.build_mask
+
+Compares the fused, chunked qc.QCEngine against the original
+implementation on a synthetic SST granule, for run time
+and peak memory (tracemalloc).
+
+Usage:
+    python benchmarks/bench_build_mask.py --nlat 4000 --nlon 4000
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from remote_sensing.netcdf import utils as nc_utils
+
+
+def fake_granule(nlat:int, nlon:int, seed:int=1234):
+    """ Synthetic SST (deg C) with cloud gaps and quality levels """
+    rng = np.random.default_rng(seed)
+    sst = (25. + 5*rng.normal(size=(nlat, nlon))).astype(np.float32)
+    sst[rng.random(size=sst.shape) < 0.4] = np.nan
+    qual = rng.integers(0, 6, size=(nlat, nlon)).astype(np.int8)
+    return sst, qual
+
+
+def legacy_build_mask(dfield, qual, qual_thresh=2, lower_qual=True,
+                      temp_bounds=(-2,33), field='SST'):
+    """ The original build_mask, kept verbatim for comparison """
+    # Mask val
+    qual_maskval = 999999 if lower_qual else -999999
+
+    dfield[np.isnan(dfield)] = np.nan
+    if field == 'SST':
+        if qual is None:
+            qual = np.zeros_like(dfield).astype(int)
+        qual[np.isnan(dfield)] = qual_maskval
+    else:
+        if qual is None:
+            raise IOError("Need to deal with qual for color.  Just a reminder")
+        # Deal with NaN
+    masks = np.logical_or(np.isnan(dfield), qual==qual_maskval)
+
+    # Quality
+    qual_masks = np.zeros_like(masks)
+
+    if qual is not None and qual_thresh is not None:
+        if lower_qual:
+            qual_masks[~masks] = (qual[~masks] > qual_thresh)
+        else:
+            qual_masks[~masks] = (qual[~masks] < qual_thresh)
+
+    # Temperature bounds
+    value_masks = np.zeros_like(masks)
+    if field == 'SST':
+        value_masks[~masks] = (dfield[~masks] <= temp_bounds[0]) | (dfield[~masks] > temp_bounds[1])
+    # Union
+    masks = np.logical_or(masks, qual_masks, value_masks)
+
+    # Return
+    return masks
+
+
+def profile(func, *args, **kwargs):
+    """ Return the result, time (s) and peak traced memory (MB) """
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, dt, peak
+
+
+def main(pargs):
+    sst, qual = fake_granule(pargs.nlat, pargs.nlon)
+    print(f"Granule: {pargs.nlat}x{pargs.nlon} = {sst.size:,d} values")
+    kwargs = dict(qual_thresh=4, lower_qual=False, temp_bounds=(-2, 30))
+
+    # The legacy version writes into its inputs;  give it copies
+    #  (int64 quality, as it needs room for its mask value)
+    l_sst, l_qual = sst.copy(), qual.astype(int)
+    legacy, t_legacy, m_legacy = profile(legacy_build_mask, l_sst, l_qual,
+                                         **kwargs)
+    print(f"Legacy:  {t_legacy:.3f} s, peak {m_legacy:.0f} MB")
+
+    fused, t_fused, m_fused = profile(nc_utils.build_mask, sst, qual, **kwargs)
+    print(f"Fused:   {t_fused:.3f} s, peak {m_fused:.0f} MB")
+    print(f"Speed-up: {t_legacy/t_fused:.1f}x, memory: {m_legacy/m_fused:.1f}x less")
+
+    # The legacy union dropped the temperature bounds
+    expected = ~np.isfinite(sst) | (qual < 4) | (sst <= -2) | (sst > 30)
+    assert np.array_equal(fused, expected)
+    print(f"Values the legacy mask missed (out of bounds): "
+          f"{np.sum(fused & ~legacy):,d}")
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("Benchmark build_mask")
+    parser.add_argument("--nlat", type=int, default=3000, help="Number of rows")
+    parser.add_argument("--nlon", type=int, default=3000, help="Number of columns")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_option())
@@ -0,0 +1,97 @@
+""" Benchmark the HEALPix binning in healpix.utils.da_to_healpix
+
+Compares the vectorized binning against the original
+per-sample loop on a synthetic, L3C-like lat/lon grid.
+
+Usage:
+    python benchmarks/bench_da_to_healpix.py --nlat 2500 --nlon 3500
+"""
+
+import argparse
+import time
+
+import numpy as np
+import healpy
+import xarray
+
+from remote_sensing.healpix import utils as hp_utils
+from remote_sensing.healpix import binning as hp_binning
+
+
+def fake_granule(nlat:int, nlon:int, cloud_frac:float=0.5, seed:int=1234):
+    """ A synthetic 1D lat/lon grid with cloud gaps (NaN) """
+    rng = np.random.default_rng(seed)
+    lats = np.linspace(30., 0., nlat)
+    lons = np.linspace(120., 150., nlon)
+    data = (25. + rng.normal(size=(nlat, nlon))).astype(np.float32)
+    data[rng.random(size=data.shape) < cloud_frac] = np.nan
+    return xarray.DataArray(data, coords={'lat': lats, 'lon': lons},
+                            dims=('lat', 'lon'))
+
+
+def pixels_and_values(da:xarray.DataArray, nside:int):
+    """ HEALPix index and value of the valid samples """
+    lons, lats = np.meshgrid(da.lon.values, da.lat.values)
+    vals = da.data.flatten()
+    gd = np.isfinite(vals)
+    theta = (90 - lats.flatten()[gd]) * np.pi / 180.
+    phi = lons.flatten()[gd] * np.pi / 180.
+    return healpy.pixelfunc.ang2pix(nside, theta, phi), vals[gd]
+
+
+def legacy_binning(idx:np.ndarray, vals:np.ndarray, npix_hp:int):
+    """ The original masked-array loop of da_to_healpix """
+    all_events = np.ma.masked_array(np.zeros(npix_hp, dtype='int'))
+    all_values = np.ma.masked_array(np.zeros(npix_hp, dtype='float'))
+    for ii in range(idx.size):
+        jj = idx[ii]
+        all_events[jj] += 1
+        all_values[jj] += vals[ii]
+    return all_events, all_values
+
+
+def main(pargs):
+    da = fake_granule(pargs.nlat, pargs.nlon)
+    nside, _ = hp_utils.get_nside_from_dataset(da)
+    npix_hp = healpy.nside2npix(nside)
+    print(f"Grid: {pargs.nlat}x{pargs.nlon} = {da.size:,d} samples, nside={nside}")
+
+    # End-to-end
+    t0 = time.perf_counter()
+    hp_utils.da_to_healpix(da, nside=nside)
+    print(f"da_to_healpix (end-to-end): {time.perf_counter()-t0:.3f} s")
+
+    # Binning alone
+    idx, vals = pixels_and_values(da, nside)
+    print(f"Valid samples: {idx.size:,d}")
+
+    t0 = time.perf_counter()
+    counts, sums = hp_binning.bincount_sums(idx, vals, npix_hp)
+    t_vec = time.perf_counter() - t0
+    print(f"Binning, vectorized: {t_vec:.3f} s")
+
+    # The loop is far too slow for a full granule; time it on a subset
+    nsub = max(1, int(idx.size * pargs.legacy_frac))
+    t0 = time.perf_counter()
+    l_counts, l_sums = legacy_binning(idx[:nsub], vals[:nsub], npix_hp)
+    t_loop = (time.perf_counter() - t0) * idx.size / nsub
+    print(f"Binning, legacy loop (extrapolated from {nsub:,d} samples): {t_loop:.1f} s")
+    print(f"Speed-up: {t_loop/t_vec:.0f}x")
+
+    # Check on the subset
+    v_counts, v_sums = hp_binning.bincount_sums(idx[:nsub], vals[:nsub], npix_hp)
+    assert np.array_equal(v_counts, l_counts.data)
+    assert np.allclose(v_sums, l_sums.data)
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("Benchmark da_to_healpix")
+    parser.add_argument("--nlat", type=int, default=1500, help="Number of latitudes")
+    parser.add_argument("--nlon", type=int, default=1500, help="Number of longitudes")
+    parser.add_argument("--legacy_frac", type=float, default=0.02,
+                        help="Fraction of the samples to run the legacy loop on")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_option())
@@ -0,0 +1,309 @@
+""" Local catalog of granule files.
+
+Records the collection, sensor, time span and footprint of each
+local granule in SQLite, when it is downloaded or first opened,
+so inputs can be selected by time, bounding box and collection
+without opening the files again.
+
+Times are UTC timestamps (s);  bounding boxes are
+(west, south, east, north) in deg, with west > east when
+crossing the dateline.
+"""
+
+import os
+import json
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas
+import xarray
+
+from remote_sensing.download import footprint
+
+if os.getenv('OS_RS') is not None:
+    catalog_file = os.path.join(os.getenv('OS_RS'), 'granules.sqlite')
+else:
+    catalog_file = os.path.join('./', 'granules.sqlite')
+
+# Columns of a record
+columns = ['path', 'collection', 'sensor', 't_start', 't_end',
+           'west', 'south', 'east', 'north', 'footprint',
+           'concept_id', 'size', 'mtime']
+
+
+def dataset_record(ds:xarray.Dataset):
+    """
+    Catalog attributes of an open granule
+
+    Time from the time coordinate and the time_coverage attributes,
+    the bounding box from the geospatial attributes or the lat/lon
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+
+    Returns
+    -------
+    dict
+        collection, sensor, t_start, t_end, west, south, east, north
+        (None where the dataset does not tell)
+    """
+    record = dict(collection=ds.attrs.get('id'), sensor=ds.attrs.get('sensor'))
+
+    # Time:  the time coordinate (reference time) to the end of coverage
+    times = []
+    if 'time' in ds.coords:
+        times = [pandas.Timestamp(t, tz='UTC').timestamp()
+                 for t in np.atleast_1d(ds.time.values)]
+    coverage = [pandas.Timestamp(ds.attrs[key]).timestamp() 
+                for key in ['time_coverage_start', 'time_coverage_end'] 
+                if key in ds.attrs]
+    record['t_start'] = min(times) if len(times) > 0 else \
+        (min(coverage) if len(coverage) > 0 else None)
+    record['t_end'] = max(times + coverage) if len(times + coverage) > 0 else None
+
+    # Bounding box
+    keys = ['geospatial_lon_min', 'geospatial_lat_min',
+            'geospatial_lon_max', 'geospatial_lat_max']
+    if all([key in ds.attrs for key in keys]):
+        bbox = [float(ds.attrs[key]) for key in keys]
+    elif 'lat' in ds and 'lon' in ds:
+        lats, lons = ds.lat.values, ds.lon.values
+        # Fill values of swaths
+        lats = lats[np.isfinite(lats) & (lats > -1000.)]
+        lons = lons[np.isfinite(lons) & (lons > -1000.)]
+        bbox = [float(np.min(lons)), float(np.min(lats)),
+                float(np.max(lons)), float(np.max(lats))]
+    else:
+        bbox = [None]*4
+    record.update(dict(zip(['west', 'south', 'east', 'north'], bbox)))
+
+    return record
+
+
+class GranuleCatalog(object):
+    """
+    SQLite catalog of local granule files
+    """
+
+    def __init__(self, filename:str=None):
+        """
+        Parameters
+        ----------
+        filename : str, optional
+            SQLite database;  created if needed.  Default is catalog_file
+        """
+        self.filename = catalog_file if filename is None else filename
+        path = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS granules (
+                path TEXT PRIMARY KEY, collection TEXT, sensor TEXT,
+                t_start REAL, t_end REAL,
+                west REAL, south REAL, east REAL, north REAL,
+                footprint TEXT, concept_id TEXT, size INTEGER, mtime INTEGER)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS granules_time
+                ON granules (collection, t_start)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=60.)
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM granules").fetchone()[0]
+
+    def add(self, path:str, collection:str=None, sensor:str=None,
+            t_start:float=None, t_end:float=None, bbox:tuple=None,
+            footprint:dict=None, concept_id:str=None):
+        """
+        Record a local granule (replacing any previous record)
+
+        Parameters
+        ----------
+        path : str
+            Local file
+        collection : str, optional
+        sensor : str, optional
+        t_start, t_end : float, optional
+            Time span (UTC timestamps)
+        bbox : tuple, optional
+            (west, south, east, north) in deg
+        footprint : dict, optional
+            as from download.granules.parse_footprint()
+        concept_id : str, optional
+            CMR concept id
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        if bbox is None:
+            bbox = (None,)*4
+        row = (path, collection, sensor, t_start, t_end) + tuple(bbox) + \
+            (None if footprint is None else json.dumps(footprint),
+             concept_id, stat.st_size, stat.st_mtime_ns)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"INSERT OR REPLACE INTO granules VALUES "
+                         f"({','.join('?'*len(columns))})", row)
+
+    def add_granule(self, granule, path:str):
+        """
+        Record a granule as downloaded
+
+        Parameters
+        ----------
+        granule : download.granules.Granule
+        path : str
+            Local file
+        """
+        self.add(path, collection=granule.collection,
+                 t_start=granule.t_start, t_end=granule.t_end,
+                 bbox=footprint.footprint_bbox(granule.footprint),
+                 footprint=granule.footprint, concept_id=granule.concept_id)
+
+    def add_file(self, path:str, ds:xarray.Dataset=None,
+                 collection:str=None):
+        """
+        Record a granule from its contents
+
+        Parameters
+        ----------
+        path : str
+            Local NetCDF file
+        ds : xarray.Dataset, optional
+            The file, if already open
+        collection : str, optional
+            Default is the id attribute of the file, 
+            else the name of its directory (as laid out by the downloads)
+        """
+        if ds is None:
+            with xarray.open_dataset(path) as ds:
+                record = dataset_record(ds)
+        else:
+            record = dataset_record(ds)
+        if collection is not None:
+            record['collection'] = collection
+        elif record['collection'] is None:
+            record['collection'] = os.path.basename(
+                os.path.dirname(os.path.abspath(path)))
+        self.add(path, collection=record['collection'],
+                 sensor=record['sensor'],
+                 t_start=record['t_start'], t_end=record['t_end'],
+                 bbox=[record[key] for key in ['west', 'south', 'east', 'north']])
+
+    def get(self, path:str):
+        """
+        Record of a file, if it is unchanged since recorded
+
+        Parameters
+        ----------
+        path : str
+
+        Returns
+        -------
+        dict or None
+        """
+        path = os.path.abspath(path)
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM granules WHERE path=?",
+                               (path,)).fetchone()
+        if row is None or not os.path.isfile(path):
+            return None
+        record = self._record(row)
+        stat = os.stat(path)
+        if record['size'] != stat.st_size or record['mtime'] != stat.st_mtime_ns:
+            return None
+        return record
+
+    def index(self, paths:list, collection:str=None):
+        """
+        Make sure files are in the catalog, opening only those
+        that are not (or have changed)
+
+        Parameters
+        ----------
+        paths : list of str
+        collection : str, optional
+            Collection of the files;  see add_file()
+
+        Returns
+        -------
+        list of dict
+            Records, in the order of paths
+        """
+        records = []
+        for path in paths:
+            record = self.get(path)
+            if record is None:
+                self.add_file(path, collection=collection)
+                record = self.get(path)
+            records.append(record)
+        return records
+
+    def query(self, collection:str=None, t_start:float=None,
+              t_end:float=None, bbox:tuple=None, sensor:str=None,
+              newest_first:bool=True, limit:int=None):
+        """
+        Find local granules
+
+        Parameters
+        ----------
+        collection : str, optional
+        t_start, t_end : float, optional
+            Granules overlapping this time span (UTC timestamps)
+        bbox : tuple, optional
+            Granules whose bounding box overlaps this
+            (west, south, east, north);  those without one are kept
+        sensor : str, optional
+        newest_first : bool, optional
+            Order by start time
+        limit : int, optional
+            Most records to return
+
+        Returns
+        -------
+        list of dict
+            Records of the files that still exist
+        """
+        where, args = [], []
+        if collection is not None:
+            where.append("collection = ?")
+            args.append(collection)
+        if sensor is not None:
+            where.append("sensor = ?")
+            args.append(sensor)
+        if t_start is not None:
+            where.append("(t_end IS NULL OR t_end >= ?)")
+            args.append(t_start)
+        if t_end is not None:
+            where.append("(t_start IS NULL OR t_start <= ?)")
+            args.append(t_end)
+        if bbox is not None:
+            where.append("(south IS NULL OR (south <= ? AND north >= ?))")
+            args += [bbox[3], bbox[1]]
+        query = "SELECT * FROM granules"
+        if len(where) > 0:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY t_start {'DESC' if newest_first else 'ASC'}"
+
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(query, args)
+            records = []
+            for row in cursor:
+                record = self._record(row)
+                if bbox is not None and record['west'] is not None and \
+                        not footprint.lon_overlap(record['west'], record['east'],
+                                        bbox[0], bbox[2]):
+                    continue
+                if not os.path.isfile(record['path']):
+                    continue
+                records.append(record)
+                if limit is not None and len(records) == limit:
+                    break
+        return records
+
+    def _record(self, row:tuple):
+        record = dict(zip(columns, row))
+        if record['footprint'] is not None:
+            record['footprint'] = json.loads(record['footprint'])
+        return record
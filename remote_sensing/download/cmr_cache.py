@@ -0,0 +1,238 @@
+""" Local cache of CMR granule search results.
+
+Results are kept in SQLite, per collection and bounding box,
+along with the time window they cover.  A later search within
+that window is answered from the cache;  one reaching past it only
+asks CMR for the granules newer than the newest cached one.
+After cache_ttl seconds since the last full search, the next search
+lists the whole window again (e.g. to pick up reprocessed or
+removed granules).
+"""
+
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+
+import pandas
+
+# Defaults
+cache_ttl = 86400.   # s
+
+# Format of the times sent to CMR
+time_format = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def to_timestamp(iso:str):
+    """
+    Convert an ISO time, e.g. 2025-01-01T00:00:00.000Z, to a UTC timestamp
+
+    Args:
+        iso (str): ISO time;  UTC if no time zone is given
+
+    Returns:
+        float: Seconds since the epoch
+    """
+    # pandas also parses the 'Z' suffix before Python 3.11
+    t = pandas.Timestamp(iso)
+    if t.tzinfo is None:
+        t = t.tz_localize('UTC')
+    return t.timestamp()
+
+
+def to_iso(timestamp:float):
+    """
+    Convert a UTC timestamp to an ISO time, for CMR
+
+    Args:
+        timestamp (float): Seconds since the epoch
+
+    Returns:
+        str: e.g. 2025-01-01T00:00:00Z
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(time_format)
+
+
+def granule_times(item:dict):
+    """
+    Start and end of a granule, from its UMM TemporalExtent
+
+    Args:
+        item (dict): Granule from a CMR umm_json search
+
+    Returns:
+        tuple: (start, end) timestamps;  None if not given
+    """
+    extent = item['umm'].get('TemporalExtent', {})
+    if 'RangeDateTime' in extent:
+        t_range = extent['RangeDateTime']
+        start = to_timestamp(t_range['BeginningDateTime'])
+        end = to_timestamp(t_range.get('EndingDateTime',
+                                       t_range['BeginningDateTime']))
+        return start, end
+    elif 'SingleDateTime' in extent:
+        start = to_timestamp(extent['SingleDateTime'])
+        return start, start
+    return None, None
+
+
+class GranuleCache(object):
+    """
+    SQLite cache of CMR granule searches
+    """
+
+    def __init__(self, filename:str):
+        """
+        Args:
+            filename (str): SQLite database;  created if needed
+        """
+        self.filename = filename
+        path = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS searches (
+                collection TEXT, bbox TEXT, t_start REAL, t_end REAL,
+                synced REAL, PRIMARY KEY (collection, bbox))""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS granules (
+                collection TEXT, bbox TEXT, concept_id TEXT,
+                t_start REAL, t_end REAL, item TEXT,
+                PRIMARY KEY (collection, bbox, concept_id))""")
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=60.)
+
+    def coverage(self, collection:str, bbox:str=None):
+        """
+        Time window covered by the cache
+
+        Args:
+            collection (str): Collection short name
+            bbox (str, optional): Bounding box of the searches
+
+        Returns:
+            tuple or None: (t_start, t_end, synced) timestamps,
+                synced being the time of the last full search
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("""SELECT t_start, t_end, synced FROM searches
+                WHERE collection=? AND bbox=?""",
+                (collection, bbox or '')).fetchone()
+        return row
+
+    def newest(self, collection:str, bbox:str=None):
+        """
+        Start of the newest cached granule
+
+        Returns:
+            float or None: Timestamp
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute("""SELECT MAX(t_start) FROM granules
+                WHERE collection=? AND bbox=?""",
+                (collection, bbox or '')).fetchone()
+        return row[0]
+
+    def store(self, collection:str, bbox:str, items:list,
+              t_start:float, t_end:float, synced:float=None,
+              replace:bool=False):
+        """
+        Add search results to the cache
+
+        Args:
+            collection (str): Collection short name
+            bbox (str): Bounding box of the search, or None
+            items (list): Granules from a CMR umm_json search
+            t_start (float): Start of the window now covered
+            t_end (float): End of the window now covered
+            synced (float, optional): Time of the last full search;
+                unchanged if None
+            replace (bool, optional): Drop the cached granules first
+        """
+        bbox = bbox or ''
+        rows = []
+        for item in items:
+            g_start, g_end = granule_times(item)
+            rows.append((collection, bbox, item['meta']['concept-id'],
+                         g_start, g_end, json.dumps(item)))
+        with closing(self._connect()) as conn, conn:
+            if replace:
+                conn.execute("DELETE FROM granules WHERE collection=? AND bbox=?",
+                             (collection, bbox))
+            conn.executemany("INSERT OR REPLACE INTO granules VALUES (?,?,?,?,?,?)",
+                             rows)
+            if synced is None:
+                conn.execute("""UPDATE searches SET t_start=?, t_end=?
+                    WHERE collection=? AND bbox=?""",
+                    (t_start, t_end, collection, bbox))
+            else:
+                conn.execute("INSERT OR REPLACE INTO searches VALUES (?,?,?,?,?)",
+                             (collection, bbox, t_start, t_end, synced))
+
+    def granules(self, collection:str, bbox:str, t_start:float, t_end:float):
+        """
+        Cached granules overlapping a time window, newest first
+
+        Args:
+            collection (str): Collection short name
+            bbox (str): Bounding box of the search, or None
+            t_start (float): Start of the window
+            t_end (float): End of the window
+
+        Returns:
+            list: Granules, as from a CMR umm_json search
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("""SELECT item FROM granules
+                WHERE collection=? AND bbox=? AND
+                (t_end IS NULL OR t_end >= ?) AND (t_start IS NULL OR t_start <= ?)
+                ORDER BY t_start DESC""",
+                (collection, bbox or '', t_start, t_end)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def search(self, collection:str, bbox:str, t_start:float, t_end:float,
+               query, ttl:float=None, verbose:bool=False):
+        """
+        Search for granules, asking CMR only for what is not cached
+
+        Args:
+            collection (str): Collection short name
+            bbox (str): Bounding box of the search, or None
+            t_start (float): Start of the window
+            t_end (float): End of the window
+            query (callable): Runs the CMR search, called as
+                query(start, end) with ISO times;  returns the granules
+            ttl (float, optional): Age (s) of the last full search
+                beyond which the window is listed again.
+                Default is cache_ttl
+            verbose (bool, optional): Print what is queried
+
+        Returns:
+            list: Granules overlapping the window, newest first
+        """
+        if ttl is None:
+            ttl = cache_ttl
+        now = time.time()
+        cov = self.coverage(collection, bbox)
+
+        if cov is None or now - cov[2] > ttl or t_start < cov[0]:
+            # Full search
+            if verbose:
+                print(f"Searching CMR for {collection}: {to_iso(t_start)} to {to_iso(t_end)}")
+            items = query(to_iso(t_start), to_iso(t_end))
+            self.store(collection, bbox, items, t_start, t_end,
+                       synced=now, replace=True)
+        elif t_end > cov[1]:
+            # Only what is newer than the newest granule
+            newest = self.newest(collection, bbox)
+            since = cov[1] if newest is None else newest
+            if verbose:
+                print(f"Searching CMR for {collection} since {to_iso(since)}")
+            items = query(to_iso(since), to_iso(t_end))
+            self.store(collection, bbox, items, cov[0], t_end)
+        elif verbose:
+            print(f"Using cached search for {collection}")
+
+        return self.granules(collection, bbox, t_start, t_end)
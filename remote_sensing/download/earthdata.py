@@ -1,63 +1,273 @@
-import requests
+""" Methods for the NASA Earthdata collection catalog (CMR).
+
+Pages of a collection search are fetched concurrently over
+a pooled session, and the catalog can be kept locally, in SQLite
+with an inverted keyword index, for fast (and offline) lookups.
+"""
+
+import os
+import re
 import json
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 from typing import List, Dict, Optional
 
+from remote_sensing.download import login
+from remote_sensing.download import transfer
+
+cmr_collections_url = "https://cmr.earthdata.nasa.gov/search/collections.json"
+
+if os.getenv('OS_RS') is not None:
+    catalog_file = os.path.join(os.getenv('OS_RS'), 'Earthdata',
+                                'collections.sqlite')
+else:
+    catalog_file = os.path.join('./', 'Earthdata', 'collections.sqlite')
+
+
+def fetch_collections(
+    page_size: int = 2000,
+    provider: Optional[str] = None,
+    keyword: Optional[str] = None,
+    workers: int = transfer.max_workers,
+    auth: Optional[login.EarthdataLogin] = None,
+    strict: bool = False
+) -> List[Dict]:
+    """
+    Retrieve collection entries from CMR, with the pages
+    after the first requested concurrently over a pooled session.
+
+    Args:
+        page_size: Number of results per page (max 2000)
+        provider: Filter by specific data provider (e.g., 'GHRC_DAAC')
+        keyword: Filter collections by keyword
+        workers: Number of pages requested at once
+        auth: Earthdata Login whose session (and token) to use;
+            the search is public, so by default no login is made
+        strict: Raise an IOError unless every page is fetched
+
+    Returns:
+        List of CMR collection entries (dicts), sorted by short name.
+        If a page fails, only those before it are returned
+        (unless strict)
+    """
+    if auth is None:
+        session = transfer.make_session(pool_size=workers)
+    else:
+        auth.grow_pool(workers)
+        session = auth
+
+    params = {'page_size': page_size, 'sort_key': 'short_name'}
+    if provider:
+        params['provider'] = provider
+    if keyword:
+        params['keyword'] = keyword
+
+    def get_page(page):
+        response = session.get(cmr_collections_url,
+            params=dict(params, page_num=page), timeout=transfer.timeout)
+        response.raise_for_status()
+        return response
+
+    # The first page gives the number of hits
+    try:
+        response = get_page(1)
+        pages = [response.json().get('feed', {}).get('entry', [])]
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+        if strict:
+            raise IOError(f"Error fetching data: {e}")
+        print(f"Error fetching data: {e}")
+        return []
+    hits = int(response.headers.get('CMR-Hits', len(pages[0])))
+    npages = -(-hits // page_size)
+
+    # The rest
+    def one(page):
+        try:
+            return get_page(page).json().get('feed', {}).get('entry', [])
+        except (requests.exceptions.RequestException,
+                json.JSONDecodeError) as e:
+            print(f"Error fetching data: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for entries in pool.map(one, range(2, npages+1)):
+            if entries is None:
+                break
+            pages.append(entries)
+    if strict and len(pages) < npages:
+        raise IOError(f"Only {len(pages)} of {npages} pages were fetched")
+
+    return [entry for entries in pages for entry in entries]
+
+
 def get_earthdata_shortnames(
     page_size: int = 100,
     provider: Optional[str] = None,
-    keyword: Optional[str] = None
+    keyword: Optional[str] = None,
+    auth: Optional[login.EarthdataLogin] = None,
+    workers: int = transfer.max_workers
 ) -> List[Dict]:
     """
     Retrieve collection short names from NASA's Common Metadata Repository (CMR).
-    
+
     Args:
         page_size: Number of results per page (default 100, max 2000)
         provider: Filter by specific data provider (e.g., 'GHRC_DAAC')
         keyword: Filter collections by keyword
-    
+        auth: Earthdata Login whose session (and token) to use,
+            e.g. login.shared();  the search is public, so by default
+            no login is made
+        workers: Number of pages requested at once
+
     Returns:
         List of dictionaries containing short_name and title for each collection
     """
-    base_url = "https://cmr.earthdata.nasa.gov/search/collections.json"
-    collections = []
-    page = 1
-    
-    while True:
-        params = {
-            'page_size': page_size,
-            'page_num': page,
-            'sort_key': 'short_name'
-        }
-        
-        if provider:
-            params['provider'] = provider
-        if keyword:
-            params['keyword'] = keyword
-            
+    return [summarize(entry) for entry in fetch_collections(
+        page_size=page_size, provider=provider, keyword=keyword,
+        workers=workers, auth=auth)]
+
+
+def summarize(entry: Dict) -> Dict:
+    """
+    Short name, title and provider of a CMR collection entry
+    """
+    return {'short_name': entry.get('short_name'),
+            'title': entry.get('title'),
+            'provider': entry.get('provider_id')}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lower-case keywords, e.g. for the catalog index
+
+    Args:
+        text: Any text, e.g. a title
+
+    Returns:
+        Unique keywords, in order of appearance
+    """
+    if not text:
+        return []
+    return list(dict.fromkeys(re.findall(r'[a-z0-9]+', text.lower())))
+
+
+class CollectionCatalog(object):
+    """
+    Local copy of the CMR collection catalog, in SQLite,
+    with an inverted index of the keywords of the short name,
+    title and summary of each collection.
+    """
+
+    def __init__(self, filename: str = None):
+        """
+        Args:
+            filename: SQLite database;  created if needed.
+                Default is catalog_file
+        """
+        self.filename = catalog_file if filename is None else filename
+        path = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS collections (
+                id INTEGER PRIMARY KEY, concept_id TEXT, short_name TEXT,
+                version TEXT, title TEXT, provider TEXT, entry TEXT)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS keywords (
+                term TEXT, collection INTEGER)""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS keywords_term
+                ON keywords (term)""")
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=60.)
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM collections").fetchone()[0]
+
+    def build(self, entries: List[Dict]):
+        """
+        Replace the catalog, and its index
+
+        Args:
+            entries: CMR collection entries, as from fetch_collections()
+        """
+        rows, terms = [], []
+        for idx, entry in enumerate(entries):
+            rows.append((idx, entry.get('id'), entry.get('short_name'),
+                         entry.get('version_id'), entry.get('title'),
+                         entry.get('provider_id'), json.dumps(entry)))
+            words = []
+            for field in ['short_name', 'title', 'summary']:
+                words += tokenize(entry.get(field))
+            terms += [(word, idx) for word in dict.fromkeys(words)]
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM collections")
+            conn.execute("DELETE FROM keywords")
+            conn.executemany("INSERT INTO collections VALUES (?,?,?,?,?,?,?)",
+                             rows)
+            conn.executemany("INSERT INTO keywords VALUES (?,?)", terms)
+
+    def update(self, provider: Optional[str] = None,
+               workers: int = transfer.max_workers,
+               auth: Optional[login.EarthdataLogin] = None,
+               page_size: int = 2000):
+        """
+        Fetch the catalog from CMR and rebuild the local copy,
+        only if every page was fetched
+
+        Args:
+            provider: Only the collections of this provider
+            workers: Number of pages requested at once
+            auth: Earthdata Login to use;  see fetch_collections()
+            page_size: Number of results per page (max 2000)
+        """
         try:
-            response = requests.get(base_url, params=params)
-            response.raise_for_status()
-            
-            data = response.json()
-            entries = data.get('feed', {}).get('entry', [])
-            
-            if not entries:
-                break
-                
-            for entry in entries:
-                collections.append({
-                    'short_name': entry.get('short_name'),
-                    'title': entry.get('title'),
-                    'provider': entry.get('provider_id')
-                })
-                
-            page += 1
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching data: {e}")
-            break
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {e}")
-            break
-            
-    return collections
\ No newline at end of file
+            entries = fetch_collections(page_size=page_size, provider=provider,
+                                        workers=workers, auth=auth, strict=True)
+        except IOError as e:
+            print(f"{e};  keeping the catalog")
+            return
+        if len(entries) == 0:
+            print("No collections fetched;  keeping the catalog")
+            return
+        self.build(entries)
+
+    def search(self, keywords: str, provider: Optional[str] = None,
+               full: bool = False) -> List[Dict]:
+        """
+        Find the collections matching all the keywords
+
+        Args:
+            keywords: e.g. 'sst viirs l2p', or a short name
+                (split into its keywords)
+            provider: Only the collections of this provider
+            full: Return the whole CMR entries
+
+        Returns:
+            Matching collections, as from get_earthdata_shortnames()
+            (or CMR entries if full), sorted by short name
+        """
+        terms = tokenize(keywords)
+        if len(terms) == 0:
+            return []
+
+        query = """SELECT short_name, title, provider, entry FROM collections
+            WHERE id IN (SELECT collection FROM keywords WHERE term IN ({})
+                GROUP BY collection HAVING COUNT(DISTINCT term) = ?)""".format(
+                ','.join('?'*len(terms)))
+        args = terms + [len(terms)]
+        if provider:
+            query += " AND provider = ?"
+            args.append(provider)
+        query += " ORDER BY short_name"
+
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query, args).fetchall()
+        if full:
+            return [json.loads(row[3]) for row in rows]
+        return [{'short_name': row[0], 'title': row[1], 'provider': row[2]}
+                for row in rows]
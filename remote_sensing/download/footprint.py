@@ -0,0 +1,192 @@
+""" Granule footprints, and their intersection with a bounding box.
+
+Footprints are as parsed from the UMM SpatialExtent of CMR
+granules (see granules.parse_footprint()):  bounding rectangles
+and GPolygons, in deg.  Bounding boxes are (west, south, east, north),
+with west > east when crossing the dateline.
+
+Polygons are intersected exactly as polygons in lon/lat, after
+unwrapping their longitudes about the box, so across the dateline too.
+Their edges are taken as straight in lon/lat rather than great circles,
+a fine approximation for the densely sampled swath outlines of CMR.
+"""
+
+import numpy as np
+
+
+def parse_bbox(bbox:str):
+    """
+    Parse a CMR bounding box
+
+    Args:
+        bbox (str): "lon_min,lat_min,lon_max,lat_max" in deg
+
+    Returns:
+        tuple: (west, south, east, north)
+    """
+    values = [float(value) for value in bbox.split(',')]
+    if len(values) != 4:
+        raise ValueError(f"Bad bounding box: {bbox}")
+    return tuple(values)
+
+
+def lon_overlap(west1:float, east1:float, west2:float, east2:float):
+    """
+    Do two longitude ranges overlap, either possibly crossing the dateline?
+
+    Args:
+        west1 (float): First range, west end (deg)
+        east1 (float): First range, east end (deg);
+            less than west1 if it crosses the dateline
+        west2 (float): Second range, west end (deg)
+        east2 (float): Second range, east end (deg)
+
+    Returns:
+        bool:
+    """
+    def pieces(west, east):
+        if east - west >= 360.:
+            return [(-180., 180.)]
+        west = (west + 180.) % 360. - 180.
+        east = (east + 180.) % 360. - 180.
+        if west <= east:
+            return [(west, east)]
+        return [(west, 180.), (-180., east)]
+
+    for w1, e1 in pieces(west1, east1):
+        for w2, e2 in pieces(west2, east2):
+            if w1 <= e2 and w2 <= e1:
+                return True
+    return False
+
+
+def footprint_bbox(footprint:dict):
+    """
+    Bounding box of a footprint, the shortest way round in longitude
+
+    Args:
+        footprint (dict): as from granules.parse_footprint()
+
+    Returns:
+        tuple or None: (west, south, east, north) in deg, with 
+            west > east if it crosses the dateline
+    """
+    if footprint is None:
+        return None
+    lons, lats = [], []
+    for west, south, east, north in footprint['rectangles']:
+        # Sample the rectangle along its longitudes (<= 90 deg apart)
+        if east < west:
+            east += 360.
+        lons += list(np.linspace(west, east, 5))
+        lats += [south, north]
+    for polygon in footprint['polygons']:
+        lons += [lon for lon, _ in polygon]
+        lats += [lat for _, lat in polygon]
+
+    # The longitudes span all but their largest gap
+    lons = np.unique(np.mod(lons, 360.))
+    gaps = np.diff(np.append(lons, lons[0]+360.))
+    igap = np.argmax(gaps)
+    south, north = float(min(lats)), float(max(lats))
+    if gaps[igap] <= 90.:
+        # All the way round, as far as the vertices tell
+        return (-180., south, 180., north)
+    to_180 = lambda lon: float((lon + 180.) % 360. - 180.)
+    return (to_180(lons[(igap+1) % len(lons)]), south, 
+            to_180(lons[igap]), north)
+
+
+def _segments_hit_box(lons:np.ndarray, lats:np.ndarray, box:tuple):
+    """ Does any segment of a polyline touch the box? (Liang-Barsky) """
+    west, south, east, north = box
+    x0, y0 = lons[:-1], lats[:-1]
+    dx, dy = np.diff(lons), np.diff(lats)
+    t0 = np.zeros_like(dx)
+    t1 = np.ones_like(dx)
+    miss = np.zeros(dx.shape, dtype=bool)
+    for p, q in [(-dx, x0-west), (dx, east-x0), (-dy, y0-south), (dy, north-y0)]:
+        parallel = p == 0.
+        miss |= parallel & (q < 0.)
+        r = q / np.where(parallel, 1., p)
+        t0 = np.where(~parallel & (p < 0.), np.maximum(t0, r), t0)
+        t1 = np.where(~parallel & (p > 0.), np.minimum(t1, r), t1)
+    return bool(np.any(~miss & (t0 <= t1)))
+
+
+def _point_in_polygon(lon:float, lat:float, lons:np.ndarray, lats:np.ndarray):
+    """ Even-odd rule, for a closed polyline """
+    x0, y0, x1, y1 = lons[:-1], lats[:-1], lons[1:], lats[1:]
+    crosses = (y0 > lat) != (y1 > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x0 + (lat - y0) * (x1 - x0) / (y1 - y0)
+    return bool(np.sum(crosses & (lon < x_cross)) % 2)
+
+
+def polygon_intersects(polygon:list, box:tuple):
+    """
+    Does a polygon intersect a bounding box?
+
+    Args:
+        polygon (list): Outer boundary, [(lon, lat), ...] in deg
+        box (tuple): (west, south, east, north) in deg
+
+    Returns:
+        bool:
+    """
+    west, south, east, north = box
+    if east < west:
+        east += 360.
+    center = (west + east) / 2.
+
+    lons = np.array([lon for lon, _ in polygon], dtype=float)
+    lats = np.array([lat for _, lat in polygon], dtype=float)
+    if lons[0] != lons[-1] or lats[0] != lats[-1]:
+        lons = np.append(lons, lons[0])
+        lats = np.append(lats, lats[0])
+
+    # Unwrap, starting within 180 deg of the box
+    steps = (np.diff(lons) + 180.) % 360. - 180.
+    start = (lons[0] - center + 180.) % 360. - 180. + center
+    lons = start + np.concatenate([[0.], np.cumsum(steps)])
+
+    # Around a pole:  all longitudes, from its latitudes to the pole
+    #  (UMM polygons run counter-clockwise, so eastward around the north)
+    if lons[-1] - lons[0] > 180.:
+        return bool(north >= min(lats))
+    if lons[-1] - lons[0] < -180.:
+        return bool(south <= max(lats))
+
+    # The box may also meet the polygon one turn away
+    for shift in [0., -360., 360.]:
+        if _segments_hit_box(lons + shift, lats, (west, south, east, north)):
+            return True
+        # The box inside the polygon
+        if _point_in_polygon(center - shift, (south + north) / 2., lons, lats):
+            return True
+    return False
+
+
+def intersects(footprint:dict, box:tuple):
+    """
+    Does a footprint intersect a bounding box?
+
+    Args:
+        footprint (dict): as from granules.parse_footprint();
+            None (unknown, e.g. orbit only) intersects everything
+        box (tuple): (west, south, east, north) in deg
+
+    Returns:
+        bool:
+    """
+    if footprint is None:
+        return True
+    west, south, east, north = box
+    for r_west, r_south, r_east, r_north in footprint['rectangles']:
+        if r_south <= north and r_north >= south and \
+                lon_overlap(r_west, r_east, west, east):
+            return True
+    for polygon in footprint['polygons']:
+        if polygon_intersects(polygon, box):
+            return True
+    return False
@@ -0,0 +1,113 @@
+""" Granule records parsed from CMR umm_json search results. """
+
+import os
+
+from subscriber import podaac_access as pa
+
+from remote_sensing.download import cmr_cache
+
+
+class Granule(object):
+    """
+    A granule:  its data file, checksum, time span and footprint
+    """
+
+    def __init__(self, concept_id:str, url:str, checksum:dict=None,
+                 t_start:float=None, t_end:float=None, footprint:dict=None):
+        """
+        Args:
+            concept_id (str): CMR concept id, e.g. G1234-POCLOUD
+            url (str): URL of the data file
+            checksum (dict, optional): e.g. {'Value': 'd963...', 'Algorithm': 'MD5'}
+            t_start (float, optional): Start time (UTC timestamp)
+            t_end (float, optional): End time (UTC timestamp)
+            footprint (dict, optional): Spatial extent, see parse_footprint()
+        """
+        self.concept_id = concept_id
+        self.url = url
+        self.checksum = checksum
+        self.t_start = t_start
+        self.t_end = t_end
+        self.footprint = footprint
+
+    @property
+    def filename(self):
+        """ str: Name of the data file """
+        return os.path.basename(self.url)
+
+    @property
+    def collection(self):
+        """ str: Collection, as in the path of the URL """
+        return self.url.split('/')[-2]
+
+    @classmethod
+    def from_umm(cls, item:dict):
+        """
+        Parse a granule of a CMR umm_json search
+
+        Args:
+            item (dict): Granule, with its 'meta' and 'umm'
+
+        Returns:
+            Granule or None: None if it has no data file
+        """
+        url = data_url(item)
+        if url is None:
+            return None
+        checksums = pa.extract_checksums([item])
+        t_start, t_end = cmr_cache.granule_times(item)
+        return cls(item['meta']['concept-id'], url,
+                   checksum=checksums.get(os.path.basename(url)),
+                   t_start=t_start, t_end=t_end,
+                   footprint=parse_footprint(item))
+
+    def __repr__(self):
+        t_start = 'None' if self.t_start is None else cmr_cache.to_iso(self.t_start)
+        return f'<Granule: {self.filename}, {t_start}>'
+
+
+def data_url(item:dict):
+    """
+    URL of the data file of a granule (not OPeNDAP),
+    with one of the extensions of podaac_access
+
+    Args:
+        item (dict): Granule of a CMR umm_json search
+
+    Returns:
+        str or None:
+    """
+    for u in item['umm'].get('RelatedUrls', []):
+        if u['Type'] != "GET DATA" or u.get('Subtype') == "OPENDAP DATA":
+            continue
+        for extension in pa.extensions:
+            if pa.search_extension(extension, u['URL']):
+                return u['URL']
+    return None
+
+
+def parse_footprint(item:dict):
+    """
+    Spatial extent of a granule, from its UMM HorizontalSpatialDomain
+
+    Args:
+        item (dict): Granule of a CMR umm_json search
+
+    Returns:
+        dict or None: with 'rectangles', a list of (west, south, east, north),
+            and 'polygons', a list of outer boundaries as [(lon, lat), ...],
+            in deg.  None if the granule gives no geometry
+    """
+    try:
+        geometry = item['umm']['SpatialExtent']['HorizontalSpatialDomain']['Geometry']
+    except KeyError:
+        return None
+    rectangles = [(r['WestBoundingCoordinate'], r['SouthBoundingCoordinate'],
+                   r['EastBoundingCoordinate'], r['NorthBoundingCoordinate'])
+                  for r in geometry.get('BoundingRectangles', [])]
+    polygons = [[(p['Longitude'], p['Latitude']) for p in g['Boundary']['Points']]
+                for g in geometry.get('GPolygons', [])]
+    if len(rectangles) == 0 and len(polygons) == 0:
+        return None
+    return dict(rectangles=rectangles, polygons=polygons)
+
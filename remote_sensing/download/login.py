@@ -0,0 +1,146 @@
+""" Earthdata Login (EDL) token and HTTP session, shared across calls.
+
+One EarthdataLogin logs in on first use and holds the token, and
+a keep-alive requests.Session sending it, until the token is
+rejected (401) or older than token_max_age.  It is thread-safe,
+so a pool of download threads can share it, and it pickles with
+its token (but not its connections), so worker processes can too.
+
+The functions of download.podaac use shared() by default.
+"""
+
+import time
+import threading
+
+from subscriber import podaac_access as pa
+
+from remote_sensing.download import transfer
+
+# Defaults
+token_max_age = 86400.   # s;  before asking EDL for the token again
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class EarthdataLogin(object):
+    """
+    Earthdata Login token and session
+    """
+
+    def __init__(self, pool_size:int=transfer.max_workers, token:str=None):
+        """
+        Args:
+            pool_size (int, optional): Connections kept per host
+            token (str, optional): Token to start with;
+                otherwise one is obtained on first use
+        """
+        self.pool_size = pool_size
+        self._token = token
+        self._token_time = None if token is None else time.time()
+        self._session = None
+        self._lock = threading.RLock()
+
+    def _set_token(self, token:str):
+        self._token = token
+        self._token_time = time.time()
+        if self._session is not None:
+            self._session.headers['Authorization'] = f'Bearer {token}'
+
+    @property
+    def token(self):
+        """ str: A valid token, logging in if need be """
+        with self._lock:
+            if self._token is None or \
+                    time.time() - self._token_time > token_max_age:
+                pa.setup_earthdata_login_auth(pa.edl)
+                self._set_token(pa.get_token(pa.token_url))
+            return self._token
+
+    @property
+    def session(self):
+        """ requests.Session: Keep-alive session sending the token """
+        with self._lock:
+            if self._session is None:
+                self._session = transfer.make_session(self.token,
+                                                      pool_size=self.pool_size)
+            return self._session
+
+    def refresh(self, old_token:str=None):
+        """
+        Replace a rejected token
+
+        Args:
+            old_token (str, optional): The token that was rejected.
+                If another thread has already replaced it,
+                nothing is done
+
+        Returns:
+            str: The new token
+        """
+        with self._lock:
+            if old_token is None or old_token == self._token:
+                self._set_token(pa.refresh_token(self._token))
+            return self._token
+
+    def grow_pool(self, pool_size:int):
+        """
+        Keep at least pool_size connections per host,
+        e.g. for as many download threads
+
+        Args:
+            pool_size (int): Connections kept per host
+        """
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            if self._session is not None:
+                session = transfer.make_session(self._token,
+                                                pool_size=pool_size)
+                self._session.adapters = session.adapters
+
+    def get(self, url:str, **kwargs):
+        """
+        GET with the session, refreshing the token once on a 401
+
+        Takes the arguments of requests.Session.get(), so it can stand
+        in for the session, e.g. in transfer.fetch_files()
+
+        Returns:
+            requests.Response:
+        """
+        token = self.token
+        response = self.session.get(url, **kwargs)
+        if response.status_code == 401:
+            response.close()
+            self.refresh(token)
+            response = self.session.get(url, **kwargs)
+        return response
+
+    def __getstate__(self):
+        # The token only;  connections and locks do not travel
+        return dict(pool_size=self.pool_size, token=self._token,
+                    token_time=self._token_time)
+
+    def __setstate__(self, state):
+        self.__init__(pool_size=state['pool_size'], token=state['token'])
+        self._token_time = state['token_time']
+
+    def __repr__(self):
+        status = 'logged in' if self._token is not None else 'not logged in'
+        return f'<EarthdataLogin: {status}>'
+
+
+def shared():
+    """
+    The EarthdataLogin shared by default within this process
+
+    Returns:
+        EarthdataLogin:
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = EarthdataLogin()
+        return _shared
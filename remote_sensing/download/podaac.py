@@ -6,6 +6,7 @@ aka subscriber.podaac_data_downloader
 """
 
 import os
+import time
 
 from datetime import datetime, timedelta, timezone
 
@@ -14,6 +15,12 @@ from subscriber import podaac_access as pa
 
 from urllib.error import HTTPError
 
+from remote_sensing.download import transfer
+from remote_sensing.download import cmr_cache
+from remote_sensing.download import login
+from remote_sensing.download import granules as rs_granules
+from remote_sensing.download import footprint
+
 from IPython import embed
 
 page_size = 2000
@@ -24,14 +31,33 @@ if os.getenv('OS_RS') is not None:
 else:
     podaac_path = os.path.join('./', 'PODAAC')
 
+# CMR granule search
+cmr_search_url = f"https://{pa.cmr}/search/granules.umm_json"
+
+# Search results
+cache_file = os.path.join(podaac_path, 'cmr_cache.sqlite')
+
 def grab_file_list(collection:str, 
                    time_range:tuple=None, 
                    t_end:str=None,
                    dt_past:dict=None, 
                    bbox:str=None,
-                   verbose:bool=True):
+                   verbose:bool=True,
+                   use_cache:bool=True,
+                   ttl:float=None,
+                   auth:login.EarthdataLogin=None,
+                   prefilter:bool=True):
     """ Grab a list of files from the PO.DAAC archive.
 
+    Search results are cached on disk (see download.cmr_cache), 
+    so repeating a search only asks CMR for the granules newer 
+    than those already listed.
+
+    The CMR bounding_box search is coarse (e.g. for whole swaths), 
+    so with a bbox the footprint of each granule is intersected 
+    exactly with it, and those that miss are dropped;  see 
+    download.footprint.
+
     Args:
         collection (str): PO.DAAC collection name.
         verbose (bool, optional): Print verbose output. Defaults to True.
@@ -48,6 +74,15 @@ def grab_file_list(collection:str,
         bbox (str, optional): Bounding box in the format of
             "lon_min,lat_min,lon_max,lat_max" in deg 
             Defaults to None.
+        use_cache (bool, optional): Use the search cache, cache_file.
+            Defaults to True.
+        ttl (float, optional): Age (s) of the cached search beyond which
+            the whole time range is searched again.
+            Defaults to cmr_cache.cache_ttl
+        auth (login.EarthdataLogin, optional): Earthdata Login to use.
+            Defaults to login.shared()
+        prefilter (bool, optional): Drop the granules whose footprint
+            misses the bbox. Defaults to True.
 
     Raises:
         e: _description_
@@ -57,19 +92,6 @@ def grab_file_list(collection:str,
             - list: List of files.
             - list: List of checksums.
     """
-    
-    # Authenicate with Earthdata Login
-    pa.setup_earthdata_login_auth(pa.edl)
-    token = pa.get_token(pa.token_url)
-
-    # Colleection ID
-    collection_id = pa.get_cmr_collection_id(
-        collection_short_name=collection,
-        provider=provider,
-        token=token,
-        verbose=verbose)
-
-
     # Times
     now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
     if time_range is None:
@@ -87,41 +109,30 @@ def grab_file_list(collection:str,
     else:
         start_date_time, end_date_time = time_range
 
-    temporal_range = pa.get_temporal_range(
-        start_date_time, end_date_time, now)
-    params = [
-            ('page_size', page_size),
-            ('sort_key', "-start_date"),
-            ('provider', provider),
-            ('ShortName', collection),
-            ('temporal', temporal_range),
-            ('token', token),
-        ]
-    if bbox is not None:
-        params.append(('bounding_box', bbox))
+    def query(start, end):
+        return search_granules(collection, start, end, now, 
+                               bbox=bbox, verbose=verbose, auth=auth)
 
-    # If 401 is raised, refresh token and try one more time
-    try:
-        results = pa.get_search_results(params, verbose)
-    except HTTPError as e:
-        if e.code == 401:
-            token = pa.refresh_token(token)
-            # Updated: This is not always a dictionary...
-            # in fact, here it's always a list of tuples
-            for  i, p in enumerate(params) :
-                if p[1] == "token":
-                    params[i] = ("token", token)
-            results = pa.get_search_results(params, verbose)
-        else:
-            raise e
+    if use_cache:
+        cache = cmr_cache.GranuleCache(cache_file)
+        items = cache.search(collection, bbox, 
+            cmr_cache.to_timestamp(start_date_time),
+            cmr_cache.to_timestamp(end_date_time),
+            query, ttl=ttl, verbose=verbose)
+    else:
+        items = query(start_date_time, end_date_time)
+
+    # Footprints
+    if bbox is not None and prefilter:
+        items = _prefilter(items, bbox, verbose=verbose)
 
     # Downloads
     downloads_all = []
     downloads_data = [[u['URL'] for u in r['umm']['RelatedUrls'] if
                        u['Type'] == "GET DATA" and ('Subtype' not in u or u['Subtype'] != "OPENDAP DATA")] for r in
-                      results['items']]
+                      items]
     downloads_metadata = [[u['URL'] for u in r['umm']['RelatedUrls'] if u['Type'] == "EXTENDED METADATA"] for r in
-                          results['items']]
+                          items]
 
     for f in downloads_data:
         downloads_all.append(f)
@@ -138,18 +149,99 @@ def grab_file_list(collection:str,
                 filtered_downloads.append(f)
 
     downloads = filtered_downloads
-    checksums = pa.extract_checksums(results['items'])
+    checksums = pa.extract_checksums(items)
 
     # Return
     return downloads, checksums
 
 
+def _prefilter(items:list, bbox:str, verbose:bool=True):
+    """ Keep the granules whose footprint intersects the bbox """
+    box = footprint.parse_bbox(bbox)
+    kept = [item for item in items if footprint.intersects(
+        rs_granules.parse_footprint(item), box)]
+    if verbose:
+        print(f"Footprints: {len(kept)} of {len(items)} granules intersect {bbox}")
+    return kept
+
+
+def search_granules(collection:str, start_date_time:str, 
+                    end_date_time:str, now:str=None,
+                    bbox:str=None, verbose:bool=True,
+                    auth:login.EarthdataLogin=None):
+    """ Search CMR for the granules of a collection
+
+    Args:
+        collection (str): PO.DAAC collection name.
+        start_date_time (str): Start of the time range, ISO format.
+        end_date_time (str): End of the time range, ISO format.
+        now (str, optional): Current time in ISO format.
+        bbox (str, optional): Bounding box in the format of
+            "lon_min,lat_min,lon_max,lat_max" in deg 
+        verbose (bool, optional): Print verbose output. Defaults to True.
+        auth (login.EarthdataLogin, optional): Earthdata Login to use.
+            Defaults to login.shared()
+
+    Returns:
+        list: Granules (umm_json items), newest first
+    """
+    if now is None:
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # Authenicate with Earthdata Login
+    if auth is None:
+        auth = login.shared()
+    token = auth.token
+
+    temporal_range = pa.get_temporal_range(
+        start_date_time, end_date_time, now)
+    params = [
+            ('page_size', page_size),
+            ('sort_key', "-start_date"),
+            ('provider', provider),
+            ('ShortName', collection),
+            ('temporal', temporal_range),
+            ('token', token),
+        ]
+    if bbox is not None:
+        params.append(('bounding_box', bbox))
+
+    # If 401 is raised, refresh token and try one more time
+    try:
+        results = pa.get_search_results(params, verbose)
+    except HTTPError as e:
+        if e.code == 401:
+            token = auth.refresh(token)
+            # Updated: This is not always a dictionary...
+            # in fact, here it's always a list of tuples
+            for  i, p in enumerate(params) :
+                if p[0] == "token":
+                    params[i] = ("token", token)
+            results = pa.get_search_results(params, verbose)
+        else:
+            raise e
+
+    return results['items']
+
+
 def download_files(file_list:list, 
                    download_dir:str=None, 
                    clobber:bool=False,
-                   verbose:bool=True):
+                   verbose:bool=True,
+                   workers:int=transfer.max_workers,
+                   session=None,
+                   checksums:dict=None):
     """ Download files from the PO.DAAC archive.
 
+    The files are downloaded concurrently by a pool of threads 
+    sharing one keep-alive session;  see download.transfer.
+
+    With checksums, existing files are verified and re-downloaded
+    if they do not match, and new ones are verified before being
+    kept.  The checksums of local files are recorded in a manifest
+    (transfer.manifest_file) in download_dir, so unchanged files
+    are not hashed again.
+
     Parameters
     -----------
     file_list : list
@@ -160,18 +252,28 @@ def download_files(file_list:list,
     clobber : bool, optional
         Overwrite existing files. Default is False.
     verbose : bool, optional
-        Print verbose output. Default is True.
+        Print verbose output, with a progress bar per file. Default is True.
+    workers : int, optional
+        Number of concurrent downloads.
+    session : login.EarthdataLogin or requests.Session, optional
+        Authenticated session to use.  Default is login.shared()
+    checksums : dict, optional
+        Checksums keyed by filename, as returned by grab_file_list(),
+        e.g. {'file.nc': {'Value': 'd963...', 'Algorithm': 'MD5'}}
 
     Returns
     --------
-    list : List of local files that were successfully downloaded.
+    list : List of local files that were successfully downloaded,
+        in the order of file_list;  None for those that failed.
 
     """
     local_files = [None]*len(file_list)
 
     # Authenicate with Earthdata Login
-    pa.setup_earthdata_login_auth(pa.edl)
-    token = pa.get_token(pa.token_url)
+    if session is None:
+        session = login.shared()
+    if isinstance(session, login.EarthdataLogin):
+        session.grow_pool(workers)
 
     if download_dir is None:
         print(f"Using default download directory: {podaac_path}")
@@ -179,8 +281,15 @@ def download_files(file_list:list,
     if not os.path.isdir(download_dir):
         os.makedirs(download_dir)
 
+    if checksums is None:
+        checksums = {}
+    manifest = transfer.Manifest(os.path.join(download_dir, 
+                                              transfer.manifest_file))
+
     # Loop on files
-    success_cnt = failure_cnt = skip_cnt = 0
+    skip_cnt = 0
+    to_get = []
+    to_verify = []
     for ss, f in enumerate(file_list):
 
         # Parse filename
@@ -192,39 +301,288 @@ def download_files(file_list:list,
         full_path = os.path.join(download_dir, collection)
         if not os.path.isdir(full_path):
             print(f'Creating directory: {full_path}')
-            os.makedirs(full_path)
+            os.makedirs(full_path, exist_ok=True)
 
         # Filename
         filename = fparse[-1]
-
-
-        # Download
-
-        try:
-            # -d flag, args.outputDirectory
-            output_path = os.path.join(full_path, filename)
+        output_path = os.path.join(full_path, filename)
             
-            # decide if we should actually download this file (e.g. we may already have the latest version)
-            if os.path.isfile(output_path) and not clobber:# and pa.checksum_does_match(output_path, checksums)):
-                if verbose:
-                    print(f'File exists: {filename}\n  --- Use clobber=True to overwrite')
-                skip_cnt += 1
-                local_files[ss] = output_path
+        # decide if we should actually download this file (e.g. we may already have the latest version)
+        if os.path.isfile(output_path) and not clobber:
+            if filename in checksums:
+                to_verify.append((ss, f, output_path))
                 continue
-
-            pa.download_file(f,output_path)
-            success_cnt = success_cnt + 1
+            if verbose:
+                print(f'File exists: {filename}\n  --- Use clobber=True to overwrite')
+            skip_cnt += 1
             local_files[ss] = output_path
+            continue
 
-            # Success
+        to_get.append((ss, f, output_path))
+
+    # Verify existing files;  those changed or corrupt are fetched again
+    matches = transfer.verify_files([item[2] for item in to_verify],
+        [checksums[os.path.basename(item[2])] for item in to_verify],
+        manifest=manifest, workers=workers)
+    for item, match in zip(to_verify, matches):
+        filename = os.path.basename(item[2])
+        if match:
+            if verbose:
+                print(f'File exists and matches its checksum: {filename}')
+            skip_cnt += 1
+            local_files[item[0]] = item[2]
+        else:
+            print(f'File does not match its checksum: {filename}\n  --- Downloading again')
+            to_get.append(item)
+
+    # Download
+    def report(idx, error):
+        ss, _, output_path = to_get[idx]
+        if error is None:
+            local_files[ss] = output_path
+            # Verified by fetch_file();  no need to hash again
+            checksum = checksums.get(os.path.basename(output_path))
+            if checksum is not None:
+                manifest.record(output_path, checksum['Algorithm'], 
+                                checksum['Value'])
             if verbose:
                 print(f'File downloaded: {output_path}')
+        else:
+            print(f'File failed to download: {os.path.basename(output_path)}. {error}') 
 
-        except Exception:
-            print(f'File failed to download: {filename}.') 
-            failure_cnt = failure_cnt + 1
+    errors = transfer.fetch_files(session, 
+        [item[1] for item in to_get], [item[2] for item in to_get],
+        workers=workers, progress=verbose, callback=report,
+        checksums=[checksums.get(os.path.basename(item[2])) for item in to_get])
+    if len(checksums) > 0:
+        manifest.save()
 
+    failure_cnt = sum([error is not None for error in errors])
+    success_cnt = len(to_get) - failure_cnt
     print(f"Downloaded {success_cnt} files, failed on {failure_cnt} files, skipped {skip_cnt} existing files.")
 
     # Return
-    return local_files
\ No newline at end of file
+    return local_files
+
+
+def iter_granules(collection:str, 
+                  start_date_time:str, 
+                  end_date_time:str=None,
+                  bbox:str=None,
+                  sort_key:str='-start_date',
+                  verbose:bool=False,
+                  auth:login.EarthdataLogin=None,
+                  prefilter:bool=True):
+    """ Stream the granules of a collection from CMR, page by page.
+
+    Pages are requested one at a time with CMR-Search-After, 
+    as the generator is consumed, so a long time range is 
+    never held in memory and processing starts with the first page.
+
+    Args:
+        collection (str): PO.DAAC collection name.
+        start_date_time (str): Start of the time range, ISO format.
+        end_date_time (str, optional): End of the time range, ISO format.
+            Defaults to now.
+        bbox (str, optional): Bounding box in the format of
+            "lon_min,lat_min,lon_max,lat_max" in deg 
+        sort_key (str, optional): CMR sort key;  newest first by default
+        verbose (bool, optional): Print each page requested.
+        auth (login.EarthdataLogin, optional): Earthdata Login to use.
+            Defaults to login.shared()
+        prefilter (bool, optional): Skip the granules whose footprint
+            misses the bbox;  see grab_file_list()
+
+    Yields:
+        granules.Granule: with its URL, checksum, times and footprint
+    """
+    if auth is None:
+        auth = login.shared()
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    params = [
+            ('page_size', page_size),
+            ('sort_key', sort_key),
+            ('provider', provider),
+            ('ShortName', collection),
+            ('temporal', pa.get_temporal_range(
+                start_date_time, end_date_time, now)),
+        ]
+    box = None
+    if bbox is not None:
+        params.append(('bounding_box', bbox))
+        if prefilter:
+            box = footprint.parse_bbox(bbox)
+
+    search_after = None
+    npage = 0
+    while True:
+        headers = {} if search_after is None else \
+            {'CMR-Search-After': search_after}
+        response = _get_page(auth, params, headers)
+        items = response.json()['items']
+        npage += 1
+        if verbose:
+            print(f"CMR page {npage}: {len(items)} of "
+                  f"{response.headers.get('CMR-Hits')} granules")
+
+        for item in items:
+            granule = rs_granules.Granule.from_umm(item)
+            if granule is None or (box is not None and 
+                    not footprint.intersects(granule.footprint, box)):
+                continue
+            yield granule
+
+        search_after = response.headers.get('CMR-Search-After')
+        if search_after is None or len(items) == 0:
+            break
+
+
+def _get_page(auth:login.EarthdataLogin, params:list, headers:dict):
+    """ One page of a CMR search, retrying transient errors """
+    for attempt in range(transfer.max_retries+1):
+        try:
+            response = auth.get(cmr_search_url, params=params,
+                                headers=headers, timeout=transfer.timeout)
+            if response.status_code not in transfer.retry_status:
+                break
+        except (transfer.requests.ConnectionError, 
+                transfer.requests.Timeout):
+            if attempt == transfer.max_retries:
+                raise
+        time.sleep(transfer.backoff_time * 2**attempt)
+    response.raise_for_status()
+    return response
+
+
+def download_granules(granules,
+                      download_dir:str=None, 
+                      clobber:bool=False,
+                      verbose:bool=True,
+                      workers:int=transfer.max_workers,
+                      session=None,
+                      catalog=None,
+                      ordered:bool=False):
+    """ Download granules as they are listed, e.g. by iter_granules()
+
+    Existing files are kept if they match their checksum (see 
+    download_files()), unless clobber is set.  A file listed 
+    more than once is downloaded (and yielded) for its first listing.
+
+    Args:
+        granules (iterable): granules.Granule to download;
+            consumed lazily
+        download_dir (str, optional): Directory to download files to. 
+            Default is the podaac_path.  A sub-directory is created 
+            for each collection.
+        clobber (bool, optional): Overwrite existing files.
+        verbose (bool, optional): Print verbose output.
+        workers (int, optional): Number of concurrent downloads.
+        session (login.EarthdataLogin or requests.Session, optional):
+            Authenticated session to use.  Default is login.shared()
+        catalog (catalog.GranuleCatalog, optional): Record the
+            local files in this catalog
+        ordered (bool, optional): Yield the granules in the order 
+            listed (e.g. newest first), downloading a few ahead.
+            Closing the generator stops the downloads, so a consumer
+            can stop once it has what it needs
+
+    Yields:
+        tuple: (granule, local_file) as each download completes,
+            local_file being None if it failed
+    """
+    if session is None:
+        session = login.shared()
+    if isinstance(session, login.EarthdataLogin):
+        session.grow_pool(workers)
+    if download_dir is None:
+        download_dir = podaac_path
+    manifest = None if clobber else transfer.Manifest(
+        os.path.join(download_dir, transfer.manifest_file))
+
+    # Jobs, keeping the granule of each.  A file listed again
+    #  (e.g. re-processed, with a new concept id) is only downloaded 
+    #  for its first listing
+    by_path = {}
+    seen = set()
+    def files():
+        for granule in granules:
+            output_path = _granule_path(granule, download_dir)
+            if output_path in seen:
+                if verbose:
+                    print(f'Skipping {granule.concept_id}:  '
+                          f'{granule.filename} is already listed')
+                continue
+            seen.add(output_path)
+            by_path[output_path] = granule
+            yield granule.url, output_path, granule.checksum
+
+    try:
+        for job, error in transfer.fetch_stream(session, files(), 
+                workers=workers, progress=verbose, manifest=manifest,
+                ordered=ordered):
+            granule = by_path.pop(job[1])
+            if error is not None:
+                print(f'File failed to download: {granule.filename}. {error}')
+                yield granule, None
+            else:
+                if verbose:
+                    print(f'File ready: {job[1]}')
+                if catalog is not None:
+                    catalog.add_granule(granule, job[1])
+                yield granule, job[1]
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+
+def download_granule(granule:rs_granules.Granule,
+                     download_dir:str=None, 
+                     verbose:bool=False,
+                     session=None,
+                     manifest:transfer.Manifest=None,
+                     catalog=None):
+    """ Download a single granule, e.g. as a stage of a pipeline
+    (see operations.pipeline) with a thread per download
+
+    Args:
+        granule (granules.Granule): Granule to download
+        download_dir (str, optional): Directory to download files to. 
+            Default is the podaac_path, with a sub-directory 
+            for each collection.
+        verbose (bool, optional): Print verbose output.
+        session (login.EarthdataLogin or requests.Session, optional):
+            Authenticated session to use.  Default is login.shared()
+        manifest (transfer.Manifest, optional): Keep the existing file
+            if it matches its checksum, and record new checksums.
+            Shared by the threads;  save it once done
+        catalog (catalog.GranuleCatalog, optional): Record the
+            local file in this catalog
+
+    Returns:
+        str or None: Local file;  None if the download failed
+    """
+    if session is None:
+        session = login.shared()
+    if download_dir is None:
+        download_dir = podaac_path
+    output_path = _granule_path(granule, download_dir)
+    try:
+        transfer.fetch_job(session, 
+                           (granule.url, output_path, granule.checksum),
+                           manifest=manifest)
+    except Exception as e:
+        print(f'File failed to download: {granule.filename}. {e}')
+        return None
+    if verbose:
+        print(f'File ready: {output_path}')
+    if catalog is not None:
+        catalog.add_granule(granule, output_path)
+    return output_path
+
+
+def _granule_path(granule:rs_granules.Granule, download_dir:str):
+    """ Local file of a granule, in a sub-directory for its collection """
+    full_path = os.path.join(download_dir, granule.collection)
+    os.makedirs(full_path, exist_ok=True)
+    return os.path.join(full_path, granule.filename)
@@ -0,0 +1,427 @@
+""" Concurrent HTTP(S) file transfers.
+
+Files are fetched by a bounded pool of threads sharing one
+requests.Session, so connections are kept alive and re-used.
+Each file is streamed to a .part file next to its destination
+and renamed into place only once complete and verified, so a failed
+or interrupted transfer never leaves a partial file under the final
+name, and the next attempt resumes where it stopped.
+
+Checksums of local files are recorded in a Manifest, keyed by
+path, size and modification time, so a file is hashed only once.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tqdm.auto import tqdm
+
+# Defaults
+max_workers = 4
+max_retries = 3
+backoff_time = 1.     # s; doubled on each retry
+timeout = 60.         # s; to connect and between bytes
+chunk_size = 2**20    # bytes
+manifest_file = '.checksums.json'  # in the download directory
+
+# Worth another try
+retry_status = [429, 500, 502, 503, 504]
+
+
+def make_session(token:str=None, pool_size:int=max_workers):
+    """
+    Generate a requests.Session with a keep-alive connection pool
+
+    Args:
+        token (str, optional): Earthdata Login token, sent as a Bearer token
+        pool_size (int, optional): Connections kept per host;
+            at least the number of threads sharing the session
+
+    Returns:
+        requests.Session:
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if token is not None:
+        session.headers['Authorization'] = f'Bearer {token}'
+    return session
+
+
+class TransferError(IOError):
+    """ A download that ended short, or does not match its checksum """
+    pass
+
+
+def file_checksum(path:str, algorithm:str='MD5'):
+    """
+    Checksum of a file
+
+    Args:
+        path (str): File
+        algorithm (str, optional): e.g. MD5, SHA-256, as in CMR
+
+    Returns:
+        str: Hex digest
+    """
+    hash_alg = hashlib.new(algorithm.lower().replace('-', ''))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hash_alg.update(chunk)
+    return hash_alg.hexdigest()
+
+
+class Manifest(object):
+    """
+    Checksums of local files, saved as JSON
+
+    An entry is valid as long as the size and modification time 
+    of its file are unchanged.  Thread-safe.
+    """
+
+    def __init__(self, filename:str):
+        """
+        Args:
+            filename (str): JSON file;  loaded if it exists.
+                Paths are recorded relative to its directory
+        """
+        self.filename = filename
+        self.root = os.path.dirname(os.path.abspath(filename))
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'rt') as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print(f"Ignoring corrupt checksum manifest: {filename}")
+
+    def _key(self, path:str):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def get(self, path:str, algorithm:str):
+        """
+        Recorded checksum of a file, if still valid
+
+        Args:
+            path (str): File
+            algorithm (str): e.g. MD5
+
+        Returns:
+            str or None: Hex digest
+        """
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(self._key(path))
+        if entry is None or entry['size'] != stat.st_size or \
+                entry['mtime'] != stat.st_mtime_ns or \
+                entry['algorithm'] != algorithm:
+            return None
+        return entry['value']
+
+    def record(self, path:str, algorithm:str, value:str):
+        """
+        Record the checksum of a file, as it is now
+
+        Args:
+            path (str): File
+            algorithm (str): e.g. MD5
+            value (str): Hex digest
+        """
+        stat = os.stat(path)
+        with self.lock:
+            self.entries[self._key(path)] = dict(size=stat.st_size,
+                mtime=stat.st_mtime_ns, algorithm=algorithm, value=value)
+
+    def checksum(self, path:str, algorithm:str='MD5'):
+        """
+        Checksum of a file, hashed only if not recorded
+
+        Args:
+            path (str): File
+            algorithm (str, optional): e.g. MD5
+
+        Returns:
+            str: Hex digest
+        """
+        value = self.get(path, algorithm)
+        if value is None:
+            value = file_checksum(path, algorithm)
+            self.record(path, algorithm, value)
+        return value
+
+    def save(self):
+        """ Write the manifest (atomically) """
+        with self.lock:
+            entries = dict(self.entries)
+        tmp_file = f'{self.filename}.tmp'
+        with open(tmp_file, 'wt') as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, self.filename)
+
+
+def verify_files(paths:list, checksums:list, manifest:Manifest=None,
+                 workers:int=max_workers):
+    """
+    Check local files against their checksums, with a pool of threads
+    (hashlib releases the GIL, so the hashing runs in parallel)
+
+    Args:
+        paths (list): Local files
+        checksums (list): Expected checksum of each file, 
+            e.g. {'Value': 'd963...', 'Algorithm': 'MD5'}
+        manifest (Manifest, optional): Recorded checksums, 
+            updated with those computed
+        workers (int, optional): Number of threads
+
+    Returns:
+        list: True for each file that matches
+    """
+    def one(idx):
+        algorithm = checksums[idx]['Algorithm']
+        if manifest is None:
+            value = file_checksum(paths[idx], algorithm)
+        else:
+            value = manifest.checksum(paths[idx], algorithm)
+        return value == checksums[idx]['Value']
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(one, range(len(paths))))
+
+
+def _fetch_part(session:requests.Session, url:str, part_file:str,
+                progress:bool=False):
+    """ Fetch what is missing of a .part file, 
+    resuming with a Range request if some of it is on disk
+
+    Returns:
+        int: Number of bytes fetched
+    """
+    offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+    headers = {'Accept-Encoding': 'identity'}
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+
+    with session.get(url, stream=True, timeout=timeout,
+                     headers=headers) as response:
+        # Already have it all?
+        if response.status_code == 416:
+            total = response.headers.get('Content-Range', '').split('/')[-1]
+            if total.isdigit() and int(total) == offset:
+                return 0
+            os.remove(part_file)
+            raise TransferError(f"Bad partial download of {url}")
+        response.raise_for_status()
+
+        # Resume, or start over if the server ignored the Range
+        if response.status_code == 206:
+            total = response.headers['Content-Range'].split('/')[-1]
+            mode = 'ab'
+        else:
+            total = response.headers.get('Content-Length')
+            offset = 0
+            mode = 'wb'
+        total = int(total) if total is not None and total.isdigit() else None
+
+        nbytes = 0
+        with open(part_file, mode) as f, tqdm(
+                total=total, initial=offset,
+                unit='B', unit_scale=True, leave=False,
+                desc=os.path.basename(part_file)[:-5],
+                disable=not progress) as pbar:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                nbytes += len(chunk)
+                pbar.update(len(chunk))
+
+    if total is not None and os.path.getsize(part_file) != total:
+        raise TransferError(f"Incomplete download of {url}")
+    return nbytes
+
+
+def fetch_file(session:requests.Session, url:str, output_path:str,
+               retries:int=None, backoff:float=None,
+               progress:bool=False, checksum:dict=None):
+    """
+    Download a single file, resumably and atomically
+
+    The file is written to output_path + '.part', which is renamed 
+    only once it is complete:  of the expected size and, if given,
+    matching the checksum.  An interrupted download resumes from the 
+    .part file with an HTTP Range request, within this call 
+    (connection errors, time-outs and transient HTTP errors, 
+    see retry_status, are retried with exponential backoff)
+    or on a later one.  Other HTTP errors are raised.
+
+    Args:
+        session (requests.Session): Session to use (thread-safe for GETs)
+        url (str): URL of the file
+        output_path (str): Local file
+        retries (int, optional): Number of retries.
+            Default is max_retries
+        backoff (float, optional): Wait before the first retry (s).
+            Default is backoff_time
+        progress (bool, optional): Show a progress bar
+        checksum (dict, optional): Expected checksum, as from
+            CMR, e.g. {'Value': 'd963...', 'Algorithm': 'MD5'}
+
+    Returns:
+        int: Number of bytes downloaded by this call
+    """
+    if retries is None:
+        retries = max_retries
+    if backoff is None:
+        backoff = backoff_time
+
+    part_file = f'{output_path}.part'
+    nbytes = 0
+    for attempt in range(retries+1):
+        try:
+            nbytes += _fetch_part(session, url, part_file, progress=progress)
+            if checksum is not None and file_checksum(
+                    part_file, checksum['Algorithm']) != checksum['Value']:
+                # Start over
+                os.remove(part_file)
+                raise TransferError(f"Checksum mismatch for {url}")
+            os.replace(part_file, output_path)
+            return nbytes
+        except (requests.ConnectionError, requests.Timeout,
+                requests.HTTPError, requests.exceptions.ChunkedEncodingError,
+                TransferError) as e:
+            retry = not isinstance(e, requests.HTTPError) or \
+                e.response.status_code in retry_status
+            if not retry or attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def fetch_files(session:requests.Session, urls:list, output_paths:list,
+                workers:int=max_workers, progress:bool=False,
+                checksums:list=None, callback=None):
+    """
+    Download files with a pool of threads
+
+    Args:
+        session (requests.Session): Shared by all the threads
+        urls (list): URLs of the files
+        output_paths (list): Local files, aligned with urls
+        workers (int, optional): Number of threads
+        progress (bool, optional): Show a progress bar per file
+        checksums (list, optional): Expected checksum of each file
+            (or None);  see fetch_file()
+        callback (callable, optional): Called as callback(index, error)
+            as each file completes, with error None on success
+
+    Returns:
+        list: Exception raised for each file (None on success),
+            in the order of urls
+    """
+    errors = [None]*len(urls)
+
+    def one(idx):
+        try:
+            fetch_file(session, urls[idx], output_paths[idx],
+                       progress=progress, 
+                       checksum=None if checksums is None else checksums[idx])
+        except Exception as e:
+            errors[idx] = e
+        if callback is not None:
+            callback(idx, errors[idx])
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(one, range(len(urls))))
+
+    return errors
+
+
+def fetch_job(session:requests.Session, job:tuple, progress:bool=False,
+              manifest:Manifest=None):
+    """
+    Download one file of a stream, unless the manifest shows
+    it is already there
+
+    Args:
+        session (requests.Session): Session to download with
+        job (tuple): (url, output_path, checksum), checksum being
+            None or e.g. {'Value': 'd963...', 'Algorithm': 'MD5'}
+        progress (bool, optional): Show a progress bar
+        manifest (Manifest, optional): If given, an existing file is
+            kept if it matches its checksum (or has none), and 
+            the checksum of a new file is recorded in it
+    """
+    url, output_path, checksum = job
+    if manifest is not None and os.path.isfile(output_path):
+        if checksum is None or manifest.checksum(
+                output_path, checksum['Algorithm']) == checksum['Value']:
+            return
+    fetch_file(session, url, output_path, progress=progress,
+               checksum=checksum)
+    if manifest is not None and checksum is not None:
+        manifest.record(output_path, checksum['Algorithm'], 
+                        checksum['Value'])
+
+
+def fetch_stream(session:requests.Session, jobs, workers:int=max_workers,
+                 progress:bool=False, manifest:Manifest=None,
+                 ordered:bool=False):
+    """
+    Download files as they are listed, with a pool of threads
+
+    jobs is consumed lazily, keeping at most 2*workers files
+    queued, so downloads start before a long listing 
+    (e.g. a generator of CMR pages) is complete.  Closing the
+    generator early drops the files queued but not started.
+
+    Args:
+        session (requests.Session): Shared by all the threads
+        jobs (iterable): (url, output_path, checksum) of each file,
+            checksum being None or as for fetch_file()
+        workers (int, optional): Number of threads
+        progress (bool, optional): Show a progress bar per file
+        manifest (Manifest, optional): If given, existing files are
+            kept if they match their checksum (or have none), and 
+            the checksums of new files are recorded in it
+        ordered (bool, optional): Yield the files in the order of jobs
+            (those queued behind the first still download meanwhile)
+
+    Yields:
+        tuple: (job, error) as each file completes, error being
+            None on success
+    """
+    def one(job):
+        fetch_job(session, job, progress=progress, manifest=manifest)
+
+    jobs = iter(jobs)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        try:
+            while True:
+                # Top up the queue
+                while len(pending) < 2*max(1, workers):
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    pending[pool.submit(one, job)] = job
+                if len(pending) == 0:
+                    break
+                if ordered:
+                    # dicts keep the order of submission
+                    future = next(iter(pending))
+                    error = future.exception()
+                    yield pending.pop(future), error
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.exception()
+        finally:
+            # Stopped early:  drop what has not started
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,33 @@
+""" dtype policy for the data flowing through the pipeline.
+
+Data values (e.g. SST) and the maps built from them are held
+as value_dtype;  float32 resolves ~1e-5 K at SST, far below
+the noise of any product, and halves memory and bandwidth.
+Only running sums, where many samples pile up, use accum_dtype.
+
+To work in full precision throughout, set e.g.
+    from remote_sensing import dtypes
+    dtypes.value_dtype = np.float64
+"""
+
+import numpy as np
+
+# Data values and the maps (including counts) built from them
+value_dtype = np.float32
+# Running sums and sums of squares
+accum_dtype = np.float64
+
+
+def as_values(arr):
+    """
+    Cast to value_dtype, without a copy if already there
+
+    Parameters
+    ----------
+    arr : np.ndarray, dask.array.Array or xarray.DataArray
+
+    Returns
+    -------
+    Same type as arr
+    """
+    return arr.astype(value_dtype, copy=False)
@@ -0,0 +1,247 @@
+""" Streaming accumulation of many granules onto a HEALPix map. """
+
+import os
+
+import numpy as np
+import healpy
+import xarray
+
+from remote_sensing import dtypes
+from remote_sensing.healpix import utils as hp_utils
+from remote_sensing.healpix import rs_healpix
+
+
+class HealpixAccumulator(object):
+    """
+    Running sum, sum of squares and count in each HEALPix pixel.
+
+    Granules are added one at a time and never held, so memory
+    stays constant however many are combined.  Statistics are
+    weighted by the number of samples in each pixel.
+    """
+
+    def __init__(self, nside:int, sparse:bool=False):
+        """
+        Parameters
+        ----------
+        nside : int
+            HEALPix NSIDE parameter
+        sparse : bool, optional
+            Only hold the pixels that have received data
+        """
+        self.nside = nside
+        self.npix = healpy.nside2npix(nside)
+        self.sparse = sparse
+
+        size = 0 if sparse else self.npix
+        self.pixels = np.zeros(0, dtype=np.int64) if sparse else None
+        self.sum = np.zeros(size, dtype=dtypes.accum_dtype)
+        self.sumsq = np.zeros(size, dtype=dtypes.accum_dtype)
+        self.count = np.zeros(size, dtype=np.int64)
+
+        # Book-keeping
+        self.ngranules = 0
+        self.filenames = []
+        self.variable = None
+
+    def add_samples(self, pix:np.ndarray, vals:np.ndarray):
+        """
+        Add samples
+
+        Parameters
+        ----------
+        pix : np.ndarray of int
+            HEALPix pixel of each sample (all must be valid)
+        vals : np.ndarray
+            Value of each sample
+        """
+        vals = vals.astype(dtypes.accum_dtype)
+        if self.sparse:
+            upix, inverse = np.unique(pix, return_inverse=True)
+            self._add_sparse(upix,
+                np.bincount(inverse, minlength=upix.size),
+                np.bincount(inverse, weights=vals, minlength=upix.size),
+                np.bincount(inverse, weights=vals**2, minlength=upix.size))
+        else:
+            self.count += np.bincount(pix, minlength=self.npix)
+            self.sum += np.bincount(pix, weights=vals, minlength=self.npix)
+            self.sumsq += np.bincount(pix, weights=vals**2, minlength=self.npix)
+
+    def _add_sparse(self, pixels:np.ndarray, count:np.ndarray,
+                    sums:np.ndarray, sumsq:np.ndarray):
+        """ Add per-pixel totals for sorted, unique pixels """
+        if np.array_equal(pixels, self.pixels):
+            new_pixels = self.pixels
+            idx_old = idx_new = slice(None)
+        else:
+            new_pixels = np.union1d(self.pixels, pixels)
+            idx_old = np.searchsorted(new_pixels, self.pixels)
+            idx_new = np.searchsorted(new_pixels, pixels)
+
+        for attr, vals in zip(['count', 'sum', 'sumsq'], [count, sums, sumsq]):
+            arr = np.zeros(new_pixels.size, dtype=getattr(self, attr).dtype)
+            arr[idx_old] = getattr(self, attr)
+            arr[idx_new] += vals
+            setattr(self, attr, arr)
+        self.pixels = new_pixels
+
+    def add_dataarray(self, da:xarray.DataArray, filename:str=None,
+                      use_cache:bool=True):
+        """
+        Add the valid samples of a granule.
+        A large or dask-backed granule is binned block by block;
+        see healpix.utils.iter_blocks()
+
+        Parameters
+        ----------
+        da : xarray.DataArray
+        filename : str, optional
+            File the granule came from
+        use_cache : bool, optional
+            Use the pixel index cache for a 1D lat/lon grid
+            (not for a large or dask-backed one, binned in blocks)
+        """
+        # Only a single block is in memory at a time
+        use_cache = use_cache and not hp_utils.in_blocks(da)
+        for block in hp_utils.iter_blocks(da):
+            pix, vals, _ = hp_utils.da_to_pixels(block, nside=self.nside,
+                                                 use_cache=use_cache)
+            self.add_samples(pix, vals)
+
+        self.ngranules += 1
+        if filename is not None:
+            self.filenames.append(filename)
+        if self.variable is None:
+            self.variable = da.name
+
+    def add_rs_healpix(self, rsh):
+        """
+        Add a binned map, weighting each pixel by its counts.
+
+        Only the per-pixel means are known, so the spread
+        of the samples within a pixel of rsh is not captured by std().
+
+        Parameters
+        ----------
+        rsh : RS_Healpix
+            Must have counts
+        """
+        if rsh.nside != self.nside:
+            raise ValueError("RS_Healpix must have the same NSIDE")
+        if rsh.counts is None:
+            raise ValueError("RS_Healpix must have counts")
+        gd = ~np.ma.getmaskarray(rsh.hp)
+        pix = rsh.pixels[gd] if rsh.is_sparse else np.flatnonzero(gd)
+        count = np.ma.getdata(rsh.counts)[gd].astype(np.int64)
+        mean = np.ma.getdata(rsh.hp)[gd].astype(dtypes.accum_dtype)
+
+        if self.sparse:
+            self._add_sparse(pix, count, count*mean, count*mean**2)
+        else:
+            self.count[pix] += count
+            self.sum[pix] += count*mean
+            self.sumsq[pix] += count*mean**2
+
+        self.ngranules += 1
+        if rsh.filename is not None:
+            self.filenames.append(rsh.filename)
+        if self.variable is None:
+            self.variable = rsh.variable
+
+    def merge(self, other):
+        """
+        Add in another accumulator, e.g. from another process
+
+        Parameters
+        ----------
+        other : HealpixAccumulator
+
+        Returns
+        -------
+        HealpixAccumulator : self
+        """
+        if other.nside != self.nside:
+            raise ValueError("Accumulators must have the same NSIDE")
+        if self.sparse and other.sparse:
+            self._add_sparse(other.pixels, other.count, other.sum, other.sumsq)
+        elif self.sparse:
+            pix = np.flatnonzero(other.count)
+            self._add_sparse(pix, other.count[pix], other.sum[pix],
+                             other.sumsq[pix])
+        else:
+            pix = other.pixels if other.sparse else slice(None)
+            self.count[pix] += other.count
+            self.sum[pix] += other.sum
+            self.sumsq[pix] += other.sumsq
+
+        self.ngranules += other.ngranules
+        self.filenames += other.filenames
+        if self.variable is None:
+            self.variable = other.variable
+        return self
+
+    def _masked(self, values:np.ndarray):
+        """ Mask the pixels without data;  in the value dtype """
+        values = dtypes.as_values(values)
+        empty = self.count == 0
+        if self.sparse:
+            return np.ma.masked_array(values, mask=empty)
+        hpma = healpy.ma(values)
+        hpma.mask = empty
+        return hpma
+
+    def coverage(self):
+        """ Number of samples in each pixel """
+        return self._masked(self.count)
+
+    def mean(self):
+        """ Sample-weighted mean in each pixel """
+        return self._masked(self.sum / np.maximum(self.count, 1))
+
+    def std(self):
+        """ Standard deviation of the samples in each pixel """
+        n = np.maximum(self.count, 1)
+        var = self.sumsq / n - (self.sum / n)**2
+        return self._masked(np.sqrt(np.maximum(var, 0.)))
+
+    def to_rs_healpix(self, stat:str='mean'):
+        """
+        Generate an RS_Healpix of a statistic
+
+        Parameters
+        ----------
+        stat : str, optional
+            mean, std or count
+
+        Returns
+        -------
+        RS_Healpix
+            Sparse if the accumulator is
+        """
+        if stat == 'mean':
+            values = self.mean()
+        elif stat == 'std':
+            values = self.std()
+        elif stat == 'count':
+            values = self.coverage()
+        else:
+            raise ValueError(f"Bad statistic: {stat}")
+
+        rsh = rs_healpix.RS_Healpix(self.nside)
+        rsh.hp = values
+        rsh.counts = self.coverage()
+        if self.sparse:
+            rsh.pixels = self.pixels
+
+        if len(self.filenames) > 0:
+            rsh.filename = f'Acc[{os.path.basename(self.filenames[0])}-'\
+                f'{os.path.basename(self.filenames[-1])}]'
+        rsh.variable = self.variable
+
+        return rsh
+
+    def __repr__(self):
+        rstr = f'<HealpixAccumulator: nside={self.nside}, ngranules={self.ngranules}'
+        if self.sparse:
+            rstr = f'{rstr}, sparse npix={self.pixels.size}'
+        return f'{rstr}>'
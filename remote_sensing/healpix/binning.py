@@ -0,0 +1,180 @@
+""" Vectorized binning of samples onto HEALPix pixels. """
+
+import numpy as np
+
+from remote_sensing import dtypes
+
+
+def bincount_sums(pix:np.ndarray, vals:np.ndarray, npix:int):
+    """
+    Count and sum the samples falling in each HEALPix pixel
+    in a single vectorized pass.
+
+    Parameters
+    ----------
+    pix : np.ndarray of int
+        HEALPix pixel index of each sample (all must be valid, i.e. >= 0)
+    vals : np.ndarray
+        Value of each sample, aligned with pix
+    npix : int
+        Number of pixels in the map
+
+    Returns
+    -------
+    counts : np.ndarray of int
+        Number of samples in each pixel, length npix
+    sums : np.ndarray of float
+        Sum of the samples in each pixel, length npix
+    """
+    counts = np.bincount(pix, minlength=npix)
+    sums = np.bincount(pix, weights=vals, minlength=npix)
+
+    return counts, sums
+
+
+# Statistics available from the bincount pass alone
+bincount_stats = ['count', 'sum', 'mean']
+# Statistics requiring the sort-based grouped reductions
+sorted_stats = ['median', 'std', 'min', 'max']
+
+
+def parse_stat(stat:str):
+    """
+    Parse a statistic name.
+
+    Parameters
+    ----------
+    stat : str
+        One of count, sum, mean, median, std, min, max
+        or a percentile given as pNN, e.g. p10 or p97.5
+
+    Returns
+    -------
+    float or None
+        Percentile (0-100) if stat is a percentile (or median), else None
+    """
+    if stat == 'median':
+        return 50.
+    if stat in bincount_stats + sorted_stats:
+        return None
+    if stat.startswith('p'):
+        try:
+            q = float(stat[1:])
+        except ValueError:
+            q = -1.
+        if 0. <= q <= 100.:
+            return q
+    raise ValueError(f"Bad statistic: {stat}")
+
+
+def needs_sort(stats:list):
+    """ Return True if any of the statistics needs the sort-based path """
+    for stat in stats:
+        parse_stat(stat)
+    return any([stat not in bincount_stats for stat in stats])
+
+
+def grouped_stats(pix:np.ndarray, vals:np.ndarray, stats:list):
+    """
+    Calculate several statistics of the samples in each HEALPix pixel.
+
+    The samples are sorted once by (pixel, value) and every statistic
+    is then a vectorized reduction over the contiguous segment of each
+    pixel, so requesting many statistics costs about one sort.
+
+    Parameters
+    ----------
+    pix : np.ndarray of int
+        HEALPix pixel index of each sample (all must be valid, i.e. >= 0)
+    vals : np.ndarray
+        Value of each sample, aligned with pix
+    stats : list of str
+        Statistics to calculate; see parse_stat()
+
+    Returns
+    -------
+    upix : np.ndarray of int
+        Sorted pixels holding one or more samples
+    counts : np.ndarray of int
+        Number of samples in each of upix
+    results : dict
+        Statistic name -> np.ndarray aligned with upix
+    """
+    # Sort by pixel, then by value within each pixel
+    order = np.lexsort((vals, pix))
+    spix = pix[order]
+    svals = vals[order]
+
+    # Segments (pixels are >= 0)
+    starts = np.flatnonzero(np.diff(spix, prepend=-1))
+    upix = spix[starts]
+    counts = np.diff(np.append(starts, spix.size))
+
+    # Reductions
+    sums, means = None, None
+    results = {}
+    for stat in stats:
+        q = parse_stat(stat)
+        if stat == 'count':
+            results[stat] = counts
+        elif stat in ['sum', 'mean', 'std']:
+            if sums is None:
+                sums = np.add.reduceat(svals.astype(dtypes.accum_dtype), starts)
+                means = sums / counts
+            if stat == 'sum':
+                results[stat] = sums
+            elif stat == 'mean':
+                results[stat] = means
+            else:
+                dev2 = (svals - np.repeat(means, counts))**2
+                results[stat] = np.sqrt(np.add.reduceat(dev2, starts) / counts)
+        elif stat == 'min':
+            results[stat] = svals[starts]
+        elif stat == 'max':
+            results[stat] = svals[starts + counts - 1]
+        else:
+            # Percentile with linear interpolation, as in np.percentile
+            pos = (counts - 1) * q / 100.
+            lo = np.floor(pos).astype(int)
+            hi = np.minimum(lo + 1, counts - 1)
+            frac = pos - lo
+            v_lo = svals[starts + lo]
+            v_hi = svals[starts + hi]
+            results[stat] = v_lo + frac * (v_hi - v_lo)
+
+    return upix, counts, results
+
+
+def unique_sums(pix:np.ndarray, vals:np.ndarray, counts:np.ndarray=None):
+    """
+    Count and sum the samples in each occupied HEALPix pixel,
+    without allocating full-sky arrays.
+
+    Parameters
+    ----------
+    pix : np.ndarray of int
+        HEALPix pixel index of each sample (all must be valid, i.e. >= 0)
+    vals : np.ndarray
+        Value of each sample, aligned with pix
+    counts : np.ndarray of int, optional
+        Number of samples each entry stands for, e.g. when
+        combining partial sums.  Default is one each
+
+    Returns
+    -------
+    upix : np.ndarray of int
+        Sorted pixels holding one or more samples
+    counts : np.ndarray of int
+        Number of samples in each of upix
+    sums : np.ndarray of float
+        Sum of the samples in each of upix
+    """
+    upix, inverse = np.unique(pix, return_inverse=True)
+    sums = np.bincount(inverse, weights=vals, minlength=upix.size)
+    if counts is None:
+        counts = np.bincount(inverse, minlength=upix.size)
+    else:
+        counts = np.bincount(inverse, weights=counts,
+                             minlength=upix.size).astype(int)
+
+    return upix, counts, sums
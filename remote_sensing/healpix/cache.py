@@ -0,0 +1,254 @@
+""" Caches of HEALPix geometry, shared across maps and runs. """
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import healpy
+
+if os.getenv('OS_RS') is not None:
+    cache_path = os.path.join(os.getenv('OS_RS'), 'HEALPix', 'cache')
+else:
+    cache_path = None
+
+
+def grid_fingerprint(lats:np.ndarray, lons:np.ndarray):
+    """
+    Fingerprint a separable (1D) lat/lon grid.
+
+    Take it from the coordinates after any bbox cut so that
+    it identifies both the grid and the slice.
+
+    Parameters
+    ----------
+    lats : np.ndarray
+        1D latitudes (deg)
+    lons : np.ndarray
+        1D longitudes (deg)
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    sha = hashlib.sha1()
+    for coord in [lats, lons]:
+        coord = np.ascontiguousarray(coord, dtype=np.float64)
+        sha.update(str(coord.shape).encode())
+        sha.update(coord.tobytes())
+    return sha.hexdigest()
+
+
+def grid_pixels(lats:np.ndarray, lons:np.ndarray, nside:int):
+    """
+    HEALPix pixel of each cell of a separable (1D) lat/lon grid.
+
+    Parameters
+    ----------
+    lats : np.ndarray
+        1D latitudes (deg)
+    lons : np.ndarray
+        1D longitudes (deg)
+    nside : int
+        HEALPix NSIDE parameter
+
+    Returns
+    -------
+    np.ndarray of int
+        Pixel indices, shape (lats.size, lons.size);
+        -1 where a coordinate is not finite.
+        int32 when all the pixels of nside fit.
+    """
+    dtype = np.int32 if healpy.nside2npix(nside) < 2**31 else np.int64
+    idx = np.full((lats.size, lons.size), -1, dtype=dtype)
+
+    gd_lat = np.isfinite(lats)
+    gd_lon = np.isfinite(lons)
+    theta = (90 - lats[gd_lat]) * np.pi / 180.
+    phi = lons[gd_lon] * np.pi / 180.
+    idx[np.ix_(gd_lat, gd_lon)] = healpy.pixelfunc.ang2pix(
+        nside, theta[:, None], phi[None, :])
+
+    return idx
+
+
+class PixelIndexCache(object):
+    """
+    Cache of the grid -> HEALPix pixel index mapping
+    for fixed-grid (e.g. L3C, L4) products.
+
+    Entries are keyed by grid fingerprint and nside, held in memory
+    with LRU eviction and, if a cache directory is set, persisted
+    as .npy files that are re-opened memory-mapped.
+    """
+
+    def __init__(self, maxsize:int=4, cache_dir:str=None):
+        """
+        Parameters
+        ----------
+        maxsize : int, optional
+            Maximum number of grids held in memory
+        cache_dir : str, optional
+            Directory for the .npy files.  If None, memory only
+        """
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def filename(self, key:str):
+        """ Return the .npy file for a key """
+        return os.path.join(self.cache_dir, f'pix_{key}.npy')
+
+    def get(self, lats:np.ndarray, lons:np.ndarray, nside:int):
+        """
+        Return the pixel indices of a 1D lat/lon grid,
+        computing them only if not yet cached.
+
+        Parameters
+        ----------
+        lats : np.ndarray
+            1D latitudes (deg)
+        lons : np.ndarray
+            1D longitudes (deg)
+        nside : int
+            HEALPix NSIDE parameter
+
+        Returns
+        -------
+        np.ndarray of int
+            Read-only, shape (lats.size, lons.size); see grid_pixels()
+        """
+        key = f'{grid_fingerprint(lats, lons)}_{nside}'
+
+        # Memory
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        # Disk
+        idx = None
+        if self.cache_dir is not None and os.path.isfile(self.filename(key)):
+            idx = np.load(self.filename(key), mmap_mode='r')
+
+        # Compute
+        if idx is None:
+            idx = grid_pixels(lats, lons, nside)
+            if self.cache_dir is not None:
+                self._save(key, idx)
+                idx = np.load(self.filename(key), mmap_mode='r')
+            else:
+                idx.flags.writeable = False
+
+        # Add, and evict the least recently used
+        self._entries[key] = idx
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        return idx
+
+    def _save(self, key:str, idx:np.ndarray):
+        """ Write atomically, as other processes may be reading """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = f'{self.filename(key)}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.save(f, idx)
+        os.replace(tmp_file, self.filename(key))
+
+    def clear(self):
+        """ Empty the in-memory cache (files on disk are kept) """
+        self._entries.clear()
+
+
+class GeometryCache(object):
+    """
+    Cache of the pixel-center longitudes and latitudes 
+    of full-sky HEALPix maps, keyed by (nside, ordering).
+
+    The arrays are read-only and shared by every map of that nside.
+    The total size held is bounded, evicting the least recently used.
+    """
+
+    def __init__(self, max_bytes:int=2**31):
+        """
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Maximum number of bytes of coordinates held
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """ Bytes currently held """
+        return int(np.sum([lons.nbytes + lats.nbytes 
+                           for lons, lats in self._entries.values()]))
+
+    def lons_lats(self, nside:int, pixels:np.ndarray=None, 
+                  nest:bool=False):
+        """
+        Return the longitudes and latitudes of pixel centers.
+
+        Parameters
+        ----------
+        nside : int
+            HEALPix NSIDE parameter
+        pixels : np.ndarray, optional
+            Pixel indices.  If None, all pixels of the sphere
+            (cached).  Otherwise only these are calculated,
+            unless the full sphere is already cached.
+        nest : bool, optional
+            NESTED ordering if True, else RING
+
+        Returns
+        -------
+        lons, lats : np.ndarray, np.ndarray
+            Degrees
+        """
+        key = (nside, 'nest' if nest else 'ring')
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                lons, lats = self._entries[key]
+                if pixels is None:
+                    return lons, lats
+                return lons[pixels], lats[pixels]
+
+        # Only a subset?
+        if pixels is not None:
+            return healpy.pixelfunc.pix2ang(nside, pixels, nest=nest, lonlat=True)
+
+        # Full sphere
+        lons, lats = healpy.pixelfunc.pix2ang(
+            nside, np.arange(healpy.nside2npix(nside)), nest=nest, lonlat=True)
+        lons.flags.writeable = False
+        lats.flags.writeable = False
+
+        # Add, and evict the least recently used
+        if lons.nbytes + lats.nbytes <= self.max_bytes:
+            with self._lock:
+                self._entries[key] = (lons, lats)
+                while self.nbytes > self.max_bytes:
+                    self._entries.popitem(last=False)
+
+        return lons, lats
+
+    def clear(self):
+        """ Empty the cache """
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all maps in the process
+pixel_cache = PixelIndexCache(cache_dir=cache_path)
+geometry_cache = GeometryCache()
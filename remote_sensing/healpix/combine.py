@@ -4,6 +4,8 @@
 import numpy as np
 import numpy.ma as ma
 
+from remote_sensing import dtypes
+
 def average_masked_arrays(arrs:list):
     """
     Average a list of masked arrays, using values that exist in either array.
@@ -20,10 +22,10 @@ def average_masked_arrays(arrs:list):
         Averaged array, preserving values that exist in at least one input
     """
     # Count valid (non-masked) values at each position
-    valid_count = np.zeros(arrs[0].size)
-    summed = valid_count.copy()
+    valid_count = np.zeros(arrs[0].size, dtype=int)
+    summed = np.zeros(arrs[0].size, dtype=dtypes.accum_dtype)
     for arr in arrs:
-        valid_count += (1-arr.mask.astype(int))
+        valid_count += ~ma.getmaskarray(arr)
         # Sum the arrays, treating masked values as 0
         summed += arr.filled(0)
     
@@ -32,6 +34,43 @@ def average_masked_arrays(arrs:list):
     
     # Divide by count of valid values (1 or 2) to get average
     # Note: divide by 1 where only one value exists
-    result = ma.array(summed / np.maximum(valid_count, 1), mask=final_mask)
+    result = ma.array(dtypes.as_values(summed / np.maximum(valid_count, 1)), 
+                      mask=final_mask)
     
-    return result
\ No newline at end of file
+    return result
+
+def average_sparse(pixels:list, arrs:list):
+    """
+    Average a list of sparse healpix maps, using values that exist in any map.
+    As for average_masked_arrays(), each map has an equal vote.
+
+    Parameters:
+    -----------
+    pixels : list of np.ndarray
+        Sorted pixel indices of each map
+    arrs : list of numpy.ma.MaskedArray
+        Values of each map, aligned with pixels
+        
+    Returns:
+    --------
+    np.ndarray
+        Sorted pixel indices of the average
+    numpy.ma.MaskedArray
+        Averaged values, aligned with the pixel indices
+    """
+    # Unmasked entries of all the maps
+    all_pix = np.concatenate([pix[~ma.getmaskarray(arr)] 
+                              for pix, arr in zip(pixels, arrs)])
+    all_vals = np.concatenate([arr.compressed() for arr in arrs])
+
+    # Sum and count in one pass;  the sums in accum_dtype
+    upix, inverse = np.unique(all_pix, return_inverse=True)
+    valid_count = np.bincount(inverse, minlength=upix.size)
+    summed = np.bincount(inverse, weights=all_vals.astype(dtypes.accum_dtype),
+                         minlength=upix.size).astype(dtypes.accum_dtype, 
+                                                     copy=False)
+
+    result = ma.array(dtypes.as_values(summed / valid_count), 
+                      mask=np.zeros(upix.size, dtype=bool))
+
+    return upix, result
@@ -0,0 +1,211 @@
+""" Ingest many granules onto a HEALPix map, optionally in parallel. """
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import xarray
+
+from remote_sensing.healpix import utils as hp_utils
+from remote_sensing.healpix import rs_healpix
+from remote_sensing.healpix.accumulate import HealpixAccumulator
+
+
+def ingest_file(filename:str, variable:str, nside:int=None,
+                sparse:bool=True, **kwargs):
+    """
+    Load, quality control and bin a single granule.
+
+    This is the unit of work of a worker process;  only the
+    compact accumulator (not the granule) is sent back.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the dataset file
+    variable : str
+        Variable to extract
+    nside : int, optional
+        HEALPix NSIDE parameter.  If None, set by the data
+    sparse : bool, optional
+        Only hold the pixels that have received data
+    **kwargs
+        Passed to rs_healpix.load_dataarray(),
+        e.g. lat_slice, lon_slice, time_isel, resol_km
+
+    Returns
+    -------
+    HealpixAccumulator
+    """
+    da, da_nside = rs_healpix.load_dataarray(filename, variable, **kwargs)
+    return _bin(da, da_nside, filename, variable, nside=nside, sparse=sparse)
+
+
+def _bin(da:xarray.DataArray, da_nside:int, filename:str, variable:str,
+         nside:int=None, sparse:bool=True):
+    """ Bin a loaded granule onto a new accumulator """
+    if nside is None:
+        nside = da_nside
+    if nside is None:
+        nside, _ = hp_utils.get_nside_from_dataset(da)
+
+    acc = HealpixAccumulator(nside, sparse=sparse)
+    acc.add_dataarray(da, filename=filename)
+    acc.variable = variable
+    return acc
+
+
+def coverage(da:xarray.DataArray):
+    """
+    Fraction of a loaded granule with good data
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+        As from rs_healpix.load_dataarray():  cut to the box
+        and quality controlled (bad values are NaN)
+
+    Returns
+    -------
+    float
+        Good values over those in the box
+        (cells of a swath outside the box have NaN lat)
+    """
+    good = np.isfinite(da.values)
+    if da.lat.ndim == 2:
+        in_box = np.broadcast_to(np.isfinite(da.lat.values), good.shape)
+        ntotal = np.sum(in_box)
+        ngood = np.sum(good & in_box)
+    else:
+        ntotal = good.size
+        ngood = np.sum(good)
+    return float(ngood / ntotal) if ntotal > 0 else 0.
+
+
+def ingest_files(files:list, variable:str, workers:int=1,
+                 nside:int=None, sparse:bool=True,
+                 verbose:bool=False, **kwargs):
+    """
+    Bin a list of granules onto a single HEALPix accumulator.
+
+    With workers > 1 the granules are read and binned in a pool
+    of processes and merged as they complete, so only
+    one granule per worker is in memory at a time.
+
+    Parameters
+    ----------
+    files : list of str
+        Filenames of the dataset files
+    variable : str
+        Variable to extract
+    workers : int, optional
+        Number of processes.  1 = serial, in this process
+    nside : int, optional
+        HEALPix NSIDE parameter.  If None, set by the data,
+        which must then give the same value for every granule
+    sparse : bool, optional
+        Only hold the pixels that have received data
+    verbose : bool, optional
+        Print a line per granule
+    **kwargs
+        Passed to rs_healpix.load_dataarray(),
+        e.g. lat_slice, lon_slice, time_isel, resol_km
+
+    Returns
+    -------
+    HealpixAccumulator
+        Its filenames are in the order of files
+    """
+    if len(files) == 0:
+        raise ValueError("No files to ingest")
+
+    total = None
+    def add(acc):
+        nonlocal total
+        total = acc if total is None else total.merge(acc)
+        if verbose:
+            print(f"Ingested {acc.filenames[0]}")
+
+    if workers <= 1:
+        for filename in files:
+            add(ingest_file(filename, variable, nside=nside,
+                            sparse=sparse, **kwargs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(ingest_file, filename, variable,
+                                   nside=nside, sparse=sparse, **kwargs)
+                       for filename in files]
+            for future in as_completed(futures):
+                add(future.result())
+
+    # Restore the input order
+    total.filenames = [filename for filename in files
+                       if filename in total.filenames]
+    return total
+
+
+def ingest_usable(files, variable:str, nfiles:int,
+                  min_coverage:float=0., nside:int=None,
+                  sparse:bool=True, verbose:bool=False, **kwargs):
+    """
+    Bin granules in the order given (e.g. newest first) until
+    nfiles of them are usable:  with at least min_coverage
+    of good data in the box, after quality control.
+
+    files is consumed lazily, and closed once enough granules
+    are binned, e.g. to stop the downloads of 
+    podaac.download_granules(..., ordered=True).
+
+    Parameters
+    ----------
+    files : iterable of str
+        Filenames of the dataset files;  None entries 
+        (e.g. failed downloads) are skipped
+    variable : str
+        Variable to extract
+    nfiles : int
+        Number of usable granules wanted
+    min_coverage : float, optional
+        Least fraction of good data in the box;  see coverage()
+    nside : int, optional
+        HEALPix NSIDE parameter.  If None, set by the data
+    sparse : bool, optional
+        Only hold the pixels that have received data
+    verbose : bool, optional
+        Print a line per granule
+    **kwargs
+        Passed to rs_healpix.load_dataarray(),
+        e.g. lat_slice, lon_slice, time_isel, resol_km
+
+    Returns
+    -------
+    HealpixAccumulator or None
+        Its filenames are those used, in the order given.
+        None if no granule was usable
+    """
+    total = None
+    files = iter(files)
+    try:
+        for filename in files:
+            if filename is None:
+                continue
+            da, da_nside = rs_healpix.load_dataarray(filename, variable, 
+                                                     **kwargs)
+            fraction = coverage(da)
+            if fraction < min_coverage or fraction == 0.:
+                if verbose:
+                    print(f"Skipping {filename}:  coverage {fraction:.2f}")
+                continue
+            acc = _bin(da, da_nside, filename, variable, nside=nside, 
+                       sparse=sparse)
+            total = acc if total is None else total.merge(acc)
+            if verbose:
+                print(f"Ingested {filename}:  coverage {fraction:.2f}")
+            if total.ngranules >= nfiles:
+                break
+    finally:
+        if hasattr(files, 'close'):
+            files.close()
+
+    if total is not None and total.ngranules < nfiles:
+        print(f"Only {total.ngranules} of {nfiles} usable granules")
+    return total
@@ -0,0 +1,183 @@
+""" Region queries on HEALPix maps.
+
+Candidate pixels come from the native HEALPix queries
+(query_polygon, query_strip, query_disc), so the cost scales
+with the area of the region rather than the whole sphere.
+
+Boxes are of the form (lon_min, lon_max, lat_min, lat_max) in deg.
+A box with lon_min > lon_max crosses the dateline,
+e.g. (170, -170, ...) or (170, 190, ...)
+"""
+
+import numpy as np
+import healpy
+
+from remote_sensing.healpix import cache as hp_cache
+
+# Largest longitude span of a single query polygon (deg);
+#  must stay well below 180 for the polygon to be convex
+max_poly_dlon = 90.
+# Use a latitude strip instead of a polygon beyond this |lat| (deg)
+polar_lat = 89.
+
+
+def lon_range(box:tuple):
+    """
+    Normalize the longitudes of a box
+
+    Args:
+        box (tuple): (lon_min, lon_max, lat_min, lat_max)
+
+    Returns:
+        tuple: lon_min in [0, 360) and the width in longitude (deg),
+            eastward from lon_min, whatever the convention of each
+            longitude (e.g. (359, -170) is 191 deg wide).
+            360 or more for the full circle
+    """
+    width = box[1] - box[0]
+    if box[0] == box[1]:
+        width = 360.
+    elif width < 360.:
+        width = width % 360.
+    return box[0] % 360., width
+
+
+def in_box(lons:np.ndarray, lats:np.ndarray, box:tuple,
+           closed:bool=False):
+    """
+    Which points lie in a box?  Handles the dateline.
+
+    Args:
+        lons (np.ndarray): longitudes (deg)
+        lats (np.ndarray): latitudes (deg)
+        box (tuple): (lon_min, lon_max, lat_min, lat_max)
+        closed (bool, optional): include points on the edges
+
+    Returns:
+        np.ndarray: bool, True = in the box.  NaN coordinates are not.
+    """
+    lon0, width = lon_range(box)
+    dlon = (lons - lon0) % 360.
+    if closed:
+        gd_lats = (lats >= box[2]) & (lats <= box[3])
+        gd_lons = (dlon <= width) | (width >= 360.)
+    else:
+        gd_lats = (lats > box[2]) & (lats < box[3])
+        gd_lons = ((dlon > 0.) & (dlon < width)) | (width >= 360.)
+    return gd_lats & gd_lons
+
+
+def _edge_lat(lat:float, dlon:float, poleward:bool):
+    """ Latitude of the two corners of a great-circle edge
+    that stays on the outside of the parallel lat over dlon.
+
+    A great circle through two points on a parallel bulges
+    toward the nearer pole, tan(lat_mid) = tan(lat) / cos(dlon/2).
+    """
+    if poleward == (lat >= 0.):
+        # Bulges outward already
+        return lat
+    return np.rad2deg(np.arctan(np.tan(np.deg2rad(lat))
+                                * np.cos(np.deg2rad(dlon/2.))))
+
+
+def candidate_pixels(nside:int, box:tuple, nest:bool=False):
+    """
+    Pixels that may have their center in a box:
+    a superset from query_polygon or query_strip.
+
+    Args:
+        nside (int): HEALPix NSIDE parameter
+        box (tuple): (lon_min, lon_max, lat_min, lat_max)
+        nest (bool, optional): NESTED ordering if True, else RING
+
+    Returns:
+        np.ndarray: sorted pixel indices
+    """
+    lat_min, lat_max = max(box[2], -90.), min(box[3], 90.)
+    if lat_min >= lat_max:
+        return np.zeros(0, dtype=np.int64)
+    lon0, width = lon_range(box)
+
+    # Polar caps or the full circle:  latitude strip
+    if width >= 360. or lat_max > polar_lat or lat_min < -polar_lat:
+        theta1 = np.deg2rad(90. - lat_max)
+        theta2 = np.deg2rad(90. - lat_min)
+        return np.sort(healpy.query_strip(nside, theta1, theta2,
+                                          inclusive=True, nest=nest))
+
+    # Convex polygons, each at most max_poly_dlon wide
+    nchunk = int(np.ceil(width / max_poly_dlon))
+    edges = lon0 + np.linspace(0., width, nchunk+1)
+    dlon = width / nchunk
+    south = _edge_lat(lat_min, dlon, poleward=False)
+    north = _edge_lat(lat_max, dlon, poleward=True)
+    cands = []
+    for lon_a, lon_b in zip(edges[:-1], edges[1:]):
+        vertices = healpy.ang2vec(np.array([lon_a, lon_b, lon_b, lon_a]),
+                                  np.array([south, south, north, north]),
+                                  lonlat=True)
+        cands.append(healpy.query_polygon(nside, vertices,
+                                          inclusive=True, nest=nest))
+    return np.unique(np.concatenate(cands))
+
+
+def pixels_in_box(nside:int, box:tuple, nest:bool=False):
+    """
+    Find the pixels with their center in a box.
+
+    Args:
+        nside (int): HEALPix NSIDE parameter
+        box (tuple): (lon_min, lon_max, lat_min, lat_max)
+        nest (bool, optional): NESTED ordering if True, else RING
+
+    Returns:
+        np.ndarray: sorted pixel indices
+    """
+    cand = candidate_pixels(nside, box, nest=nest)
+    lons, lats = hp_cache.geometry_cache.lons_lats(nside, cand, nest=nest)
+    return cand[in_box(lons, lats, box)]
+
+
+def pixels_in_disc(nside:int, lon:float, lat:float, radius:float,
+                   inclusive:bool=False, nest:bool=False):
+    """
+    Find the pixels in a disc.
+
+    Args:
+        nside (int): HEALPix NSIDE parameter
+        lon (float): longitude of the center (deg)
+        lat (float): latitude of the center (deg)
+        radius (float): radius of the disc (deg)
+        inclusive (bool, optional): include all pixels overlapping
+            the disc, not only those with their center in it
+        nest (bool, optional): NESTED ordering if True, else RING
+
+    Returns:
+        np.ndarray: sorted pixel indices
+    """
+    vec = healpy.ang2vec(lon, lat, lonlat=True)
+    return np.sort(healpy.query_disc(nside, vec, np.deg2rad(radius),
+                                     inclusive=inclusive, nest=nest))
+
+
+def window(in_region:np.ndarray):
+    """
+    Smallest window of an array holding all the points in a region,
+    e.g. the rows and columns of a swath that overlap a box.
+
+    Args:
+        in_region (np.ndarray): bool, True = in the region
+
+    Returns:
+        tuple: a slice per dimension;  of zero size if
+            no point is in the region
+    """
+    slices = []
+    for axis in range(in_region.ndim):
+        other = tuple(ax for ax in range(in_region.ndim) if ax != axis)
+        idx = np.flatnonzero(np.any(in_region, axis=other))
+        if idx.size == 0:
+            return tuple(slice(0, 0) for _ in range(in_region.ndim))
+        slices.append(slice(idx[0], idx[-1]+1))
+    return tuple(slices)
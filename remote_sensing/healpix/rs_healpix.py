@@ -11,12 +11,112 @@ import xarray
 from remote_sensing.healpix import utils as hp_utils 
 from remote_sensing.plotting import globe
 from remote_sensing.healpix import combine as hp_combine
+from remote_sensing.healpix import cache as hp_cache
+from remote_sensing.healpix import regions as hp_regions
+from remote_sensing.healpix import accumulate as hp_accumulate
 from remote_sensing import units
+from remote_sensing import dtypes
 from remote_sensing.netcdf import utils as nc_utils
 
 
 from IPython import embed
 
+def load_dataarray(filename:str, variable:str, 
+                   lat_slice:slice=None, 
+                   lon_slice:slice=None,
+                   time_isel:int=None,
+                   resol_km:float=None,
+                   chunks:dict=None):
+    """
+    Load a variable from a dataset file, ready for binning:
+    cut to the bounding box, quality controlled and, 
+    for SST, in Celsius.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the dataset file
+    variable : str
+        Variable to extract from the dataarray
+    lat_slice : slice, optional
+        Slice to apply to the latitude dimension
+        For 2D lat/lon, a tuple (lat_min, lat_max)
+    lon_slice : slice, optional
+        Slice to apply to the longitude dimension
+        For 2D lat/lon, a tuple (lon_min, lon_max);
+        lon_min > lon_max crosses the dateline
+    time_isel : int, optional
+        Time index
+    resol_km : float, optional
+        Resolution for binning; required for 2D lat/lon
+    chunks : dict or str, optional
+        Open the file lazily with these dask chunks,
+        e.g. dict(lat=2000, lon=2000) or 'auto'.
+        Quality control and units are then applied
+        chunk by chunk when the data are computed
+
+    Returns
+    -------
+    da : xarray.DataArray
+        dask-backed if chunks is set
+    nside : int or None
+        None if it is to be set from the data
+    """
+    nside = None
+    ds = xarray.open_dataset(filename, chunks=chunks)
+    if ds.lat.ndim == 1:
+        if lat_slice is not None:
+            ds = ds.sel(lat=lat_slice)
+        if lon_slice is not None:
+            ds = ds.sel(lon=lon_slice)
+    if ds.lat.ndim == 2:
+        # Only the coordinates are read here
+        lats = np.array(ds.lat.values)
+        lons = np.array(ds.lon.values)
+
+        # Deal with junk
+        lats[lats < -1000.] = np.nan
+        lons[lons < -1000.] = np.nan
+
+        # Crop to the rows/columns overlapping the box, 
+        #  before any data variable is read, and cut the rest with NaNs
+        if lat_slice is not None or lon_slice is not None:
+            bbox = tuple(lon_slice if lon_slice is not None else (0., 360.)) \
+                + tuple(lat_slice if lat_slice is not None else (-90., 90.))
+            in_bbox = hp_regions.in_box(lons, lats, bbox, closed=True)
+            win = hp_regions.window(in_bbox)
+            ds = ds.isel(dict(zip(ds.lat.dims, win)))
+            lats, lons = lats[win], lons[win]
+            lats[~in_bbox[win]] = np.nan
+        ds = ds.assign_coords(lat=(ds.lat.dims, lats, ds.lat.attrs),
+                              lon=(ds.lon.dims, lons, ds.lon.attrs))
+        # nside 
+        if resol_km is None:
+            raise ValueError("Must provide resol_km for 2D lat/lon arrays")
+        # Translate to deg
+        delta_lat = resol_km / 111.1
+        nside, _ = hp_utils.get_nside_from_angular_size(delta_lat)
+    
+    # Time slice
+    if time_isel is not None:
+        ds = ds.isel(time=time_isel)
+
+    # Quality control
+    da = dtypes.as_values(ds[variable])
+    junk = nc_utils.gen_mask_for_dataset(ds, variable)
+    if junk is not None:
+        if da.chunks is None:
+            da.data[junk] = np.nan
+        else:
+            da = da.where(~junk)
+
+    # If SST, convert to Celsius
+    if da.units in ['K', 'kelvin', 'Kelvin']:
+        da = units.kelvin_to_celsius(da)
+
+    return da, nside
+
+
 class RS_Healpix(object):
 
     def __init__(self, nside:int):
@@ -33,15 +133,24 @@ class RS_Healpix(object):
         self.hp = None
         self.counts = None
 
+        # Sparse?  If set, the pixel indices 
+        #  of the entries in hp and counts
+        self.pixels = None
+
         # File?
         self.filename = None
         self.variable = None
     
+    @property
+    def is_sparse(self):
+        """ Is the map stored sparsely? """
+        return self.pixels is not None
+
     @property
     def lons_lats(self):
-        """ Return the lats and lons. """
-        return healpy.pixelfunc.pix2ang(
-            self.nside, np.arange(self.npix), lonlat=True)
+        """ Return the lats and lons. 
+        Only of the stored pixels if the map is sparse. """
+        return hp_cache.geometry_cache.lons_lats(self.nside, self.pixels)
 
     @property
     def lats(self):
@@ -91,12 +200,16 @@ class RS_Healpix(object):
             if rs.nside != nside:
                 raise ValueError("All RS_Healpix objects must have the same NSIDE")
                 
-        # Average
-        hp_values = hp_combine.average_masked_arrays([rs.hp for rs in rs_list])
-
         # Instantiate
         rsh = RS_Healpix(nside)
-        rsh.hp = hp_values
+
+        # Average
+        if np.any([rs.is_sparse for rs in rs_list]):
+            rs_list = [rs.to_sparse() for rs in rs_list]
+            rsh.pixels, rsh.hp = hp_combine.average_sparse(
+                [rs.pixels for rs in rs_list], [rs.hp for rs in rs_list])
+        else:
+            rsh.hp = hp_combine.average_masked_arrays([rs.hp for rs in rs_list])
 
         # A bit more
         if rs_list[0].filename is not None:
@@ -113,6 +226,9 @@ class RS_Healpix(object):
                             lon_slice:slice=None,
                             time_isel:int=None,
                             resol_km:float=None,
+                            stat:str='mean',
+                            sparse:bool=False,
+                            chunks:dict=None,
                             debug:bool=False):
         """
         Initialize the RS_Healpix object from a dataarray file.
@@ -125,58 +241,41 @@ class RS_Healpix(object):
             Variable to extract from the dataarray
         lat_slice : slice, optional
             Slice to apply to the latitude dimension
+            For 2D lat/lon, a tuple (lat_min, lat_max)
         lon_slice : slice, optional
             Slice to apply to the longitude dimension
+            For 2D lat/lon, a tuple (lon_min, lon_max);
+            lon_min > lon_max crosses the dateline
+        stat : str, optional
+            Statistic to calculate in each pixel; see da_to_healpix()
+        sparse : bool, optional
+            Store only the pixels holding data
+        chunks : dict or str, optional
+            Read, quality control and bin the data one dask chunk
+            at a time, so that memory stays bounded for files
+            larger than RAM;  see load_dataarray().
+            Only the mean, std and count statistics are available
 
         Returns
         -------
         RS_Healpix
 
         """
-        nside = None
-        ds = xarray.open_dataset(filename)
-        if ds.lat.ndim == 1:
-            if lat_slice is not None:
-                ds = ds.sel(lat=lat_slice)
-            if lon_slice is not None:
-                ds = ds.sel(lon=lon_slice)
-        if ds.lat.ndim == 2:
-            # Deal with junk
-            junk = ds.lat < -1000.
-            ds.lat.data[junk] = np.nan
-            #
-            junk = ds.lon < -1000.
-            ds.lon.data[junk] = np.nan
-
-            # Cut with NaNs
-            if lat_slice is not None:
-                junk = (ds.lat < lat_slice[0]) | (ds.lat > lat_slice[1])
-                ds.lat.data[junk] = np.nan
-            if lon_slice is not None:
-                junk = (ds.lon < lon_slice[0]) | (ds.lon > lon_slice[1])
-                ds.lon.data[junk] = np.nan
-            # nside 
-            if resol_km is None:
-                raise ValueError("Must provide resol_km for 2D lat/lon arrays")
-            # Translate to deg
-            delta_lat = resol_km / 111.1
-            nside, _ = hp_utils.get_nside_from_angular_size(delta_lat)
-        
-        # Time slice
-        if time_isel is not None:
-            ds = ds.isel(time=time_isel)
-
-        # Quality control
-        da = ds[variable]
-        junk = nc_utils.gen_mask_for_dataset(ds, variable)
-        if junk is not None:
-            da.data[junk] = np.nan
+        da, nside = load_dataarray(filename, variable,
+            lat_slice=lat_slice, lon_slice=lon_slice,
+            time_isel=time_isel, resol_km=resol_km, chunks=chunks)
 
         # Instantiate
-        # If SST, convert to Celsius
-        if da.units in ['K', 'kelvin', 'Kelvin']:
-            da = units.kelvin_to_celsius(da)
-        rsh =  cls.from_dataarray(da, nside=nside)
+        if chunks is None:
+            rsh =  cls.from_dataarray(da, nside=nside, stat=stat, sparse=sparse)
+        else:
+            if stat not in ['mean', 'std', 'count']:
+                raise ValueError(f"Statistic {stat} is not available with chunks")
+            if nside is None:
+                nside, _ = hp_utils.get_nside_from_dataset(da)
+            acc = hp_accumulate.HealpixAccumulator(nside, sparse=sparse)
+            acc.add_dataarray(da)
+            rsh = acc.to_rs_healpix(stat)
 
         # Fill in
         rsh.filename = filename
@@ -188,7 +287,8 @@ class RS_Healpix(object):
         
     @classmethod
     def from_dataarray(cls, da:xarray.DataArray,
-                       nside:int=None):
+                       nside:int=None, stat:str='mean',
+                       sparse:bool=False):
         """
         Initialize the RS_Healpix object from an xarray dataset.
 
@@ -197,6 +297,11 @@ class RS_Healpix(object):
         da : xarray.DataArray
             Dataset containing the HEALPix data
         nside : int, optional
+        stat : str, optional
+            Statistic to calculate in each pixel; see da_to_healpix().
+            A single one:  the map holds one value per pixel
+        sparse : bool, optional
+            Store only the pixels holding data
 
         Returns
         -------
@@ -204,10 +309,22 @@ class RS_Healpix(object):
 
         """
         reload(hp_utils)
-
+        if not isinstance(stat, str):
+            raise ValueError("stat must be a single statistic, e.g. 'mean';  "
+                             "use healpix.utils.da_to_healpix() for several")
+
+        if sparse:
+            pixels, counts, values, nside = \
+                hp_utils.da_to_healpix_sparse(da, nside=nside, stat=stat)
+            rsh = cls(nside)
+            rsh.pixels = pixels
+            rsh.hp = np.ma.masked_array(values, mask=np.zeros(pixels.size, dtype=bool))
+            rsh.counts = np.ma.masked_array(dtypes.as_values(counts), 
+                                            mask=np.zeros(pixels.size, dtype=bool))
+            return rsh
         
         hp_counts, hp_values, hp_lons, hp_lats, nside = \
-            hp_utils.da_to_healpix(da, nside=nside)
+            hp_utils.da_to_healpix(da, nside=nside, stat=stat)
 
         # Instantiate
         rsh = cls(nside)
@@ -219,6 +336,66 @@ class RS_Healpix(object):
         # Return
         return rsh
 
+    def to_sparse(self):
+        """ Return a sparse version of the map, 
+        holding only its unmasked pixels. """
+        if self.is_sparse:
+            return self
+        keep = np.flatnonzero(~np.ma.getmaskarray(self.hp))
+
+        rsh = RS_Healpix(self.nside)
+        rsh.pixels = keep
+        rsh.hp = np.ma.masked_array(self.hp.data[keep], 
+                                    mask=np.zeros(keep.size, dtype=bool))
+        if self.counts is not None:
+            rsh.counts = np.ma.masked_array(self.counts.data[keep], 
+                                            mask=np.zeros(keep.size, dtype=bool))
+        rsh.filename = self.filename
+        rsh.variable = self.variable
+        return rsh
+
+    def to_dense(self):
+        """ Return a full-sky version of the map """
+        if not self.is_sparse:
+            return self
+
+        def densify(arr):
+            hp = healpy.ma(np.zeros(self.npix))
+            hp.mask = np.ones(self.npix, dtype=bool)
+            hp.data[self.pixels] = np.ma.getdata(arr)
+            hp.mask[self.pixels] = np.ma.getmaskarray(arr)
+            return hp
+
+        rsh = RS_Healpix(self.nside)
+        rsh.hp = densify(self.hp)
+        if self.counts is not None:
+            rsh.counts = densify(self.counts)
+        rsh.filename = self.filename
+        rsh.variable = self.variable
+        return rsh
+
+    def interp_values(self, lons:np.ndarray, lats:np.ndarray):
+        """
+        Bilinear interpolation of the map 
+
+        Parameters
+        ----------
+        lons : np.ndarray
+            Longitudes (deg)
+        lats : np.ndarray
+            Latitudes (deg)
+
+        Returns
+        -------
+        np.ndarray
+        """
+        if self.is_sparse:
+            return hp_utils.sparse_interp_val(
+                self.pixels, self.hp, self.nside, lons, lats)
+        else:
+            return healpy.pixelfunc.get_interp_val(
+                self.hp, lons, lats, lonlat=True)
+
     def fill_in(self, rs_hp, bbox:tuple):
         """
         Fill in the RS_Healpix object from another RS_Healpix object.
@@ -233,19 +410,37 @@ class RS_Healpix(object):
 
         """
         # Find the missing healpixels
-        missing = hp_utils.masked_in_box(self.hp, bbox)
-        miss_lats = self.lats[missing]
-        miss_lons = self.lons[missing]
+        if self.is_sparse:
+            missing = hp_utils.masked_in_box(self.hp, bbox, 
+                pixels=self.pixels, nside=self.nside)
+        else:
+            missing = hp_utils.masked_in_box(self.hp, bbox)
+        miss_lons, miss_lats = hp_cache.geometry_cache.lons_lats(
+            self.nside, missing)
 
         # Interpolate
-        missing_values = healpy.pixelfunc.get_interp_val(
-            rs_hp.hp, miss_lons, miss_lats, lonlat=True)
+        missing_values = dtypes.as_values(np.ma.getdata(
+            rs_hp.interp_values(miss_lons, miss_lats)))
 
         # Fill in
-        self.hp.data[missing] = missing_values
-        self.hp.mask[missing] = False
-
-        print("Filled in {:d} pixels".format(np.sum(missing)))
+        if self.is_sparse:
+            # Drop any masked entries being filled, then merge
+            keep = ~np.isin(self.pixels, missing)
+            pixels = np.concatenate([self.pixels[keep], missing])
+            srt = np.argsort(pixels)
+            self.pixels = pixels[srt]
+            self.hp = np.ma.concatenate([self.hp[keep], 
+                np.ma.masked_array(missing_values, 
+                                   mask=np.zeros(missing.size, dtype=bool))])[srt]
+            if self.counts is not None:
+                self.counts = np.ma.concatenate([self.counts[keep],
+                    np.ma.masked_array(np.zeros(missing.size, dtype=dtypes.value_dtype), 
+                                       mask=np.zeros(missing.size, dtype=bool))])[srt]
+        else:
+            self.hp.data[missing] = missing_values
+            self.hp.mask[missing] = False
+
+        print("Filled in {:d} pixels".format(missing.size))
         
     def plot(self, **kwargs):
         """ Plot the HEALPix map. """
@@ -254,6 +449,8 @@ class RS_Healpix(object):
 
     def __repr__(self):
         rstr = f'<RS_Healpix: nside={self.nside}, resol={self.pix_resol}deg'
+        if self.is_sparse:
+            rstr = f'{rstr}, sparse npix={self.pixels.size}'
         if self.filename is not None:
             rstr = f'{rstr}\n file={self.basename}'
         if self.variable is not None:
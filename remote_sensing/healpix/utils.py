@@ -7,6 +7,10 @@ import numpy as np
 import xarray
 
 from remote_sensing.utils import utils
+from remote_sensing import dtypes
+from remote_sensing.healpix import binning as hp_binning
+from remote_sensing.healpix import cache as hp_cache
+from remote_sensing.healpix import regions as hp_regions
 
 from IPython import embed
 
@@ -77,39 +81,127 @@ def get_nside_from_dataset(ds:xarray.Dataset):
 
 
 
-def da_to_healpix(da:xarray.DataArray, 
-                  stat:str='mean',
-                  nside:int=None):
+# Most grid cells binned at once when stepping through
+#  the rows of a 1D lat/lon grid, e.g. a global L4 product
+max_band_cells = 2**24
+
+
+def iter_blocks(da:xarray.DataArray, max_cells:int=None):
     """
-    Generate a healpix map of where the input
-    MHW Systems are located on the globe
+    Step through a DataArray one block at a time.
+
+    A dask-backed DataArray yields one in-memory DataArray per chunk 
+    (with its lat/lon), so each chunk is read and computed once.
+    An in-memory 1D lat/lon grid larger than max_cells yields bands of 
+    whole rows, using its separable structure.  Either way only a 
+    single block is computed at once.  Anything else yields the 
+    DataArray itself.
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+    max_cells : int, optional
+        Most cells in a band of rows.  Default is max_band_cells
+
+    Yields
+    ------
+    xarray.DataArray
+    """
+    if max_cells is None:
+        max_cells = max_band_cells
+
+    if da.chunks is None:
+        # Row bands of a fixed grid
+        if da.lat.ndim == 1 and da.size > max_cells:
+            lat_dim = da.lat.dims[0]
+            nlat = da.sizes[lat_dim]
+            nrows = max(1, max_cells // (da.size // nlat))
+            for row in range(0, nlat, nrows):
+                yield da.isel({lat_dim: slice(row, row+nrows)})
+        else:
+            yield da
+        return
+
+    # Offsets of the chunks along each dimension
+    offsets = [np.cumsum((0,) + tuple(chunks)) for chunks in da.chunks]
+    for iblock in np.ndindex(*[len(chunks) for chunks in da.chunks]):
+        window = {dim: slice(off[i], off[i+1]) 
+                  for dim, off, i in zip(da.dims, offsets, iblock)}
+        yield da.isel(window).compute()
+
+
+def in_blocks(da:xarray.DataArray, max_cells:int=None):
+    """
+    Whether iter_blocks() splits a DataArray
+
+    The pixel index cache is then not used for its blocks:
+    an entry (and file) per block would only churn the cache
+
+    Parameters
+    ----------
+    da : xarray.DataArray
+    max_cells : int, optional
+        See iter_blocks()
+
+    Returns
+    -------
+    bool
+    """
+    if max_cells is None:
+        max_cells = max_band_cells
+    return da.chunks is not None or \
+        (da.lat.ndim == 1 and da.size > max_cells)
+
+
+def da_to_pixels(da:xarray.DataArray, nside:int=None,
+                 use_cache:bool=True):
+    """
+    Find the HEALPix pixel of each valid sample of a DataArray
 
     Parameters
     ----------
     da : xa.DataArray
-    stat : str, optional
-        Statistic to calculate. Default is 'mean'
     nside : int, optional
         HEALPix NSIDE parameter. Default is None
         If None, the NSIDE is calculated from the input data
-    
+    use_cache : bool, optional
+        For a 1D lat/lon grid, take the pixel indices from
+        the shared PixelIndexCache
+
     Returns
     -------
-    healpix_array : healpy.ma (number of items contributing)
-    healpix_array : healpy.ma1 (combined statistic)
-    lats : np.ndarray
-    lons : np.ndarray
+    idx : np.ndarray of int
+        HEALPix pixel of each valid sample (finite value, lat and lon)
+    vals : np.ndarray
+        Value of each valid sample
+    nside : int
     """
-    if stat != 'mean':
-        raise IOError("stat != 'mean' not implemented yet")
+    # Pixels
+    if nside is None:
+        nside, _ = get_nside_from_dataset(da)
+
+    # Deal with NaNs
+    vals = da.data.flatten()
+    finite = np.isfinite(vals)
+
+    # Fixed grid?
+    if da.lat.ndim == 1 and use_cache:
+        idx_all = hp_cache.pixel_cache.get(
+            da.lat.values, da.lon.values, nside).reshape(-1)
+        gd = (idx_all >= 0) & finite
+        return idx_all[gd], vals[gd], nside
+
+    # Fixed grid;  broadcast rather than build the 2D lat/lon
+    if da.lat.ndim == 1:
+        idx_all = hp_cache.grid_pixels(
+            da.lat.values, da.lon.values, nside).reshape(-1)
+        gd = (idx_all >= 0) & finite
+        return idx_all[gd], vals[gd], nside
 
     # Unpack
     if da.lat.ndim == 2:
         lats = da.lat.values
         lons = da.lon.values
-    elif da.lat.ndim == 1:
-        # Convert to 2D
-        lons, lats = np.meshgrid(da.lon.values, da.lat.values)
     else:
         raise ValueError("Bad lat/lon shape")
 
@@ -117,89 +209,244 @@ def da_to_healpix(da:xarray.DataArray,
     lats = lats.flatten()
     lons = lons.flatten()
 
-    # Pixels
-    if nside is None:
-        nside, _ = get_nside_from_dataset(da)
-    npix_hp = healpy.nside2npix(nside)
-    
-    # Deal with NaNs
-    vals = da.data.flatten()
-    finite = np.isfinite(vals)
-
-    # 
-    idx_all = np.zeros(vals.size, dtype='int') -1
-
     # Healpix coords
     theta = (90 - lats) * np.pi / 180. 
     phi = lons * np.pi / 180.
 
     gd = np.isfinite(lats) & np.isfinite(lons) & finite
 
-    idx_all[gd] = healpy.pixelfunc.ang2pix(
+    idx_gd = healpy.pixelfunc.ang2pix(
         nside, theta[gd], phi[gd])
 
-    # Count events
-    all_events = np.ma.masked_array(np.zeros(npix_hp, dtype='int'))
-    all_values = np.ma.masked_array(np.zeros(npix_hp, dtype='float'))
+    return idx_gd, vals[gd], nside
 
-    # Calculate median values
-    upixels = np.unique(idx_all)
-    upixels.sort()
 
-    gdi = np.where(idx_all >= 0)[0]
+def da_to_healpix(da:xarray.DataArray, 
+                  stat='mean',
+                  nside:int=None,
+                  use_cache:bool=True):
+    """
+    Generate a healpix map of where the input
+    MHW Systems are located on the globe
+
+    Parameters
+    ----------
+    da : xa.DataArray
+    stat : str or list, optional
+        Statistic to calculate. Default is 'mean'
+        Options are count, sum, mean, median, std, min, max
+        and percentiles, e.g. p10, p90.
+        Provide a list to calculate several statistics at once.
+        count, sum and mean are binned block by block 
+        (see iter_blocks()), so memory stays bounded for
+        large grids;  the others need all the samples at once
+        (a dask-backed DataArray is computed)
+    nside : int, optional
+        HEALPix NSIDE parameter. Default is None
+        If None, the NSIDE is calculated from the input data
+    use_cache : bool, optional
+        Use the pixel index cache for a 1D lat/lon grid
+        (not for one binned in blocks;  see in_blocks())
+    
+    Returns
+    -------
+    healpix_array : healpy.ma (number of items contributing)
+    healpix_array : healpy.ma1 (combined statistic)
+        or a dict of them, keyed by statistic, if stat is a list
+    lats : np.ndarray
+    lons : np.ndarray
+    """
+    stats = [stat] if isinstance(stat, str) else list(stat)
+    if nside is None:
+        nside, _ = get_nside_from_dataset(da)
+    npix_hp = healpy.nside2npix(nside)
 
-    # Add em in
-    for ii in gdi:
-        jj = idx_all[ii]
-        # Count
-        all_events[jj] += 1
-        all_values[jj] += vals[ii]
-    #embed(header='155 of utils')
-    # Mean
-    pos = all_events > 0
-    all_values[pos] /= all_events[pos]
+    stat_maps = {}
+    if hp_binning.needs_sort(stats):
+        # One sort over all the samples (so all in memory), 
+        #  then segment reductions
+        if da.chunks is not None:
+            da = da.compute()
+        idx_gd, vals_gd, nside = da_to_pixels(
+            da, nside=nside, use_cache=use_cache)
+        upix, ucounts, ustats = hp_binning.grouped_stats(
+            idx_gd, vals_gd, stats)
+        all_events = np.zeros(npix_hp, dtype='int')
+        all_events[upix] = ucounts
+        for key in stats:
+            stat_maps[key] = np.zeros(npix_hp, dtype=dtypes.value_dtype)
+            stat_maps[key][upix] = ustats[key]
+    else:
+        # Count events and sum values in one pass, block by block
+        all_events = np.zeros(npix_hp, dtype='int')
+        sums = np.zeros(npix_hp, dtype=dtypes.accum_dtype)
+        use_cache = use_cache and not in_blocks(da)
+        for block in iter_blocks(da):
+            idx_gd, vals_gd, _ = da_to_pixels(
+                block, nside=nside, use_cache=use_cache)
+            b_events, b_sums = hp_binning.bincount_sums(
+                idx_gd, vals_gd, npix_hp)
+            all_events += b_events
+            sums += b_sums
+        for key in stats:
+            if key == 'count':
+                stat_maps[key] = dtypes.as_values(all_events)
+            elif key == 'sum':
+                stat_maps[key] = sums
+            else:
+                # Mean
+                all_values = sums.copy()
+                pos = all_events > 0
+                all_values[pos] /= all_events[pos]
+                stat_maps[key] = all_values
 
     # HP Mask 
     # Yes, the counts need to be a float (for now)
-    hpma = healpy.ma(all_events.astype(float))
-    hpma1 = healpy.ma(all_values)
-
     zero = all_events == 0 
+    hpma = healpy.ma(dtypes.as_values(all_events))
     hpma.mask = zero # current mask set to zero array, where Trues (no events) are masked
-    hpma1.mask = zero 
+    for key in stats:
+        stat_maps[key] = healpy.ma(dtypes.as_values(stat_maps[key]))
+        stat_maps[key].mask = zero 
+    hpma1 = stat_maps[stat] if isinstance(stat, str) else stat_maps
 
     # Angles (convenient)
-    hp_lons, hp_lats = healpy.pixelfunc.pix2ang(nside, np.arange(npix_hp), lonlat=True)
+    hp_lons, hp_lats = hp_cache.geometry_cache.lons_lats(nside)
 
     # Return
     return hpma, hpma1, hp_lons, hp_lats, nside
 
-def masked_in_box(hp:healpy.ma, box:tuple):
+def da_to_healpix_sparse(da:xarray.DataArray, 
+                         stat='mean',
+                         nside:int=None,
+                         use_cache:bool=True):
+    """
+    Generate a sparse healpix map, i.e. one holding
+    only the pixels that contain data
+
+    Parameters
+    ----------
+    da : xa.DataArray
+    stat : str or list, optional
+        Statistic to calculate; see da_to_healpix()
+    nside : int, optional
+        HEALPix NSIDE parameter. Default is None
+        If None, the NSIDE is calculated from the input data
+    use_cache : bool, optional
+        Use the pixel index cache for a 1D lat/lon grid
+        (not for one binned in blocks;  see in_blocks())
+    
+    Returns
+    -------
+    pixels : np.ndarray of int
+        Sorted HEALPix pixels holding data
+    counts : np.ndarray of int
+        Number of items contributing to each pixel
+    values : np.ndarray 
+        Combined statistic in each pixel,
+        or a dict of them, keyed by statistic, if stat is a list
+    nside : int
+    """
+    stats = [stat] if isinstance(stat, str) else list(stat)
+    if nside is None:
+        nside, _ = get_nside_from_dataset(da)
+
+    if hp_binning.needs_sort(stats):
+        # All the samples at once
+        if da.chunks is not None:
+            da = da.compute()
+        idx_gd, vals_gd, nside = da_to_pixels(
+            da, nside=nside, use_cache=use_cache)
+        pixels, counts, values = hp_binning.grouped_stats(
+            idx_gd, vals_gd, stats)
+    else:
+        # Block by block, then combine the occupied pixels
+        b_pixels, b_counts, b_sums = [], [], []
+        use_cache = use_cache and not in_blocks(da)
+        for block in iter_blocks(da):
+            idx_gd, vals_gd, _ = da_to_pixels(
+                block, nside=nside, use_cache=use_cache)
+            upix, ucounts, usums = hp_binning.unique_sums(idx_gd, vals_gd)
+            b_pixels.append(upix)
+            b_counts.append(ucounts)
+            b_sums.append(usums)
+        pixels, counts, sums = hp_binning.unique_sums(
+            np.concatenate(b_pixels), np.concatenate(b_sums),
+            counts=np.concatenate(b_counts))
+        values = {}
+        for key in stats:
+            if key == 'count':
+                values[key] = dtypes.as_values(counts)
+            elif key == 'sum':
+                values[key] = dtypes.as_values(sums)
+            else:
+                values[key] = dtypes.as_values(sums / counts)
+
+    if isinstance(stat, str):
+        values = values[stat]
+
+    # Return
+    return pixels, counts, values, nside
+
+def sparse_interp_val(pixels:np.ndarray, values:np.ma.MaskedArray,
+                      nside:int, lons:np.ndarray, lats:np.ndarray):
+    """ Bilinear interpolation of a sparse healpix map
+
+    Equivalent to healpy.get_interp_val() on the full-sky map,
+    i.e. neighbors that are absent or masked contribute zero.
+
+    Args:
+        pixels (np.ndarray): sorted pixels of the sparse map
+        values (np.ma.MaskedArray): values, aligned with pixels
+        nside (int): HEALPix NSIDE parameter
+        lons (np.ndarray): longitudes to interpolate at (deg)
+        lats (np.ndarray): latitudes to interpolate at (deg)
+
+    Returns:
+        np.ndarray: interpolated values
+    """
+    p, w = healpy.get_interp_weights(nside, lons, lats, lonlat=True)
+    if pixels.size == 0:
+        return np.zeros(p.shape[1:])
+
+    # Look up the neighbors
+    idx = np.minimum(np.searchsorted(pixels, p), pixels.size-1)
+    present = (pixels[idx] == p) & ~np.ma.getmaskarray(values)[idx]
+    vals = np.where(present, np.ma.getdata(values)[idx], 0.)
+
+    return np.sum(vals * w, axis=0)
+
+def masked_in_box(hp:healpy.ma, box:tuple, pixels:np.ndarray=None,
+                  nside:int=None):
     """ Find which healpix pixels are masked
     in the box 
 
+    Only the pixels near the box are examined; 
+    see regions.pixels_in_box()
+
     Args:
         hp (healpy.ma): healpix masked array
         box (list): bounding box of the form
             [lon_min, lon_max, lat_min, lat_max]
+            lon_min > lon_max for a box crossing the dateline
+        pixels (np.ndarray, optional): if provided, hp is a sparse
+            map holding only these pixels and absent pixels
+            count as masked
+        nside (int, optional): HEALPix NSIDE parameter.
+            Required for a sparse map
 
-    
+    Returns:
+        np.ndarray: pixel indices
     """
-    nside = healpy.npix2nside(hp.size)
-    lons, lats = healpy.pix2ang(nside, np.arange(hp.size), lonlat=True)
+    if pixels is not None:
+        if nside is None:
+            raise ValueError("Must provide nside for a sparse map")
+        in_box = hp_regions.pixels_in_box(nside, box)
+        present = pixels[~np.ma.getmaskarray(hp)]
+        return np.setdiff1d(in_box, present, assume_unique=True)
 
-    # In box?
-    gd_lats = (lats > box[2]) & (lats < box[3])
-    if box[0] < box[1]:
-        gd_lons = (lons > box[0]) & (lons < box[1])
-    else:
-        gd_lons = (lons > box[0]) | (lons < box[1])
-    in_box = gd_lats & gd_lons
+    nside = healpy.npix2nside(hp.size)
+    in_box = hp_regions.pixels_in_box(nside, box)
 
     # Masked?
-    masked = hp.mask & in_box
-
-    # Done
-    return np.where(masked)[0]
-
-    
\ No newline at end of file
+    return in_box[np.ma.getmaskarray(hp)[in_box]]
@@ -0,0 +1,364 @@
+""" Rule-based quality control masks.
+
+A list of rules (NaN, quality threshold, value bounds, l2p_flags bits)
+is evaluated by a QCEngine in a single fused pass over the data,
+one chunk of values at a time.  Each rule ORs its verdict into the
+output in place, so only chunk-sized scratch arrays are allocated.
+
+Masks follow the convention of the rest of the package:  True = bad.
+"""
+
+import numpy as np
+import xarray
+
+# Name of the mask cached in a dataset by sst.quality_control()
+mask_variable = 'qc_mask'
+
+
+class QCRule(object):
+    """ Base class of a quality control rule """
+
+    # Input the rule reads:  data, qual or flags
+    source = 'data'
+
+    def apply(self, arr:np.ndarray, tmp:np.ndarray, out:np.ndarray):
+        """
+        OR the bad values of a chunk into out
+
+        Parameters
+        ----------
+        arr : np.ndarray
+            Chunk of the input named by source
+        tmp : np.ndarray of bool
+            Scratch space, same shape as arr
+        out : np.ndarray of bool
+            Mask of the chunk, updated in place
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}>'
+
+
+class NaNRule(QCRule):
+    """ Non-finite (NaN, inf) data are bad """
+
+    def apply(self, arr, tmp, out):
+        np.isfinite(arr, out=tmp)
+        np.logical_not(tmp, out=tmp)
+        out |= tmp
+
+
+class QualityRule(QCRule):
+    """ Data below (or above) a quality threshold are bad """
+
+    source = 'qual'
+
+    def __init__(self, threshold:int, bad_above:bool=False):
+        """
+        Parameters
+        ----------
+        threshold : int
+            Quality threshold, e.g. of the GHRSST quality_level
+        bad_above : bool, optional
+            If True, quality values above threshold are bad
+            (lower is better).  Otherwise those below it
+        """
+        self.threshold = threshold
+        self.bad_above = bad_above
+
+    def apply(self, arr, tmp, out):
+        if self.bad_above:
+            np.greater(arr, self.threshold, out=tmp)
+        else:
+            np.less(arr, self.threshold, out=tmp)
+        out |= tmp
+
+    def __repr__(self):
+        op = '>' if self.bad_above else '<'
+        return f'<QualityRule: qual {op} {self.threshold}>'
+
+
+class BoundsRule(QCRule):
+    """ Data outside (vmin, vmax] are bad """
+
+    def __init__(self, vmin:float, vmax:float):
+        """
+        Parameters
+        ----------
+        vmin : float
+            Values at or below this are bad
+        vmax : float
+            Values above this are bad
+        """
+        self.vmin = vmin
+        self.vmax = vmax
+
+    def apply(self, arr, tmp, out):
+        np.less_equal(arr, self.vmin, out=tmp)
+        out |= tmp
+        np.greater(arr, self.vmax, out=tmp)
+        out |= tmp
+
+    def __repr__(self):
+        return f'<BoundsRule: ({self.vmin}, {self.vmax}]>'
+
+
+class FlagRule(QCRule):
+    """ Data with any of a set of bits raised in the flags are bad """
+
+    source = 'flags'
+
+    def __init__(self, bitmask:int):
+        """
+        Parameters
+        ----------
+        bitmask : int
+            OR of the flag bits that are bad, e.g. (1<<1) | (1<<2)
+        """
+        self.bitmask = int(bitmask)
+
+    def apply(self, arr, tmp, out):
+        # Bit pattern in the dtype of the flags (e.g. bit 15 of int16)
+        bitmask = np.asarray(self.bitmask).astype(arr.dtype)
+        np.not_equal(np.bitwise_and(arr, bitmask), 0, out=tmp)
+        out |= tmp
+
+    def __repr__(self):
+        return f'<FlagRule: bits {self.bitmask:#x}>'
+
+
+class QCEngine(object):
+    """
+    Evaluate a list of QC rules in one fused, chunked pass.
+    """
+
+    def __init__(self, rules:list, chunk_size:int=2**18):
+        """
+        Parameters
+        ----------
+        rules : list of QCRule
+            The mask is the union of the rules
+        chunk_size : int, optional
+            Approximate number of values per chunk
+        """
+        if len(rules) == 0:
+            raise ValueError("Need at least one QC rule")
+        self.rules = list(rules)
+        self.chunk_size = chunk_size
+
+    @property
+    def sources(self):
+        """ Inputs required by the rules """
+        return sorted(set([rule.source for rule in self.rules]))
+
+    def mask(self, data:np.ndarray=None, qual:np.ndarray=None,
+             flags:np.ndarray=None):
+        """
+        Generate the mask
+
+        Parameters
+        ----------
+        data : np.ndarray, optional
+            Data values, e.g. SST
+        qual : np.ndarray, optional
+            Quality values, e.g. quality_level
+        flags : np.ndarray of int, optional
+            Packed flags, e.g. l2p_flags
+        Each is required only if a rule needs it;  all must
+        have the same shape.  DataArrays are unwrapped and
+        dask arrays give a lazy mask, evaluated block by block.
+
+        Returns
+        -------
+        np.ndarray of bool (or dask array)
+            True = bad
+        """
+        inputs = dict(data=data, qual=qual, flags=flags)
+        for source in self.sources:
+            if inputs[source] is None:
+                raise IOError(f"QC rules need the {source} array")
+        arrays = [inputs[source].data 
+                  if isinstance(inputs[source], xarray.DataArray)
+                  else inputs[source] for source in self.sources]
+
+        # Lazy arrays:  one fused pass per block
+        if any([hasattr(arr, 'dask') for arr in arrays]):
+            import dask.array
+            chunks = [arr for arr in arrays if hasattr(arr, 'dask')][0].chunks
+            arrays = [dask.array.asarray(arr).rechunk(chunks) for arr in arrays]
+            return dask.array.map_blocks(self._mask_arrays, *arrays,
+                                         dtype=bool)
+
+        return self._mask_arrays(*[np.asarray(arr) for arr in arrays])
+
+    def _mask_arrays(self, *arrays):
+        """ Fused pass over in-memory arrays, in the order of sources """
+        shape = arrays[0].shape
+        for arr in arrays[1:]:
+            if arr.shape != shape:
+                raise ValueError("QC arrays must have the same shape")
+
+        # Views without the length-1 axes (e.g. time)
+        core = tuple([n for n in shape if n != 1]) or (1,)
+        views = [arr.reshape(core) for arr in arrays]
+        out = np.zeros(core, dtype=bool)
+        if out.size == 0:
+            return out.reshape(shape)
+
+        # Chunks of chunk_size values, or of rows if an input
+        #  is not contiguous (views, for any memory layout)
+        if all([view.flags.c_contiguous for view in views]):
+            views = [view.reshape(-1) for view in views]
+            out_view = out.reshape(-1)
+            step = self.chunk_size
+        else:
+            out_view = out
+            step = max(1, self.chunk_size // max(out[0].size, 1))
+        by_source = dict(zip(self.sources, views))
+        scratch = np.empty((step,) + out_view.shape[1:], dtype=bool)
+
+        for start in range(0, out_view.shape[0], step):
+            part = slice(start, start+step)
+            chunk = out_view[part]
+            tmp = scratch[:chunk.shape[0]]
+            for rule in self.rules:
+                rule.apply(by_source[rule.source][part], tmp, chunk)
+
+        return out.reshape(shape)
+
+    def __repr__(self):
+        return f'<QCEngine: {self.rules}>'
+
+
+# Common GHRSST L2P flags, used when a file does not describe its own
+ghrsst_flags = dict(microwave=1, land=2, ice=4, lake=8, river=16)
+
+
+def flag_bitmask(flags:xarray.DataArray, names:list):
+    """
+    OR of the bits of named flags, e.g. of l2p_flags
+
+    The bits are taken from the CF flag_meanings and flag_masks
+    attributes of the variable (all bits sharing a name are used),
+    else from the common GHRSST L2P flags.
+
+    Parameters
+    ----------
+    flags : xarray.DataArray
+        Packed flags
+    names : list of str
+        Flag names, e.g. ['land', 'ice']
+
+    Returns
+    -------
+    int
+    """
+    if 'flag_meanings' in flags.attrs and 'flag_masks' in flags.attrs:
+        meanings = flags.attrs['flag_meanings'].split()
+        masks = np.atleast_1d(flags.attrs['flag_masks']).astype(np.int64)
+        # Signed masks, e.g. -32768 for bit 15 of int16
+        masks = masks % 2**(8*flags.dtype.itemsize)
+        bits = {}
+        for meaning, mask in zip(meanings, masks):
+            bits[meaning] = bits.get(meaning, 0) | int(mask)
+    else:
+        bits = ghrsst_flags
+
+    bitmask = 0
+    for name in names:
+        if name not in bits:
+            raise ValueError(f"Unknown flag: {name}")
+        bitmask |= bits[name]
+    return bitmask
+
+
+class SensorQC(object):
+    """
+    Quality control criteria of a sensor or collection
+    """
+
+    def __init__(self, min_quality:int=None, bad_flags:list=None,
+                 bounds:tuple=None):
+        """
+        Parameters
+        ----------
+        min_quality : int, optional
+            Lowest good quality_level
+        bad_flags : list of str, optional
+            l2p_flags that are bad, e.g. ['land', 'ice']
+        bounds : tuple, optional
+            (vmin, vmax) of good data;  see BoundsRule
+        """
+        self.min_quality = min_quality
+        self.bad_flags = [] if bad_flags is None else list(bad_flags)
+        self.bounds = bounds
+
+    def rules(self, ds:xarray.Dataset, variable:str=None):
+        """
+        Rules for a dataset;  criteria whose variable
+        the dataset lacks are skipped
+
+        Parameters
+        ----------
+        ds : xarray.Dataset
+        variable : str, optional
+            Data variable, required for bounds
+
+        Returns
+        -------
+        list of QCRule
+        """
+        rules = []
+        if self.min_quality is not None and 'quality_level' in ds:
+            rules.append(QualityRule(self.min_quality))
+        if len(self.bad_flags) > 0 and 'l2p_flags' in ds:
+            rules.append(FlagRule(flag_bitmask(ds.l2p_flags, self.bad_flags)))
+        if self.bounds is not None and variable is not None:
+            rules.append(BoundsRule(self.bounds[0], self.bounds[1]))
+        return rules
+
+    def __repr__(self):
+        return f'<SensorQC: min_quality={self.min_quality}, '\
+            f'bad_flags={self.bad_flags}, bounds={self.bounds}>'
+
+
+# Keyed by collection (the id attribute) or sensor.
+#  Quality thresholds only;  to also drop e.g. land and ice, use
+#  register('AHI', SensorQC(min_quality=5, bad_flags=['land', 'ice']))
+registry = {
+    'AMSR2': SensorQC(min_quality=2),
+    'VIIRS': SensorQC(min_quality=5),
+    'AHI': SensorQC(min_quality=5),
+}
+
+
+def register(key:str, sensor_qc:SensorQC):
+    """
+    Add (or replace) the QC of a sensor or collection
+
+    Parameters
+    ----------
+    key : str
+        Sensor, e.g. AMSR2, or collection id
+    sensor_qc : SensorQC
+    """
+    registry[key] = sensor_qc
+
+
+def lookup(ds:xarray.Dataset):
+    """
+    Find the QC of a dataset, by collection and then by sensor
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+
+    Returns
+    -------
+    SensorQC or None
+    """
+    for attr in ['id', 'sensor']:
+        if ds.attrs.get(attr) in registry:
+            return registry[ds.attrs[attr]]
+    return None
@@ -4,6 +4,7 @@ import xarray
 import pandas
 
 from remote_sensing import units 
+from remote_sensing.netcdf import qc
 
 def find_variable(ds, verbose:bool=False):
     """
@@ -27,7 +28,7 @@ def find_variable(ds, verbose:bool=False):
             return variable 
     return None
 
-def load(filename:str, verbose:bool=True):
+def load(filename:str, verbose:bool=True, chunks:dict=None):
     """
     Load a .nc file of SST
 
@@ -37,6 +38,12 @@ def load(filename:str, verbose:bool=True):
         NetCDF file to load
         It must include the time dimension
     verbose : bool, optional
+    chunks : dict or str, optional
+        Open the file lazily with these dask chunks, 
+        e.g. dict(lat=2000, lon=2000) or 'auto'.
+        sst and qual are then dask arrays, converted and read
+        one chunk at a time when computed, and a corrupt 
+        file is only detected then
 
     Returns
     -------
@@ -52,7 +59,8 @@ def load(filename:str, verbose:bool=True):
         filename_or_obj=filename,
         engine='h5netcdf',
         mask_and_scale=True,
-        decode_timedelta=False)
+        decode_timedelta=False,
+        chunks=chunks)
 
     # Deal with time
     if 'time' in ds.coords:
@@ -83,20 +91,49 @@ def load(filename:str, verbose:bool=True):
             import pdb; pdb.set_trace()
         return None, None, None, None
 
-    ds.close()
+    # Lazy arrays still read from the file
+    if chunks is None:
+        ds.close()
 
     # Return
     return sst, qual, latitude, longitude, time
 
-def quality_control(ds):
-    """ Sensor / Product specific quality control. """
+def quality_control(ds:xarray.Dataset, verbose:bool=False):
+    """ Sensor / Product specific quality control. 
 
-    bad = None
-    if ds.attrs['sensor'] == 'AMSR2':
-        bad = ds.quality_level < 2
-    elif ds.attrs['sensor'] == 'VIIRS':
-        bad = ds.quality_level < 5
-    elif ds.attrs['sensor'] == 'AHI':
-        bad = ds.quality_level < 5
+    The criteria come from the qc.registry, keyed by collection
+    or sensor.  The mask is computed once and cached in the dataset
+    as the qc.mask_variable, so it follows any later slicing.
 
-    return bad
+    Parameters
+    ----------
+    ds : xarray.Dataset
+    verbose : bool, optional
+        Report a sensor without quality control
+
+    Returns
+    -------
+    xarray.DataArray or None
+        Mask;  True = bad.  None if the sensor is not registered
+    """
+    # Cached?
+    if qc.mask_variable in ds:
+        return ds[qc.mask_variable]
+
+    sensor_qc = qc.lookup(ds)
+    if sensor_qc is None:
+        if verbose:
+            print(f"No quality control for sensor: {ds.attrs.get('sensor')}")
+        return None
+    rules = sensor_qc.rules(ds)
+    if len(rules) == 0:
+        return None
+
+    # One fused pass
+    qual = ds.quality_level if 'quality_level' in ds else None
+    flags = ds.l2p_flags if 'l2p_flags' in ds else None
+    dims = (qual if qual is not None else flags).dims
+    bad = qc.QCEngine(rules).mask(qual=qual, flags=flags)
+
+    ds[qc.mask_variable] = (dims, bad)
+    return ds[qc.mask_variable]
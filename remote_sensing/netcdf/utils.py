@@ -1,13 +1,15 @@
 """ Utilities for working with netCDF files. """
 
-import numpy as np
 import xarray
 
 from . import sst
+from . import qc
 
-def gen_mask_for_dataset(ds:xarray.Dataset, variable:str):
+def gen_mask_for_dataset(ds:xarray.Dataset, variable:str,
+                         verbose:bool=False):
     """
     Generate a mask for a dataset based on a variable.
+    For SST, the mask is cached in the dataset;  see sst.quality_control()
 
     Parameters
     ----------
@@ -15,6 +17,8 @@ def gen_mask_for_dataset(ds:xarray.Dataset, variable:str):
         Dataset containing the variable
     variable : str
         Variable name
+    verbose : bool, optional
+        Report a sensor without quality control
 
     Returns
     -------
@@ -25,7 +29,7 @@ def gen_mask_for_dataset(ds:xarray.Dataset, variable:str):
 
     # Quality control
     if variable in ['sea_surface_temperature', 'analysed_sst']:
-        mask = sst.quality_control(ds)
+        mask = sst.quality_control(ds, verbose=verbose)
     
     return mask
 
@@ -35,6 +39,9 @@ def build_mask(dfield, qual, qual_thresh=2, lower_qual=True,
     """
     Generate a mask based on NaN, qual, and other bounds
 
+    The criteria are evaluated as rules of a qc.QCEngine
+    in a single pass;  the inputs are not modified.
+
     Parameters
     ----------
     dfield : np.ndarray
@@ -58,37 +65,18 @@ def build_mask(dfield, qual, qual_thresh=2, lower_qual=True,
         mask;  True = bad
 
     """
-    # Mask val
-    qual_maskval = 999999 if lower_qual else -999999
-
-    dfield[np.isnan(dfield)] = np.nan
-    if field == 'SST':
-        if qual is None:
-            qual = np.zeros_like(dfield).astype(int)
-        qual[np.isnan(dfield)] = qual_maskval
-    else:
-        if qual is None:
-            raise IOError("Need to deal with qual for color.  Just a reminder")
-        # Deal with NaN
-    masks = np.logical_or(np.isnan(dfield), qual==qual_maskval)
+    rules = [qc.NaNRule()]
+    if field != 'SST' and qual is None:
+        raise IOError("Need to deal with qual for color.  Just a reminder")
 
     # Quality
     # TODO -- Do this right for color
-    qual_masks = np.zeros_like(masks)
-
     if qual is not None and qual_thresh is not None:
-        if lower_qual:
-            qual_masks[~masks] = (qual[~masks] > qual_thresh) 
-        else:
-            qual_masks[~masks] = (qual[~masks] < qual_thresh) 
+        rules.append(qc.QualityRule(qual_thresh, bad_above=lower_qual))
 
     # Temperature bounds
-    #
-    value_masks = np.zeros_like(masks)
     if field == 'SST':
-        value_masks[~masks] = (dfield[~masks] <= temp_bounds[0]) | (dfield[~masks] > temp_bounds[1])
-    # Union
-    masks = np.logical_or(masks, qual_masks, value_masks)
+        rules.append(qc.BoundsRule(temp_bounds[0], temp_bounds[1]))
 
-    # Return
-    return masks
\ No newline at end of file
+    # Union
+    return qc.QCEngine(rules).mask(data=dfield, qual=qual)
@@ -3,12 +3,19 @@ SST sources (microwave and IR)
 
 This example was used for the ARCTERX 2025, Leg 2"""
 
-import xarray
+import os
+import time
 import argparse
+import itertools
+
+import pandas
 
 from remote_sensing.download import podaac
-from remote_sensing.healpix import rs_healpix
-from remote_sensing import io as rs_io
+from remote_sensing.download import login
+from remote_sensing.download import transfer
+from remote_sensing.operations import pipeline
+from remote_sensing import catalog as rs_catalog
+from remote_sensing.healpix import ingest
 from remote_sensing import kml as rs_kml
 
 from IPython import embed
@@ -16,82 +23,204 @@ from IPython import embed
 # Globals
 lon_lim = (127.,134)
 lat_lim = (18.,23)
+amsr2_collection = 'AMSR2-REMSS-L2P_RT-v8.2'
+h09_collection = 'H09-AHI-L3C-ACSPO-v2.90'
+bbox = '127,18,134,23'
+
+# Loading and QC of each source
+amsr2_kwargs = dict(time_isel=0, resol_km=11., 
+                    lat_slice=(18,23.),  lon_slice=(127., 134.))
+h09_kwargs = dict(lat_slice=slice(23,18),  lon_slice=slice(127., 134.), 
+                  time_isel=0)
+
+
+def newest_granules(collection:str, args):
+    """ Granules over the box, newest first, from CMR """
+    if args.t_end is None:
+        t_end = pandas.Timestamp.now(tz='UTC')
+    else:
+        t_end = pandas.Timestamp(args.t_end)
+    t_start = t_end - pandas.Timedelta(days=args.ndays)
+    fmt = '%Y-%m-%dT%H:%M:%SZ'
+    return podaac.iter_granules(collection, t_start.strftime(fmt), 
+                                t_end.strftime(fmt), bbox=bbox,
+                                sort_key='-start_date', verbose=args.verbose)
+
+
+def ingest_on_demand(collection:str, ngranules:int, args, catalog, **kwargs):
+    """ Download and bin the newest granules over the box, one at a time,
+    until ngranules of them are usable """
+    granules = newest_granules(collection, args)
+    downloads = podaac.download_granules(granules, clobber=args.clobber,
+                                         verbose=args.verbose,
+                                         workers=args.download_workers,
+                                         catalog=catalog, ordered=True)
+    acc = ingest.ingest_usable((local_file for _, local_file in downloads),
+                               'sea_surface_temperature', ngranules,
+                               min_coverage=args.min_coverage, 
+                               verbose=True, **kwargs)
+    if acc is None:
+        raise IOError(f"No usable {collection} granules for this time and box")
+    return acc
+
+
+def fetch(job, **kwargs):
+    """ Download stage:  (source, granule) to (source, local file) """
+    name, granule = job
+    local_file = podaac.download_granule(granule, **kwargs)
+    return None if local_file is None else (name, local_file)
+
+
+def bin_granule(job):
+    """ Binning stage:  (source, local file) to (source, accumulator) """
+    name, local_file = job
+    kwargs = amsr2_kwargs if name == 'amsr2' else h09_kwargs
+    return name, ingest.ingest_file(local_file, 'sea_surface_temperature',
+                                    **kwargs)
+
+
+def ingest_pipeline(args, catalog):
+    """ Search, download and bin both sources at once:  
+    each granule is binned while the next ones download """
+    sources = [('amsr2', amsr2_collection, args.namsr2),
+               ('h09', h09_collection, args.nh09)]
+    # Tag each granule with its source
+    granules = itertools.chain(*[
+        zip(itertools.repeat(name), itertools.islice(
+            newest_granules(collection, args), ngranules))
+        for name, collection, ngranules in sources])
+
+    session = login.shared()
+    session.grow_pool(args.download_workers)
+    manifest = None if args.clobber else transfer.Manifest(
+        os.path.join(podaac.podaac_path, transfer.manifest_file))
+
+    pipe = pipeline.Pipeline(granules, verbose=True)
+    pipe.add(fetch, workers=args.download_workers, name='download',
+             session=session, manifest=manifest, catalog=catalog, 
+             verbose=args.verbose)
+    pipe.add(bin_granule, workers=args.workers, processes=True, name='bin')
+    accs = {}
+    try:
+        for name, acc in pipe:
+            accs[name] = acc if name not in accs else accs[name].merge(acc)
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+    if 'amsr2' not in accs or 'h09' not in accs:
+        raise IOError("No AMSR2 or H09 granules for this time and box")
+    return accs['amsr2'], accs['h09']
+
 
 def main(args):
 
-    if args.use_json is None:
+    catalog = rs_catalog.GranuleCatalog()
+
+    if args.pipeline:
+        amsr2_acc, h09_acc = ingest_pipeline(args, catalog)
+        # Use the latest H09 file for the timestamp
+        t_h09 = max([catalog.get(f)['t_start'] for f in h09_acc.filenames])
+        time_root = str(pandas.Timestamp(t_h09, unit='s')
+                        ).replace(' ', 'T').replace(':','')[0:13]
+        make_kmz(amsr2_acc, h09_acc, time_root, args)
+        return
+
+    if args.on_demand:
+        # Download only what is binned, newest first
+        print("Generating AMSR2 stack")
+        amsr2_acc = ingest_on_demand(amsr2_collection, args.namsr2, args, 
+                                     catalog, **amsr2_kwargs)
+        print("Generating H09 stack")
+        h09_acc = ingest_on_demand(h09_collection, args.nh09, args, 
+                                   catalog, **h09_kwargs)
+        # Use the latest H09 file for the timestamp
+        time_root = str(pandas.Timestamp(
+            catalog.get(h09_acc.filenames[0])['t_start'], unit='s')
+            ).replace(' ', 'T').replace(':','')[0:13]
+        make_kmz(amsr2_acc, h09_acc, time_root, args)
+        return
+
+    if not args.offline:
         # Grab the latest data
-        amsr2_files, _ = podaac.grab_file_list(
-            'AMSR2-REMSS-L2P_RT-v8.2', 
+        amsr2_files, amsr2_checksums = podaac.grab_file_list(
+            amsr2_collection, 
             t_end=args.t_end,
             dt_past=dict(days=args.ndays),
-            bbox='127,18,134,23')
+            bbox=bbox)
 
-        h09_files, _ = podaac.grab_file_list(
-            'H09-AHI-L3C-ACSPO-v2.90', dt_past=dict(days=args.ndays),
+        h09_files, h09_checksums = podaac.grab_file_list(
+            h09_collection, dt_past=dict(days=args.ndays),
             t_end=args.t_end,
-            bbox='127,18,134,23')
+            bbox=bbox)
 
         # Download
         print("Downloading AMSR2 files")
-        local_amsr2 = podaac.download_files(amsr2_files, verbose=args.verbose)
+        local_amsr2 = podaac.download_files(amsr2_files, verbose=args.verbose,
+                                            checksums=amsr2_checksums)
         print("Downloading Himawari files")
-        local_h09 = podaac.download_files(h09_files, verbose=args.verbose)
+        local_h09 = podaac.download_files(h09_files, verbose=args.verbose,
+                                          checksums=h09_checksums)
         print("All done")
 
-        sdict = {}
-        sdict['local_amsr2'] = local_amsr2
-        sdict['local_h09'] = local_h09
-        sdict['namsr2'] = args.namsr2
-        sdict['nh09'] = args.nh09
+        # Catalog them (each file is opened only the first time)
+        catalog.index([f for f in local_amsr2 if f is not None], 
+                      collection=amsr2_collection)
+        catalog.index([f for f in local_h09 if f is not None], 
+                      collection=h09_collection)
 
+    # Select the newest granules over the box
+    if args.t_end is None:
+        t_end = time.time()
     else:
-        # Load filenames from JSON
-        sdict = rs_io.loadjson(args.use_json)
-        amsr2_files = sdict['local_amsr2']
-        h09_files = sdict['local_h09']
-        if 'namsr2' not in sdict:
-            sdict['namsr2'] = args.namsr2
-            sdict['nh09'] = args.nh09
+        t_end = pandas.Timestamp(args.t_end).timestamp()
+    query = dict(t_start=t_end - args.ndays*86400., t_end=t_end,
+                 bbox=(lon_lim[0], lat_lim[0], lon_lim[1], lat_lim[1]))
+    local_amsr2 = [record['path'] for record in catalog.query(
+        collection=amsr2_collection, limit=args.namsr2, **query)]
+    local_h09 = catalog.query(collection=h09_collection, limit=args.nh09, 
+                              **query)
+    if len(local_amsr2) == 0 or len(local_h09) == 0:
+        raise IOError("No AMSR2 or H09 granules in the catalog for this time and box")
 
     # Use the latest H09 file for the timestamp
-    ds = xarray.open_dataset(sdict['local_h09'][0])
-    time_root = str(ds.time.data[0]).replace(':','')[0:13]
-
-    if args.use_json is None:
-        # Save files to a JSON file
-        json_file = f'Merged_SST_{time_root}.json'
-        jdict = rs_io.jsonify(sdict)
-        rs_io.savejson(json_file, jdict, overwrite=True)
-        print(f"Wrote: {json_file}")
+    time_root = str(pandas.Timestamp(local_h09[0]['t_start'], unit='s')
+                    ).replace(' ', 'T').replace(':','')[0:13]
+    local_h09 = [record['path'] for record in local_h09]
 
     # #############################
     # Healpix time
     # #############################
 
     # AMSR2
-    amsr2_hpxs = []
-
     print("--------------------")
     print("Generating AMSR2 stack")
     print("--------------------")
 
-    for data_file in sdict['local_amsr2'][0:sdict['namsr2']]:
-        # Objectify
-        rs_hpx = rs_healpix.RS_Healpix.from_dataset_file(
-            data_file, 'sea_surface_temperature',
-            time_isel=0, resol_km=11., 
-            lat_slice=(18,23.),  lon_slice=(127., 134.))
-        #
-        print(f"Generated RS_Healpix from {data_file}")
-        # Add
-        amsr2_hpxs.append(rs_hpx)
-
-    # Combine?
-    if args.namsr2 > 1:
-        amsr2_stack = rs_healpix.RS_Healpix.from_list(amsr2_hpxs)
-    else:
-        amsr2_stack = amsr2_hpxs[0]
+    amsr2_acc = ingest.ingest_files(
+        local_amsr2, 
+        'sea_surface_temperature', workers=args.workers,
+        verbose=True, **amsr2_kwargs)
+
+    print("--------------------")
+    print("Generating H09 stack")
+    print("--------------------")
+
+    # #############################
+    if args.debug:
+        from importlib import reload
+        embed(header='110 of gen')
+    h09_acc = ingest.ingest_files(
+        local_h09, 
+        'sea_surface_temperature', workers=args.workers,
+        verbose=True, **h09_kwargs)
+
+    make_kmz(amsr2_acc, h09_acc, time_root, args)
+
+
+def make_kmz(amsr2_acc, h09_acc, time_root:str, args):
+    """ Stack, fill in the IR with the microwave, and write the KMZ """
+    amsr2_stack = amsr2_acc.to_rs_healpix('mean')
 
     if args.show:
         print("Showing AMSR2 stack")
@@ -102,28 +231,8 @@ def main(args):
         #if args.debug:
         #    embed(header='Check AMSR2 stack')
 
-    print("--------------------")
-    print("Generating H09 stack")
-    print("--------------------")
-
-    # #############################
-    h09_hpxs = []
-    if args.debug:
-        from importlib import reload
-        embed(header='110 of gen')
-    for data_file in sdict['local_h09'][0:sdict['nh09']]:
-        # Objectify
-        rs_hpx = rs_healpix.RS_Healpix.from_dataset_file(
-            data_file, 'sea_surface_temperature',
-            lat_slice=slice(23,18),  lon_slice=slice(127., 134.), 
-            time_isel=0, debug=args.debug)
-        # 
-        print(f"Generated RS_Healpix from {data_file}")
-        # Add
-        h09_hpxs.append(rs_hpx)
-        del(rs_hpx)
     # Stack
-    h09_stack = rs_healpix.RS_Healpix.from_list(h09_hpxs)
+    h09_stack = h09_acc.to_rs_healpix('mean')
     if args.show:
         h09_stack.plot(figsize=(10.,6), cmap='jet', 
                        lon_lim=lon_lim, lat_lim=lat_lim, 
@@ -181,8 +290,18 @@ def parse_option():
                         help='Print more to the screen?')
     parser.add_argument('--clobber', default=False, action='store_true',
                         help='Clobber existing files')
-    parser.add_argument('--use_json', type=str, 
-                        help='Load files from the JSON file')
+    parser.add_argument('--offline', default=False, action='store_true',
+                        help='Use the granules already in the local catalog;  no search or download')
+    parser.add_argument("--workers", type=int, 
+                        default=1, help="Number of processes for reading and binning the granules")
+    parser.add_argument('--on_demand', default=False, action='store_true',
+                        help='Download the newest granules one by one, stopping once enough are usable')
+    parser.add_argument('--pipeline', default=False, action='store_true',
+                        help='Search, download and bin at once, binning each granule while the next ones download')
+    parser.add_argument("--min_coverage", type=float, 
+                        default=0.1, help="With --on_demand, least fraction of good data in the box for a granule to count")
+    parser.add_argument("--download_workers", type=int, 
+                        default=2, help="With --on_demand or --pipeline, number of concurrent downloads")
 
     args = parser.parse_args()
     
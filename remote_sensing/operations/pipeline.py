@@ -0,0 +1,262 @@
+""" Streaming pipeline of stages connected by bounded queues.
+
+Items (e.g. granules) flow from a source, such as a CMR search, through
+stages, such as download then QC and binning, to the consumer, such as
+an accumulator.  Each stage has its own pool of workers:  threads for
+I/O-bound work (downloads) or processes for CPU-bound work (binning),
+so the binning of one granule runs while the next ones download, and
+the time to the product approaches that of the slowest stage rather
+than the sum of the stages.
+
+The queues between the stages are bounded, so a fast stage waits for
+a slow one rather than piling up work (or files) ahead of it.
+
+    pipe = pipeline.Pipeline(podaac.iter_granules(collection, start, end))
+    pipe.add(podaac.download_granule, workers=4, name='download')
+    pipe.add(ingest.ingest_file, workers=2, processes=True, name='bin',
+             variable='sea_surface_temperature', time_isel=0)
+    for acc in pipe:
+        ...
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Defaults
+queue_size = 4       # items waiting per worker of the next stage
+poll_time = 0.1      # s;  between checks for a stop while blocked
+
+# End of the stream
+_done = object()
+
+
+class Stage(object):
+    """
+    One step of a pipeline:  a function applied to each item
+    by a pool of workers
+    """
+
+    def __init__(self, func, workers:int=1, processes:bool=False,
+                 name:str=None, **kwargs):
+        """
+        Parameters
+        ----------
+        func : callable
+            Called as func(item, **kwargs);  its result is passed on,
+            unless None (e.g. a failed download), which is dropped.
+            For processes, it and its arguments must pickle
+        workers : int, optional
+            Number of items handled at once
+        processes : bool, optional
+            Run func in a pool of processes (for CPU-bound work)
+            rather than in threads
+        name : str, optional
+            For messages;  default is the name of func
+        **kwargs
+            Passed to func
+        """
+        self.func = func
+        self.workers = max(1, workers)
+        self.processes = processes
+        self.name = func.__name__ if name is None else name
+        self.kwargs = kwargs
+        # Statistics
+        self.nitems = 0
+        self.busy = 0.
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        kind = 'processes' if self.processes else 'threads'
+        return f'<Stage: {self.name}, {self.workers} {kind}>'
+
+
+class Pipeline(object):
+    """
+    A source of items and the stages they go through, run
+    concurrently by iterating over the pipeline
+    """
+
+    def __init__(self, source, verbose:bool=False):
+        """
+        Parameters
+        ----------
+        source : iterable
+            Items fed to the first stage (None is skipped);  consumed
+            lazily in a thread of its own (and closed, if a generator,
+            once stopped)
+        verbose : bool, optional
+            Print the time spent in each stage at the end
+        """
+        self.source = source
+        self.verbose = verbose
+        self.stages = []
+
+    def add(self, func, workers:int=1, processes:bool=False,
+            name:str=None, **kwargs):
+        """
+        Add a stage;  see Stage
+
+        Returns
+        -------
+        Pipeline : self, to chain calls
+        """
+        self.stages.append(Stage(func, workers=workers, processes=processes,
+                                 name=name, **kwargs))
+        return self
+
+    def __iter__(self):
+        """
+        Run the pipeline
+
+        Yields
+        ------
+        Results of the last stage, in the order they complete.
+        Breaking out of the loop stops the pipeline:  the source is
+        no longer read and the items in flight are dropped
+
+        Raises
+        ------
+        Exception
+            The first exception raised by the source or a stage,
+            once the pipeline has stopped
+        """
+        stop = threading.Event()
+        errors = []
+        queues = [queue.Queue(maxsize=queue_size*stage.workers)
+                  for stage in self.stages] + [queue.Queue(maxsize=queue_size)]
+        pools = [ProcessPoolExecutor(max_workers=stage.workers)
+                 if stage.processes else None for stage in self.stages]
+
+        def fail(e):
+            errors.append(e)
+            stop.set()
+
+        def feed():
+            source = iter(self.source)
+            try:
+                for item in source:
+                    if item is None:
+                        continue
+                    if not _put(queues[0], item, stop):
+                        break
+            except Exception as e:
+                fail(e)
+            finally:
+                if hasattr(source, 'close'):
+                    source.close()
+                _put(queues[0], _done, stop)
+
+        def work(idx):
+            stage, pool = self.stages[idx], pools[idx]
+            q_in, q_out = queues[idx], queues[idx+1]
+            while True:
+                item = _get(q_in, stop)
+                if item is _done:
+                    # Let the other workers of the stage see it too
+                    _put(q_in, _done, stop)
+                    break
+                if item is None:
+                    # Stopped
+                    break
+                t0 = time.perf_counter()
+                try:
+                    if pool is None:
+                        result = stage.func(item, **stage.kwargs)
+                    else:
+                        result = pool.submit(stage.func, item,
+                                             **stage.kwargs).result()
+                except Exception as e:
+                    fail(e)
+                    break
+                with stage._lock:
+                    stage.busy += time.perf_counter() - t0
+                    stage.nitems += 1
+                if result is not None and not _put(q_out, result, stop):
+                    break
+            # The last worker of the stage ends the stream
+            with stage._lock:
+                stage._running -= 1
+                last = stage._running == 0
+            if last:
+                _put(q_out, _done, stop)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for idx, stage in enumerate(self.stages):
+            stage._running = stage.workers
+            threads += [threading.Thread(target=work, args=(idx,), daemon=True)
+                        for _ in range(stage.workers)]
+
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                result = _get(queues[-1], stop)
+                if result is _done or result is None:
+                    break
+                yield result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            for pool in pools:
+                if pool is not None:
+                    pool.shutdown(wait=True, cancel_futures=True)
+            if self.verbose:
+                print(f"Pipeline:  {time.perf_counter() - t0:.1f}s")
+                for stage in self.stages:
+                    print(f"  {stage.name}:  {stage.nitems} items, "
+                          f"{stage.busy:.1f}s busy over {stage.workers} workers")
+        if len(errors) > 0:
+            raise errors[0]
+
+    def run(self, merge=None):
+        """
+        Run the pipeline to the end
+
+        Parameters
+        ----------
+        merge : callable, optional
+            Called as merge(total, result) for each result after the
+            first, returning the new total,
+            e.g. HealpixAccumulator.merge
+
+        Returns
+        -------
+        list or object
+            The results of the last stage, in the order they complete,
+            or their total if merge is given (None if there were none)
+        """
+        if merge is None:
+            return list(self)
+        total = None
+        for result in self:
+            total = result if total is None else merge(total, result)
+        return total
+
+    def __repr__(self):
+        return f'<Pipeline: {" -> ".join([stage.name for stage in self.stages])}>'
+
+
+def _put(q:queue.Queue, item, stop:threading.Event):
+    """ Put an item, unless stopped;  returns False if stopped """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=poll_time)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q:queue.Queue, stop:threading.Event):
+    """ Get an item;  None if stopped """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=poll_time)
+        except queue.Empty:
+            continue
+    return None
@@ -18,6 +18,8 @@ def parser(options=None):
     parser.add_argument("--cmap", type=str, help="Color map")
 
     parser.add_argument("--itime", type=int, default=0, help="Time index to view, if applicable")
+    parser.add_argument("--t_start", type=str, help="Only show files from this time on, ISO format e.g. 2025-02-07T04:00:00Z (uses the granule catalog)")
+    parser.add_argument("--t_end", type=str, help="Only show files up to this time, ISO format (uses the granule catalog)")
 
     if options is None:
         pargs = parser.parse_args()
@@ -135,5 +137,21 @@ def main(pargs):
     files = glob.glob(pargs.netcdf_file)
     files.sort()
 
+    # Select by time, and order by it, from the granule catalog;
+    #  files are opened only the first time they are seen
+    if pargs.t_start is not None or pargs.t_end is not None:
+        import pandas
+        from remote_sensing import catalog as rs_catalog
+        t_start = None if pargs.t_start is None else \
+            pandas.Timestamp(pargs.t_start).timestamp()
+        t_end = None if pargs.t_end is None else \
+            pandas.Timestamp(pargs.t_end).timestamp()
+        records = rs_catalog.GranuleCatalog().index(files)
+        records = [record for record in records 
+                   if (t_start is None or record['t_end'] is None or record['t_end'] >= t_start)
+                   and (t_end is None or record['t_start'] is None or record['t_start'] <= t_end)]
+        records.sort(key=lambda record: record['t_start'] or 0.)
+        files = [record['path'] for record in records]
+
     for one_file in files:
         show_one(one_file, pargs)
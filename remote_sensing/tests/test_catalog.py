@@ -0,0 +1,92 @@
+""" Test routines for the granule catalog """
+
+import os
+
+import numpy as np
+import xarray
+
+from remote_sensing import catalog as rs_catalog
+from remote_sensing.download import granules as rs_granules
+from remote_sensing.download import cmr_cache
+
+
+def fake_file(path, hour:int, lon_min:float, lon_max:float):
+    """ A small L3 granule at an hour of 2025-02-07 """
+    lats = np.linspace(18., 23., 6)
+    lons = np.linspace(lon_min, lon_max, 8)
+    ds = xarray.Dataset(
+        {'sea_surface_temperature': (('lat', 'lon'), np.ones((6, 8)))},
+        coords=dict(lat=lats, lon=lons),
+        attrs=dict(sensor='AHI',
+                   time_coverage_end=f'20250207T{hour:02d}5959Z'))
+    ds = ds.expand_dims(time=[np.datetime64(f'2025-02-07T{hour:02d}:00:00')])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.to_netcdf(path)
+    return path
+
+
+def test_catalog(tmp_path, monkeypatch):
+    """ Files are indexed once, then selected without opening them """
+    catalog = rs_catalog.GranuleCatalog(str(tmp_path / 'granules.sqlite'))
+    files = [fake_file(str(tmp_path / 'H09' / f'h09_{hour:02d}.nc'), hour,
+                       127., 134.) for hour in range(6)]
+
+    # Indexed on first sight
+    opened = []
+    open_dataset = xarray.open_dataset
+    def counting(path, *args, **kwargs):
+        opened.append(path)
+        return open_dataset(path, *args, **kwargs)
+    monkeypatch.setattr(rs_catalog.xarray, 'open_dataset', counting)
+    records = catalog.index(files)
+    assert len(opened) == 6
+    assert records[2]['collection'] == 'H09'
+    assert records[2]['sensor'] == 'AHI'
+    assert records[2]['t_start'] == cmr_cache.to_timestamp('2025-02-07T02:00:00Z')
+    assert records[2]['t_end'] == cmr_cache.to_timestamp('2025-02-07T02:59:59Z')
+    assert (records[2]['west'], records[2]['north']) == (127., 23.)
+
+    # Not again, unless changed
+    catalog.index(files)
+    assert len(opened) == 6
+    fake_file(files[0], 0, 130., 140.)
+    catalog.index(files)
+    assert opened[6:] == [files[0]]
+
+    # Queries
+    t0 = cmr_cache.to_timestamp('2025-02-07T01:30:00Z')
+    t1 = cmr_cache.to_timestamp('2025-02-07T04:00:00Z')
+    found = catalog.query(collection='H09', t_start=t0, t_end=t1, limit=2)
+    assert [record['path'] for record in found] == [files[4], files[3]]
+    found = catalog.query(bbox=(135., 10., 150., 30.), newest_first=False)
+    assert [record['path'] for record in found] == [files[0]]
+    assert catalog.query(collection='AMSR2') == []
+    assert len(opened) == 7
+
+    # Deleted files are not returned
+    os.remove(files[5])
+    assert len(catalog.query(collection='H09')) == 5
+
+
+def test_catalog_granule(tmp_path):
+    """ Downloads are recorded with their CMR footprint """
+    catalog = rs_catalog.GranuleCatalog(str(tmp_path / 'granules.sqlite'))
+    path = str(tmp_path / 'granule.nc')
+    with open(path, 'wb') as f:
+        f.write(b'data')
+    # Across the dateline
+    footprint = dict(rectangles=[], polygons=[
+        [(170., -10.), (-170., -10.), (-170., 10.), (170., 10.), (170., -10.)]])
+    granule = rs_granules.Granule('G1-POCLOUD', 'https://archive/AMSR2/granule.nc',
+        t_start=0., t_end=3600., footprint=footprint)
+    catalog.add_granule(granule, path)
+
+    record = catalog.get(path)
+    assert record['collection'] == 'AMSR2'
+    assert record['concept_id'] == 'G1-POCLOUD'
+    assert (record['west'], record['east']) == (170., -170.)
+    assert record['footprint']['polygons'][0][1] == [-170., -10.]
+    assert len(catalog.query(bbox=(175., -5., 180., 5.))) == 1
+    assert len(catalog.query(bbox=(-175., -5., -160., 5.))) == 1
+    assert len(catalog.query(bbox=(0., -5., 10., 5.))) == 0
+
@@ -0,0 +1,623 @@
+""" Test routines for the download module, against a local HTTP server """
+
+import os
+import json
+import pickle
+import hashlib
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from remote_sensing.download import podaac
+from remote_sensing.download import transfer
+from remote_sensing.download import cmr_cache
+from remote_sensing.download import login
+from remote_sensing.download import earthdata
+from remote_sensing.download import footprint
+from remote_sensing.download import granules as rs_granules
+
+
+class FakeArchive(BaseHTTPRequestHandler):
+    """ Serves the files of the server, honouring Range requests.
+    Fails the paths in server.fail, drops the connection 
+    after server.cut bytes for those in server.cut, and 
+    requires server.token (if set) as a Bearer token """
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith('/search/granules'):
+            self.search()
+            return
+        if self.path.startswith('/search/collections'):
+            self.collections()
+            return
+        with server.lock:
+            server.requests.append(self.path)
+            server.ranges.append(self.headers.get('Range'))
+            nfail = server.fail.get(self.path, 0)
+            if nfail > 0:
+                server.fail[self.path] = nfail - 1
+            cut = server.cut.pop(self.path, None)
+        if nfail > 0:
+            self.send_error(503)
+            return
+        if server.token is not None and \
+                self.headers.get('Authorization') != f'Bearer {server.token}':
+            self.send_error(401)
+            return
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        data = server.files[self.path]
+
+        # Range
+        start = 0
+        if self.headers.get('Range') is not None:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 
+                             f'bytes {start}-{len(data)-1}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)-start))
+        self.end_headers()
+        if cut is not None:
+            self.wfile.write(data[start:start+cut])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def search(self):
+        """ CMR granule search over server.granules, paged with
+        CMR-Search-After """
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        page_size = int(query['page_size'][0])
+        offset = int(self.headers.get('CMR-Search-After', 'sa0')[2:])
+        with server.lock:
+            server.searches.append(offset)
+        items = server.granules[offset:offset+page_size]
+        body = json.dumps({'hits': len(server.granules), 
+                           'items': items}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('CMR-Hits', str(len(server.granules)))
+        if offset + page_size < len(server.granules):
+            self.send_header('CMR-Search-After', f'sa{offset+page_size}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def collections(self):
+        """ CMR collection search over server.collections, by page_num;
+        fails page N if 'page_N' is in server.fail """
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        page_size = int(query['page_size'][0])
+        page_num = int(query['page_num'][0])
+        with server.lock:
+            server.pages.append(page_num)
+            nfail = server.fail.get(f'page_{page_num}', 0)
+            if nfail > 0:
+                server.fail[f'page_{page_num}'] = nfail - 1
+        if nfail > 0:
+            self.send_error(503)
+            return
+        entries = server.collections[(page_num-1)*page_size:page_num*page_size]
+        body = json.dumps({'feed': {'entry': entries}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('CMR-Hits', str(len(server.collections)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def archive():
+    """ A local stand-in for the PO.DAAC archive """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeArchive)
+    server.files = {f'/COLL/granule_{ii}.nc': os.urandom(10000 + 1000*ii)
+                    for ii in range(6)}
+    server.fail = {}
+    server.cut = {}
+    server.token = None
+    server.granules = []
+    server.searches = []
+    server.collections = []
+    server.pages = []
+    server.requests = []
+    server.ranges = []
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_files(archive, tmp_path, monkeypatch):
+    """ Concurrent downloads keep the order, retry and skip """
+    monkeypatch.setattr(transfer, 'backoff_time', 0.01)
+    paths = sorted(archive.files)
+    file_list = [archive.url + path for path in paths]
+    file_list.insert(2, archive.url + '/COLL/missing.nc')
+    archive.fail['/COLL/granule_3.nc'] = 2
+
+    session = transfer.make_session()
+    local_files = podaac.download_files(file_list, download_dir=str(tmp_path),
+        verbose=False, workers=3, session=session)
+
+    assert local_files[2] is None
+    local_files.pop(2)
+    for path, local_file in zip(paths, local_files):
+        assert local_file == os.path.join(str(tmp_path), 'COLL',
+                                          os.path.basename(path))
+        with open(local_file, 'rb') as f:
+            assert f.read() == archive.files[path]
+    # Retried after the 503s;  no temporary files left
+    assert archive.requests.count('/COLL/granule_3.nc') == 3
+    assert sorted(os.listdir(tmp_path / 'COLL')) == \
+        sorted([os.path.basename(path) for path in paths])
+
+    # Existing files are skipped
+    archive.requests.clear()
+    podaac.download_files(file_list[:2], download_dir=str(tmp_path),
+        verbose=False, session=session)
+    assert len(archive.requests) == 0
+
+
+def test_fetch_file_errors(archive, tmp_path, monkeypatch):
+    """ A failed download leaves nothing under the final name """
+    monkeypatch.setattr(transfer, 'backoff_time', 0.01)
+    session = transfer.make_session()
+    archive.fail['/COLL/granule_0.nc'] = 10
+    output_path = str(tmp_path / 'granule_0.nc')
+    with pytest.raises(transfer.requests.HTTPError):
+        transfer.fetch_file(session, archive.url + '/COLL/granule_0.nc',
+                            output_path, retries=2, backoff=0.01)
+    assert not os.path.isfile(output_path)
+
+
+def test_resume(archive, tmp_path, monkeypatch):
+    """ Interrupted downloads resume from their .part file """
+    monkeypatch.setattr(transfer, 'backoff_time', 0.01)
+    session = transfer.make_session()
+    path = '/COLL/granule_5.nc'
+    data = archive.files[path]
+    output_path = str(tmp_path / 'granule_5.nc')
+    checksum = {'Value': hashlib.md5(data).hexdigest(), 'Algorithm': 'MD5'}
+
+    # Dropped mid-way, then resumed by the retry
+    #  (from the last full chunk written)
+    monkeypatch.setattr(transfer, 'chunk_size', 1024)
+    archive.cut[path] = 4096
+    transfer.fetch_file(session, archive.url + path, output_path,
+                        checksum=checksum)
+    with open(output_path, 'rb') as f:
+        assert f.read() == data
+    assert archive.ranges[-2:] == [None, 'bytes=4096-']
+    assert not os.path.isfile(output_path + '.part')
+
+    # Left by an earlier run;  not counted as existing
+    os.remove(output_path)
+    os.mkdir(tmp_path / 'COLL')
+    with open(str(tmp_path / 'COLL' / 'granule_5.nc.part'), 'wb') as f:
+        f.write(data[:7000])
+    local_files = podaac.download_files([archive.url + path], 
+        download_dir=str(tmp_path), verbose=False, session=session)
+    with open(local_files[0], 'rb') as f:
+        assert f.read() == data
+    assert archive.ranges[-1] == 'bytes=7000-'
+
+    # Complete .part:  only verified and renamed
+    os.rename(local_files[0], output_path + '.part')
+    transfer.fetch_file(session, archive.url + path, output_path,
+                        checksum=checksum)
+    assert os.path.getsize(output_path) == len(data)
+
+    # Corrupt .part:  retried from scratch, then given up on
+    with open(output_path + '.part', 'wb') as f:
+        f.write(b'x'*100)
+    bad = {'Value': '0'*32, 'Algorithm': 'MD5'}
+    with pytest.raises(transfer.TransferError):
+        transfer.fetch_file(session, archive.url + path, 
+                            str(tmp_path / 'bad.nc'), checksum=bad, retries=1)
+    assert not os.path.isfile(str(tmp_path / 'bad.nc'))
+
+
+def test_checksums(archive, tmp_path, monkeypatch):
+    """ Existing files are verified once, and fetched again if corrupt """
+    monkeypatch.setattr(transfer, 'backoff_time', 0.01)
+    session = transfer.make_session()
+    paths = sorted(archive.files)
+    file_list = [archive.url + path for path in paths]
+    checksums = {os.path.basename(path): 
+                 {'Value': hashlib.md5(archive.files[path]).hexdigest(),
+                  'Algorithm': 'MD5'} for path in paths}
+
+    # Count the hashing
+    hashed = []
+    file_checksum = transfer.file_checksum
+    def counting(path, algorithm='MD5'):
+        hashed.append(os.path.basename(path))
+        return file_checksum(path, algorithm)
+    monkeypatch.setattr(transfer, 'file_checksum', counting)
+
+    local_files = podaac.download_files(file_list, download_dir=str(tmp_path),
+        verbose=False, workers=3, session=session, checksums=checksums)
+    assert os.path.isfile(tmp_path / transfer.manifest_file)
+
+    # Unchanged:  neither hashed nor fetched again
+    hashed.clear()
+    archive.requests.clear()
+    podaac.download_files(file_list, download_dir=str(tmp_path),
+        verbose=False, workers=3, session=session, checksums=checksums)
+    assert hashed == []
+    assert archive.requests == []
+
+    # Corrupt:  hashed and fetched again
+    with open(local_files[1], 'r+b') as f:
+        f.write(b'corrupt')
+    podaac.download_files(file_list, download_dir=str(tmp_path),
+        verbose=False, workers=3, session=session, checksums=checksums)
+    assert archive.requests == [paths[1]]
+    with open(local_files[1], 'rb') as f:
+        assert f.read() == archive.files[paths[1]]
+
+    # Manifest entries are only valid for the same size and mtime
+    manifest = transfer.Manifest(str(tmp_path / transfer.manifest_file))
+    assert manifest.get(local_files[0], 'MD5') == \
+        checksums[os.path.basename(paths[0])]['Value']
+    os.utime(local_files[0], ns=(0, 0))
+    assert manifest.get(local_files[0], 'MD5') is None
+
+
+def fake_granule(idx:int, t_start:str, t_end:str, 
+                 url:str='https://archive', checksum:str=None):
+    """ A granule as in a CMR umm_json search """
+    name = f'granule_{idx}.nc'
+    if checksum is None:
+        checksum = f'{idx:032d}'
+    return {'meta': {'concept-id': f'G{idx}-POCLOUD'},
+            'umm': {'TemporalExtent': {'RangeDateTime': {
+                        'BeginningDateTime': t_start,
+                        'EndingDateTime': t_end}},
+                    'SpatialExtent': {'HorizontalSpatialDomain': {'Geometry': {
+                        'BoundingRectangles': [{
+                            'WestBoundingCoordinate': 120.+idx,
+                            'SouthBoundingCoordinate': 10.,
+                            'EastBoundingCoordinate': 130.+idx,
+                            'NorthBoundingCoordinate': 20.}]}}},
+                    'RelatedUrls': [
+                        {'URL': f'{url}/COLL/{name}', 'Type': 'GET DATA'},
+                        {'URL': f'{url}/opendap/{name}', 'Type': 'GET DATA',
+                         'Subtype': 'OPENDAP DATA'}],
+                    'DataGranule': {'ArchiveAndDistributionInformation': [
+                        {'Name': name, 'Checksum': {'Value': checksum,
+                                                    'Algorithm': 'MD5'}}]}}}
+
+
+def test_search_cache(tmp_path, monkeypatch):
+    """ Repeated searches only ask CMR for newer granules """
+    # CMR times, with or without the 'Z' (parsed as UTC either way)
+    t0 = 1738368000.
+    assert cmr_cache.to_timestamp('2025-02-01T00:00:00.000Z') == t0
+    assert cmr_cache.to_timestamp('2025-02-01T00:00:00Z') == t0
+    assert cmr_cache.to_timestamp('2025-02-01T00:00:00') == t0
+    assert cmr_cache.to_timestamp('2025-02-01T01:00:00+01:00') == t0
+    assert cmr_cache.to_iso(t0) == '2025-02-01T00:00:00Z'
+
+    # Hourly granules
+    catalog = [fake_granule(ii, f'2025-02-01T{ii:02d}:00:00.000Z', 
+                            f'2025-02-01T{ii:02d}:59:59.000Z') 
+               for ii in range(24)]
+    queries = []
+    def search_granules(collection, start, end, now, bbox=None, verbose=True,
+                        auth=None):
+        queries.append((start, end))
+        t0, t1 = cmr_cache.to_timestamp(start), cmr_cache.to_timestamp(end)
+        return [item for item in catalog[::-1] 
+                if cmr_cache.granule_times(item)[1] >= t0 and 
+                cmr_cache.granule_times(item)[0] <= t1]
+    monkeypatch.setattr(podaac, 'search_granules', search_granules)
+    monkeypatch.setattr(podaac, 'cache_file', str(tmp_path / 'cmr.sqlite'))
+
+    kwargs = dict(dt_past=dict(hours=6), bbox='127,18,134,23', verbose=False)
+    files, checksums = podaac.grab_file_list('COLL', 
+        t_end='2025-02-01T12:00:00Z', **kwargs)
+    assert queries == [('2025-02-01T06:00:00Z', '2025-02-01T12:00:00Z')]
+    assert files == [f'https://archive/COLL/granule_{ii}.nc' 
+                     for ii in range(12, 5, -1)]
+    assert checksums['granule_7.nc']['Value'] == f'{7:032d}'
+
+    # Within the cached window:  no query
+    assert podaac.grab_file_list('COLL', 
+        time_range=('2025-02-01T07:00:00Z', '2025-02-01T11:00:00Z'),
+        bbox='127,18,134,23', verbose=False)[0] == files[1:-1]
+    assert len(queries) == 1
+
+    # An hour later:  only since the newest granule
+    files2, _ = podaac.grab_file_list('COLL', 
+        t_end='2025-02-01T13:00:00Z', **kwargs)
+    assert queries[-1] == ('2025-02-01T12:00:00Z', '2025-02-01T13:00:00Z')
+    assert files2 == [f'https://archive/COLL/granule_{ii}.nc' 
+                      for ii in range(13, 6, -1)]
+
+    # Another bbox, or an expired cache:  full search
+    podaac.grab_file_list('COLL', t_end='2025-02-01T13:00:00Z', 
+                          dt_past=dict(hours=6), verbose=False)
+    assert queries[-1] == ('2025-02-01T07:00:00Z', '2025-02-01T13:00:00Z')
+    podaac.grab_file_list('COLL', t_end='2025-02-01T13:00:00Z', 
+                          ttl=-1., **kwargs)
+    assert queries[-1] == ('2025-02-01T07:00:00Z', '2025-02-01T13:00:00Z')
+    assert len(queries) == 4
+
+
+def test_login(archive, tmp_path, monkeypatch):
+    """ One login is shared by threads, and refreshed once on a 401 """
+    calls = []
+    def get_token(url):
+        calls.append('get')
+        return 'old'
+    def refresh_token(token):
+        calls.append('refresh')
+        return 'new'
+    monkeypatch.setattr(login.pa, 'setup_earthdata_login_auth', 
+                        lambda endpoint: None)
+    monkeypatch.setattr(login.pa, 'get_token', get_token)
+    monkeypatch.setattr(login.pa, 'refresh_token', refresh_token)
+    archive.token = 'new'
+
+    auth = login.EarthdataLogin(pool_size=2)
+    assert repr(auth) == '<EarthdataLogin: not logged in>'
+    paths = sorted(archive.files)
+    local_files = podaac.download_files([archive.url + path for path in paths],
+        download_dir=str(tmp_path), verbose=False, workers=4, session=auth)
+    assert None not in local_files
+    assert calls == ['get', 'refresh']
+    assert auth.pool_size == 4
+
+    # Worker processes get the token, not a new login
+    auth2 = pickle.loads(pickle.dumps(auth))
+    assert auth2.token == 'new'
+    assert calls == ['get', 'refresh']
+
+    # Expired:  log in again
+    monkeypatch.setattr(login, 'token_max_age', -1.)
+    assert auth2.token == 'old'
+    assert calls[-1] == 'get'
+
+    # A search is a single request to CMR
+    searches = []
+    def get_search_results(params, verbose):
+        searches.append(dict(params))
+        return {'items': [fake_granule(0, '2025-02-01T00:00:00Z',
+                                       '2025-02-01T00:59:59Z')]}
+    def no_lookup(*args, **kwargs):
+        raise AssertionError("Looked up the collection id")
+    monkeypatch.setattr(podaac.pa, 'get_search_results', get_search_results)
+    monkeypatch.setattr(podaac.pa, 'get_cmr_collection_id', no_lookup)
+    items = podaac.search_granules('COLL', '2025-02-01T00:00:00Z',
+        '2025-02-02T00:00:00Z', verbose=False, auth=auth2)
+    assert len(items) == 1
+    assert len(searches) == 1 and searches[0]['token'] == 'old'
+
+
+def test_stream_granules(archive, tmp_path, monkeypatch):
+    """ Granules are listed page by page, and downloaded as they come """
+    monkeypatch.setattr(podaac, 'cmr_search_url', 
+                        archive.url + '/search/granules.umm_json')
+    monkeypatch.setattr(podaac, 'page_size', 4)
+    paths = sorted(archive.files)
+    archive.granules = [fake_granule(ii, f'2025-02-01T{ii:02d}:00:00Z',
+        f'2025-02-01T{ii:02d}:59:59Z', url=archive.url,
+        checksum=hashlib.md5(archive.files[path]).hexdigest())
+        for ii, path in enumerate(paths)][::-1]
+    auth = login.EarthdataLogin(token='token')
+
+    # Lazy:  one page per 4 granules
+    stream = podaac.iter_granules('COLL', '2025-02-01T00:00:00Z', 
+                                  '2025-02-02T00:00:00Z', auth=auth)
+    granule = next(stream)
+    assert archive.searches == [0]
+    assert granule.filename == 'granule_5.nc'
+    assert granule.url == archive.url + '/COLL/granule_5.nc'
+    assert granule.checksum['Value'] == \
+        hashlib.md5(archive.files[paths[5]]).hexdigest()
+    assert granule.t_start == cmr_cache.to_timestamp('2025-02-01T05:00:00Z')
+    assert granule.footprint == dict(rectangles=[(125., 10., 135., 20.)],
+                                     polygons=[])
+    assert len(list(stream)) == 5
+    assert archive.searches == [0, 4]
+
+    # Fed straight to the downloader
+    archive.searches.clear()
+    done = list(podaac.download_granules(
+        podaac.iter_granules('COLL', '2025-02-01T00:00:00Z', auth=auth),
+        download_dir=str(tmp_path), verbose=False, workers=2, session=auth))
+    assert sorted([granule.filename for granule, _ in done]) == \
+        sorted([os.path.basename(path) for path in paths])
+    for granule, local_file in done:
+        with open(local_file, 'rb') as f:
+            assert f.read() == archive.files['/COLL/' + granule.filename]
+
+    # A granule listed twice (e.g. with a new concept id) is fetched once
+    granules = list(podaac.iter_granules('COLL', '2025-02-01T00:00:00Z', 
+                                         auth=auth))
+    again = rs_granules.Granule('G99-POCLOUD', granules[0].url,
+                                checksum=granules[0].checksum)
+    done = list(podaac.download_granules(granules[:1] + [again],
+        download_dir=str(tmp_path / 'twice'), verbose=False, session=auth))
+    assert [granule.concept_id for granule, _ in done] == \
+        [granules[0].concept_id]
+
+    # Again:  verified from the manifest, not fetched
+    archive.requests.clear()
+    done = list(podaac.download_granules(
+        podaac.iter_granules('COLL', '2025-02-01T00:00:00Z', auth=auth),
+        download_dir=str(tmp_path), verbose=False, workers=2, session=auth))
+    assert None not in [local_file for _, local_file in done]
+    assert archive.requests == []
+
+    # One at a time, e.g. as a pipeline stage
+    manifest = transfer.Manifest(str(tmp_path / transfer.manifest_file))
+    granule = done[0][0]
+    assert podaac.download_granule(granule, download_dir=str(tmp_path),
+        session=auth, manifest=manifest) == done[0][1]
+    assert archive.requests == []
+    granule.url = archive.url + '/COLL/missing.nc'
+    assert podaac.download_granule(granule, download_dir=str(tmp_path),
+                                   session=auth) is None
+
+
+def test_ordered_stream(archive, tmp_path, monkeypatch):
+    """ Files come in the order listed, and closing stops the downloads """
+    session = transfer.make_session()
+    paths = sorted(archive.files)[::-1]
+    jobs = [(archive.url + path, str(tmp_path / os.path.basename(path)), None)
+            for path in paths]
+    # The newest is the slowest
+    monkeypatch.setattr(transfer, 'backoff_time', 0.2)
+    archive.fail[paths[0]] = 1
+
+    stream = transfer.fetch_stream(session, iter(jobs), workers=2, 
+                                   ordered=True)
+    done = [next(stream), next(stream)]
+    stream.close()
+    assert [job for job, _ in done] == jobs[:2]
+    assert [error for _, error in done] == [None, None]
+    # At most those queued behind were started
+    time.sleep(0.5)
+    assert len(set(archive.requests)) <= 5
+    assert not os.path.exists(jobs[-1][1])
+
+
+def test_collection_catalog(archive, tmp_path, monkeypatch):
+    """ Collection pages are fetched concurrently, and indexed locally """
+    monkeypatch.setattr(earthdata, 'cmr_collections_url', 
+                        archive.url + '/search/collections.json')
+    archive.collections = [dict(id=f'C{ii}-TEST', short_name=f'COLL-{ii:02d}',
+        title=f'Collection {ii}', provider_id='POCLOUD' if ii % 2 else 'OB_DAAC',
+        summary='Sea surface temperature' if ii % 3 else 'Ocean color')
+        for ii in range(23)]
+
+    collections = earthdata.get_earthdata_shortnames(page_size=5, workers=3)
+    assert [c['short_name'] for c in collections] == \
+        [f'COLL-{ii:02d}' for ii in range(23)]
+    assert collections[1] == dict(short_name='COLL-01', title='Collection 1',
+                                  provider='POCLOUD')
+    assert sorted(archive.pages) == [1, 2, 3, 4, 5]
+
+    # Local catalog
+    catalog = earthdata.CollectionCatalog(str(tmp_path / 'collections.sqlite'))
+    catalog.update(workers=3)
+    assert len(catalog) == 23
+
+    # Answered locally
+    archive.pages.clear()
+    found = catalog.search('ocean COLOR')
+    assert [c['short_name'] for c in found] == \
+        [f'COLL-{ii:02d}' for ii in range(0, 23, 3)]
+    found = catalog.search('surface temperature', provider='POCLOUD')
+    assert [c['short_name'] for c in found] == \
+        [f'COLL-{ii:02d}' for ii in range(23) if ii % 3 and ii % 2]
+    assert catalog.search('coll 07', full=True)[0]['id'] == 'C7-TEST'
+    assert catalog.search('chlorophyll') == []
+    assert catalog.search('') == []
+    assert archive.pages == []
+
+    # A partial listing does not replace the catalog
+    archive.collections = archive.collections[:12]
+    archive.fail['page_2'] = 10
+    catalog.update(workers=3, page_size=5)
+    assert len(catalog) == 23
+    archive.fail.clear()
+    catalog.update(workers=3, page_size=5)
+    assert len(catalog) == 12
+
+
+def test_footprint():
+    """ Exact, dateline-aware intersection of footprints and boxes """
+    assert footprint.lon_overlap(127., 134., 130., 140.)
+    assert not footprint.lon_overlap(127., 134., 135., 140.)
+    assert footprint.lon_overlap(170., -170., -175., -160.)
+    assert footprint.lon_overlap(170., -170., 185., 188.)
+    assert not footprint.lon_overlap(170., -170., 350., 355.)
+    assert not footprint.lon_overlap(170., -170., -160., 160.)
+    assert footprint.lon_overlap(-180., 180., 10., 20.)
+
+    # Across the dateline
+    across = [(170., -10.), (-170., -10.), (-170., 10.), (170., 10.), (170., -10.)]
+    assert footprint.polygon_intersects(across, (175., -5., 179., 5.))
+    assert footprint.polygon_intersects(across, (-178., -5., -172., 5.))
+    assert footprint.polygon_intersects(across, (178., -5., -178., 5.))
+    assert not footprint.polygon_intersects(across, (0., -5., 10., 5.))
+    assert footprint.footprint_bbox(dict(rectangles=[], polygons=[across])) == \
+        (170., -10., -170., 10.)
+
+    # Grazing:  the box is within the bounding box, but not the polygon
+    triangle = [(120., 10.), (140., 10.), (120., 30.)]
+    assert footprint.polygon_intersects(triangle, (127., 18., 134., 23.))
+    assert not footprint.polygon_intersects(triangle, (133., 20., 138., 25.))
+    # Inside
+    assert footprint.polygon_intersects(triangle, (122., 12., 123., 13.))
+
+    # Around a pole
+    polar = [(0., 70.), (90., 70.), (180., 70.), (-90., 70.), (0., 70.)]
+    assert footprint.polygon_intersects(polar, (10., 75., 20., 80.))
+    assert not footprint.polygon_intersects(polar, (10., 0., 20., 10.))
+    assert footprint.polygon_intersects(polar[::-1], (10., -80., 20., 10.))
+    assert not footprint.polygon_intersects(polar[::-1], (10., 75., 20., 80.))
+
+    # Rectangles, and unknown footprints
+    assert footprint.intersects(dict(rectangles=[(170., -10., -170., 10.)], 
+        polygons=[]), (-175., 0., -172., 5.))
+    assert not footprint.intersects(dict(rectangles=[(170., -10., -170., 10.)], 
+        polygons=[]), (-175., 20., -172., 25.))
+    assert footprint.intersects(None, (0., 0., 1., 1.))
+    assert footprint.footprint_bbox(dict(rectangles=[(-180., -90., 180., 90.)],
+        polygons=[])) == (-180., -90., 180., 90.)
+
+
+def test_prefilter(monkeypatch):
+    """ Granules whose footprint misses the box are dropped """
+    items = [fake_granule(ii, '2025-02-01T00:00:00Z', '2025-02-01T01:00:00Z')
+             for ii in range(3)]
+    # A swath that grazes the box (but not its bounding box), and
+    #  one that crosses it
+    items[0]['umm']['SpatialExtent']['HorizontalSpatialDomain']['Geometry'] = \
+        {'GPolygons': [{'Boundary': {'Points': [
+            {'Longitude': lon, 'Latitude': lat} for lon, lat in 
+            [(120., 10.), (140., 10.), (120., 30.), (120., 10.)]]}}]}
+    items[1]['umm']['SpatialExtent']['HorizontalSpatialDomain']['Geometry'] = \
+        {'GPolygons': [{'Boundary': {'Points': [
+            {'Longitude': lon, 'Latitude': lat} for lon, lat in 
+            [(130., 0.), (135., 0.), (135., 40.), (130., 40.), (130., 0.)]]}}]}
+    # No geometry:  kept
+    del items[2]['umm']['SpatialExtent']
+    monkeypatch.setattr(podaac, 'search_granules', 
+                        lambda *args, **kwargs: items)
+
+    files, checksums = podaac.grab_file_list('COLL', 
+        time_range=('2025-02-01T00:00:00Z', '2025-02-01T02:00:00Z'),
+        bbox='133,20,138,25', use_cache=False, verbose=False)
+    assert files == ['https://archive/COLL/granule_1.nc', 
+                     'https://archive/COLL/granule_2.nc']
+    assert sorted(checksums) == ['granule_1.nc', 'granule_2.nc']
+    files, _ = podaac.grab_file_list('COLL', 
+        time_range=('2025-02-01T00:00:00Z', '2025-02-01T02:00:00Z'),
+        bbox='133,20,138,25', use_cache=False, verbose=False, prefilter=False)
+    assert len(files) == 3
@@ -0,0 +1,541 @@
+""" Test routines for the healpix module """
+
+import pytest
+
+import numpy as np
+import xarray
+import healpy
+
+from remote_sensing.healpix import utils as hp_utils
+from remote_sensing.healpix import cache as hp_cache
+from remote_sensing.healpix import regions as hp_regions
+from remote_sensing.healpix.rs_healpix import RS_Healpix
+from remote_sensing.healpix.accumulate import HealpixAccumulator
+from remote_sensing.healpix import binning as hp_binning
+from remote_sensing.healpix import combine as hp_combine
+from remote_sensing import dtypes
+from remote_sensing import units
+from remote_sensing.healpix import ingest
+from remote_sensing.healpix import rs_healpix
+
+
+def fake_grid(nlat=60, nlon=80, seed=1234, nan_frac=0.2):
+    """ Generate a small 1D lat/lon grid DataArray with NaNs """
+    rng = np.random.default_rng(seed)
+    lats = np.linspace(23., 18., nlat)
+    lons = np.linspace(127., 134., nlon)
+    data = 25. + rng.normal(size=(nlat, nlon))
+    data[rng.random(size=data.shape) < nan_frac] = np.nan
+    return xarray.DataArray(data, coords={'lat': lats, 'lon': lons},
+                            dims=('lat', 'lon'))
+
+
+def fake_swath(nx=50, ny=40, seed=42):
+    """ Generate a small 2D lat/lon swath DataArray with junk """
+    rng = np.random.default_rng(seed)
+    lats = 18. + 5*rng.random(size=(ny, nx))
+    lons = 127. + 7*rng.random(size=(ny, nx))
+    lats[0, :5] = np.nan
+    data = 25. + rng.normal(size=(ny, nx))
+    data[rng.random(size=data.shape) < 0.1] = np.nan
+    return xarray.DataArray(data, dims=('ni', 'nj'),
+                            coords={'lat': (('ni', 'nj'), lats),
+                                    'lon': (('ni', 'nj'), lons)})
+
+
+def loop_counts_means(da, nside):
+    """ Reference implementation: one sample at a time """
+    if da.lat.ndim == 1:
+        lons, lats = np.meshgrid(da.lon.values, da.lat.values)
+    else:
+        lons, lats = da.lon.values, da.lat.values
+    lats, lons = lats.flatten(), lons.flatten()
+    vals = da.values.flatten()
+    npix = healpy.nside2npix(nside)
+    counts = np.zeros(npix, dtype=int)
+    sums = np.zeros(npix)
+    for lat, lon, val in zip(lats, lons, vals):
+        if not (np.isfinite(lat) and np.isfinite(lon) and np.isfinite(val)):
+            continue
+        ipix = healpy.ang2pix(nside, (90-lat)*np.pi/180., lon*np.pi/180.)
+        counts[ipix] += 1
+        sums[ipix] += val
+    pos = counts > 0
+    sums[pos] /= counts[pos]
+    return counts, sums
+
+
+def test_da_to_healpix_matches_loop(monkeypatch):
+    # Exact comparison in full precision
+    monkeypatch.setattr(dtypes, 'value_dtype', np.float64)
+    for da, nside in [(fake_grid(), 256), (fake_swath(), 128)]:
+        hp_counts, hp_values, hp_lons, hp_lats, nside = \
+            hp_utils.da_to_healpix(da, nside=nside)
+        counts, means = loop_counts_means(da, nside)
+
+        assert np.array_equal(hp_counts.data, counts)
+        assert np.array_equal(hp_counts.mask, counts == 0)
+        assert np.array_equal(hp_values.mask, counts == 0)
+        assert np.allclose(hp_values.data, means, rtol=0, atol=1e-12)
+        assert hp_lons.size == healpy.nside2npix(nside)
+
+
+def test_da_to_healpix_stats():
+    da = fake_grid(nlat=80, nlon=100)
+    nside = 128
+    stats = ['count', 'mean', 'median', 'std', 'min', 'max', 'p10', 'p97.5']
+    hp_counts, hp_stats, _, _, _ = hp_utils.da_to_healpix(
+        da, nside=nside, stat=stats)
+    assert sorted(hp_stats.keys()) == sorted(stats)
+
+    # Brute force, pixel by pixel
+    lons, lats = np.meshgrid(da.lon.values, da.lat.values)
+    vals = da.values.flatten()
+    gd = np.isfinite(vals)
+    pix = healpy.ang2pix(nside, lons.flatten()[gd], lats.flatten()[gd],
+                         lonlat=True)
+    upix = np.unique(pix)
+    assert np.array_equal(np.where(~hp_counts.mask)[0], upix)
+    for ipix in upix:
+        pvals = vals[gd][pix == ipix]
+        assert hp_counts[ipix] == pvals.size
+        assert np.isclose(hp_stats['count'][ipix], pvals.size)
+        assert np.isclose(hp_stats['mean'][ipix], np.mean(pvals))
+        assert np.isclose(hp_stats['median'][ipix], np.median(pvals))
+        assert np.isclose(hp_stats['std'][ipix], np.std(pvals))
+        assert np.isclose(hp_stats['min'][ipix], np.min(pvals))
+        assert np.isclose(hp_stats['max'][ipix], np.max(pvals))
+        assert np.isclose(hp_stats['p10'][ipix], np.percentile(pvals, 10))
+        assert np.isclose(hp_stats['p97.5'][ipix], np.percentile(pvals, 97.5))
+
+    # Single statistic returns a single map
+    _, hp_median, _, _, _ = hp_utils.da_to_healpix(
+        da, nside=nside, stat='median')
+    assert np.array_equal(hp_median.data, hp_stats['median'].data)
+
+    # Bad statistic
+    with pytest.raises(ValueError):
+        hp_utils.da_to_healpix(da, nside=nside, stat='mode')
+
+    # A map holds a single statistic
+    rsh = RS_Healpix.from_dataarray(da, nside=nside, stat='median', sparse=True)
+    assert np.allclose(rsh.hp.data, hp_stats['median'].data[rsh.pixels])
+    for sparse in [True, False]:
+        with pytest.raises(ValueError):
+            RS_Healpix.from_dataarray(da, stat=['mean', 'median'],
+                                      sparse=sparse)
+
+
+def test_sparse_matches_dense():
+    box = (128., 133., 19., 22.)
+    da1, da2 = fake_grid(seed=1), fake_grid(seed=2, nan_frac=0.6)
+    swath = fake_swath()
+    nside = 256
+
+    dense = [RS_Healpix.from_dataarray(da, nside=nside) for da in [da1, da2]]
+    sparse = [RS_Healpix.from_dataarray(da, nside=nside, sparse=True) 
+              for da in [da1, da2]]
+    for rs_d, rs_s in zip(dense, sparse):
+        assert rs_s.is_sparse
+        assert rs_s.hp.size == np.sum(~rs_d.hp.mask)
+        back = rs_s.to_dense()
+        assert np.array_equal(back.hp.mask, rs_d.hp.mask)
+        assert np.array_equal(back.hp.data[~back.hp.mask], 
+                              rs_d.hp.data[~rs_d.hp.mask])
+        assert np.array_equal(back.counts.data[~back.hp.mask], 
+                              rs_d.counts.data[~rs_d.hp.mask])
+        # Masked pixels in the box
+        assert np.array_equal(
+            hp_utils.masked_in_box(rs_d.hp, box),
+            hp_utils.masked_in_box(rs_s.hp, box, pixels=rs_s.pixels, 
+                                   nside=nside))
+        
+    # Average
+    avg_d = RS_Healpix.from_list(dense)
+    avg_s = RS_Healpix.from_list(sparse)
+    assert avg_s.is_sparse
+    assert np.array_equal(avg_s.pixels, np.flatnonzero(~avg_d.hp.mask))
+    assert np.array_equal(avg_s.hp.data, avg_d.hp.data[avg_s.pixels])
+
+    # Fill in
+    fill_d = RS_Healpix.from_dataarray(swath, nside=nside)
+    fill_s = RS_Healpix.from_dataarray(swath, nside=nside, sparse=True)
+    dense[1].fill_in(fill_d, box)
+    sparse[1].fill_in(fill_s, box)
+    back = sparse[1].to_dense()
+    assert np.array_equal(back.hp.mask, dense[1].hp.mask)
+    assert np.allclose(back.hp.data[~back.hp.mask], 
+                       dense[1].hp.data[~dense[1].hp.mask])
+    # Plotting coordinates
+    lons, lats = sparse[1].lons_lats
+    assert lons.size == sparse[1].hp.size
+
+
+def test_pixel_index_cache(tmp_path):
+    da = fake_grid()
+    nside = 256
+
+    # Same pixels as without the cache
+    idx, vals, _ = hp_utils.da_to_pixels(da, nside=nside, use_cache=False)
+    cache = hp_cache.PixelIndexCache(maxsize=2, cache_dir=str(tmp_path))
+    grid_idx = cache.get(da.lat.values, da.lon.values, nside)
+    assert np.array_equal(grid_idx.reshape(-1)[np.isfinite(da.values.flatten())],
+                          idx)
+    assert not grid_idx.flags.writeable
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+
+    # In memory
+    assert cache.get(da.lat.values, da.lon.values, nside) is grid_idx
+
+    # LRU eviction
+    cache.get(da.lat.values, da.lon.values, 128)
+    cache.get(da.lat.values[1:], da.lon.values, nside)
+    assert len(cache) == 2
+
+    # From disk, memory-mapped, as in a new process
+    cache2 = hp_cache.PixelIndexCache(cache_dir=str(tmp_path))
+    grid_idx2 = cache2.get(da.lat.values, da.lon.values, nside)
+    assert isinstance(grid_idx2, np.memmap)
+    assert np.array_equal(grid_idx2, grid_idx)
+
+
+def test_geometry_cache():
+    geom = hp_cache.GeometryCache(max_bytes=2*16*healpy.nside2npix(64))
+    pixels = np.array([0, 10, 5000, 49151])
+
+    # Subset only; nothing cached
+    lons, lats = geom.lons_lats(64, pixels)
+    assert len(geom) == 0
+    assert np.allclose(lons, healpy.pix2ang(64, pixels, lonlat=True)[0])
+
+    # Full sky is shared and read-only
+    lons, lats = geom.lons_lats(64)
+    assert geom.lons_lats(64)[0] is lons
+    assert not lats.flags.writeable
+    assert np.allclose(geom.lons_lats(64, pixels)[1], lats[pixels])
+    geom.lons_lats(64, nest=True)
+    assert len(geom) == 2
+
+    # Size bound, evicting the least recently used
+    geom.lons_lats(32)
+    assert geom.nbytes <= geom.max_bytes
+    assert (64, 'ring') not in geom._entries
+    # Too large to hold at all
+    geom.lons_lats(128)
+    assert (128, 'ring') not in geom._entries
+
+    # RS_Healpix uses the shared cache
+    rsh = RS_Healpix.from_dataarray(fake_grid(), nside=64)
+    assert rsh.lons is hp_cache.geometry_cache.lons_lats(64)[0]
+    box = (126., 135., 17., 24.)
+    rs_s = rsh.to_sparse()
+    assert np.array_equal(hp_utils.masked_in_box(rsh.hp, box),
+        hp_utils.masked_in_box(rs_s.hp, box, pixels=rs_s.pixels, nside=64))
+
+
+def test_pixels_in_box():
+    nside = 128
+    lons, lats = healpy.pix2ang(nside, np.arange(healpy.nside2npix(nside)),
+                                lonlat=True)
+    boxes = [(127., 134., 18., 23.),      # ARCTERX
+             (-10., 10., -5., 5.),        # Negative longitudes
+             (170., -170., 30., 40.),     # Dateline
+             (350., 10., -60., -40.),     # Prime meridian
+             (20., 250., 60., 80.),       # Wide, in longitude
+             (0., 360., 85., 90.),        # Polar cap
+             (100., 110., -89.5, -70.),   
+             (359., -170., 10., 20.),     # Mixed conventions
+             ]
+    for box in boxes:
+        pix = hp_regions.pixels_in_box(nside, box)
+        brute = np.flatnonzero(hp_regions.in_box(lons, lats, box))
+        assert brute.size > 0
+        assert np.array_equal(pix, brute), box
+
+    # Dateline, two ways
+    assert np.array_equal(hp_regions.pixels_in_box(nside, (170., -170., 30., 40.)),
+                          hp_regions.pixels_in_box(nside, (170., 190., 30., 40.)))
+    assert hp_regions.lon_range((359., -170., 10., 20.)) == (359., 191.)
+    assert np.array_equal(hp_regions.pixels_in_box(nside, (359., -170., 10., 20.)),
+                          hp_regions.pixels_in_box(nside, (-1., 190., 10., 20.)))
+
+    # Disc
+    disc = hp_regions.pixels_in_disc(nside, 130., 20., 2.)
+    dist = healpy.rotator.angdist([130., 20.], [lons[disc], lats[disc]], 
+                                  lonlat=True)
+    assert np.all(np.rad2deg(dist) <= 2.)
+
+
+def test_accumulator():
+    nside = 128
+    granules = [fake_grid(seed=ss, nan_frac=0.5) for ss in range(4)] + [fake_swath()]
+
+    # All samples at once
+    all_pix, all_vals = [], []
+    for da in granules:
+        pix, vals, _ = hp_utils.da_to_pixels(da, nside=nside)
+        all_pix.append(pix)
+        all_vals.append(vals)
+    upix, counts, stats = hp_binning.grouped_stats(
+        np.concatenate(all_pix), np.concatenate(all_vals), ['mean', 'std'])
+
+    # One at a time, dense and sparse, and merged
+    dense = HealpixAccumulator(nside)
+    sparse = HealpixAccumulator(nside, sparse=True)
+    part1 = HealpixAccumulator(nside, sparse=True)
+    part2 = HealpixAccumulator(nside)
+    for ss, da in enumerate(granules):
+        dense.add_dataarray(da)
+        sparse.add_dataarray(da)
+        (part1 if ss % 2 else part2).add_dataarray(da)
+    merged = part1.merge(part2)
+    assert merged.ngranules == len(granules)
+
+    for acc in [dense, sparse, merged]:
+        rs_mean = acc.to_rs_healpix('mean')
+        rs_std = acc.to_rs_healpix('std')
+        if acc.sparse:
+            assert np.array_equal(acc.pixels, upix)
+            mean, std, cnt = rs_mean.hp, rs_std.hp, rs_mean.counts
+        else:
+            assert np.array_equal(np.flatnonzero(~rs_mean.hp.mask), upix)
+            mean, std, cnt = rs_mean.hp[upix], rs_std.hp[upix], rs_mean.counts[upix]
+        assert np.allclose(mean, stats['mean'])
+        assert np.allclose(std, stats['std'], atol=1e-6)
+        assert np.array_equal(cnt, counts)
+
+    # From binned maps, weighted by the counts
+    acc = HealpixAccumulator(nside, sparse=True)
+    for da in granules:
+        acc.add_rs_healpix(RS_Healpix.from_dataarray(da, nside=nside, sparse=True))
+    assert np.allclose(acc.mean(), stats['mean'])
+
+
+def test_ingest_files(tmp_path):
+    """ Parallel ingestion matches serial accumulation """
+    files = []
+    acc = None
+    for seed in range(4):
+        da = fake_grid(seed=seed)
+        da.attrs['units'] = 'celsius'
+        filename = str(tmp_path / f'granule_{seed}.nc')
+        da.expand_dims(time=[np.datetime64('2025-02-07')]).to_dataset(
+            name='sst').to_netcdf(filename)
+        files.append(filename)
+        if acc is None:
+            nside, _ = hp_utils.get_nside_from_dataset(da)
+            acc = HealpixAccumulator(nside, sparse=True)
+        acc.add_dataarray(da, filename=filename)
+
+    serial = ingest.ingest_files(files, 'sst', time_isel=0)
+    parallel = ingest.ingest_files(files, 'sst', workers=2, time_isel=0)
+
+    for result in [serial, parallel]:
+        assert result.nside == acc.nside
+        assert result.ngranules == 4
+        assert result.filenames == files
+        assert np.array_equal(result.pixels, acc.pixels)
+        assert np.array_equal(result.count, acc.count)
+        assert np.allclose(result.sum, acc.sum)
+
+
+def test_ingest_usable(tmp_path):
+    """ Granules are consumed in order until enough have good coverage """
+    files = []
+    for seed, nan_frac in enumerate([0.2, 0.95, 0.2, 0.2]):
+        da = fake_grid(seed=seed, nan_frac=nan_frac)
+        da.attrs['units'] = 'celsius'
+        filename = str(tmp_path / f'granule_{seed}.nc')
+        da.expand_dims(time=[np.datetime64('2025-02-07')]).to_dataset(
+            name='sst').to_netcdf(filename)
+        files.append(filename)
+    da, _ = rs_healpix.load_dataarray(files[0], 'sst', time_isel=0)
+    assert 0.75 < ingest.coverage(da) < 0.85
+
+    consumed = []
+    def listing():
+        for filename in [None] + files:
+            consumed.append(filename)
+            yield filename
+    acc = ingest.ingest_usable(listing(), 'sst', 2, min_coverage=0.5, 
+                               time_isel=0)
+    assert acc.filenames == [files[0], files[2]]
+    assert consumed == [None] + files[:3]
+    assert acc.count.sum() == ingest.ingest_files(
+        [files[0], files[2]], 'sst', time_isel=0).count.sum()
+
+    # Not enough
+    acc = ingest.ingest_usable(files[:2], 'sst', 2, min_coverage=0.5, 
+                               time_isel=0)
+    assert acc.ngranules == 1
+    assert ingest.ingest_usable(files[1:2], 'sst', 1, min_coverage=0.5,
+                                time_isel=0) is None
+
+
+def test_swath_window(tmp_path):
+    """ Cropped reads of a 2D swath bin as the full swath does """
+    ny, nx = 200, 150
+    rows, cols = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+    lats = 10. + 0.1*rows + 0.02*cols
+    lons = 120. + 0.13*cols
+    lats[5, 5] = -9999.
+    da = fake_swath(nx=nx, ny=ny)
+    da = da.assign_coords(lat=(('ni', 'nj'), lats), lon=(('ni', 'nj'), lons))
+    da.attrs['units'] = 'celsius'
+    filename = str(tmp_path / 'swath.nc')
+    da.expand_dims(time=[np.datetime64('2025-02-07')]).to_dataset(
+        name='sst').to_netcdf(filename)
+
+    box = (127., 134., 18., 23.)
+    cut, nside = rs_healpix.load_dataarray(filename, 'sst', time_isel=0,
+        lat_slice=box[2:], lon_slice=box[:2], resol_km=11.)
+
+    # Only the window was read
+    in_bbox = hp_regions.in_box(lons, lats, box, closed=True)
+    assert cut.shape == (np.any(in_bbox, axis=1).sum(), 
+                         np.any(in_bbox, axis=0).sum())
+
+    # Same samples as cutting the full swath
+    full = da.copy(deep=True)
+    full.lat.data[~in_bbox] = np.nan
+    pix_full, vals_full, _ = hp_utils.da_to_pixels(full, nside=nside)
+    pix_cut, vals_cut, _ = hp_utils.da_to_pixels(cut, nside=nside)
+    assert np.array_equal(np.sort(pix_full), np.sort(pix_cut))
+    assert np.isclose(vals_full.sum(), vals_cut.sum())
+
+    # Nothing in the box
+    cut, _ = rs_healpix.load_dataarray(filename, 'sst', time_isel=0,
+        lat_slice=(-20., -10.), lon_slice=box[:2], resol_km=11.)
+    assert cut.size == 0
+
+
+def test_chunked_from_dataset_file(tmp_path):
+    """ Chunked loading bins as the eager one does """
+    rng = np.random.default_rng(7)
+    da = fake_grid(nlat=90, nlon=120)
+    ds = (da + 273.15).to_dataset(name='sea_surface_temperature')
+    ds['sea_surface_temperature'].attrs['units'] = 'kelvin'
+    ds['quality_level'] = (('lat', 'lon'), rng.integers(0, 6, size=da.shape))
+    ds.attrs['sensor'] = 'AHI'
+    filename = str(tmp_path / 'l3c.nc')
+    ds.expand_dims(time=[np.datetime64('2025-02-07')]).to_netcdf(filename)
+
+    eager = RS_Healpix.from_dataset_file(filename, 'sea_surface_temperature',
+                                         time_isel=0, sparse=True)
+    chunked = RS_Healpix.from_dataset_file(filename, 'sea_surface_temperature',
+                                           time_isel=0, sparse=True,
+                                           chunks=dict(lat=25, lon=40))
+
+    assert chunked.nside == eager.nside
+    assert np.array_equal(chunked.pixels, eager.pixels)
+    assert np.array_equal(chunked.counts.data, eager.counts.data)
+    assert np.allclose(chunked.hp.data, eager.hp.data)
+    # QC was applied
+    assert chunked.counts.sum() == np.sum(np.isfinite(da.values)
+                                          & (ds.quality_level.values >= 5))
+
+    with pytest.raises(ValueError):
+        RS_Healpix.from_dataset_file(filename, 'sea_surface_temperature',
+                                     time_isel=0, stat='median',
+                                     chunks=dict(lat=25, lon=40))
+
+
+def test_row_bands(monkeypatch):
+    """ Binning a 1D grid in row bands matches binning it at once """
+    da = fake_grid(nlat=90, nlon=120)
+    nside = 64
+    hpma, hpma1, _, _, _ = hp_utils.da_to_healpix(da, nside=nside)
+    pixels, counts, values, _ = hp_utils.da_to_healpix_sparse(da, nside=nside)
+
+    monkeypatch.setattr(hp_utils, 'max_band_cells', 1000)
+    bands = list(hp_utils.iter_blocks(da))
+    assert len(bands) == 12
+    assert sum([band.size for band in bands]) == da.size
+
+    b_hpma, b_hpma1, _, _, _ = hp_utils.da_to_healpix(da, nside=nside)
+    assert np.array_equal(b_hpma.data, hpma.data)
+    assert np.allclose(b_hpma1.data, hpma1.data)
+
+    b_pixels, b_counts, b_values, _ = hp_utils.da_to_healpix_sparse(
+        da, nside=nside)
+    assert np.array_equal(b_pixels, pixels)
+    assert np.array_equal(b_counts, counts)
+    assert np.allclose(b_values, values)
+
+    acc = HealpixAccumulator(nside)
+    acc.add_dataarray(da)
+    assert np.array_equal(acc.count, hpma.data.astype(int))
+
+    # Sort-based statistics compute the whole DataArray
+    chunked = da.chunk(dict(lat=45, lon=60))
+    stats = ['median', 'std']
+    _, c_stats, _, _, _ = hp_utils.da_to_healpix(chunked, nside=nside,
+                                                 stat=stats)
+    _, e_stats, _, _, _ = hp_utils.da_to_healpix(da, nside=nside, stat=stats)
+    for key in stats:
+        assert np.array_equal(c_stats[key].data, e_stats[key].data)
+    c_pixels, _, c_median, _ = hp_utils.da_to_healpix_sparse(
+        chunked, nside=nside, stat='median')
+    _, _, e_median, _ = hp_utils.da_to_healpix_sparse(
+        da, nside=nside, stat='median')
+    assert np.array_equal(c_pixels, pixels)
+    assert np.array_equal(c_median, e_median)
+
+    # Blocks are not cached
+    def no_cache(*args, **kwargs):
+        raise AssertionError("Cached a block")
+    monkeypatch.setattr(hp_cache.pixel_cache, 'get', no_cache)
+    acc = HealpixAccumulator(nside)
+    acc.add_dataarray(da)
+    assert np.array_equal(acc.count, hpma.data.astype(int))
+
+    # Dask chunks are read once each, not in bands
+    computed = []
+    def counting(block):
+        computed.append(block.shape)
+        return block
+    chunked = da.chunk(dict(lat=45, lon=60))
+    chunked = chunked.copy(data=chunked.data.map_blocks(counting))
+    blocks = list(hp_utils.iter_blocks(chunked))
+    assert len(blocks) == 4
+    assert computed.count((45, 60)) == 4
+    c_pixels, c_counts, _, _ = hp_utils.da_to_healpix_sparse(
+        chunked, nside=nside)
+    assert np.array_equal(c_counts, counts)
+
+
+def test_dtype_policy():
+    """ Values and maps are float32;  sums stay float64 """
+    da = fake_grid()
+    da.attrs['units'] = 'K'
+    da = units.kelvin_to_celsius(da + 273.15)
+    assert da.dtype == np.float32
+
+    hp_counts, hp_values, _, _, _ = hp_utils.da_to_healpix(da, nside=64)
+    assert hp_counts.dtype == np.float32
+    assert hp_values.dtype == np.float32
+    counts, means = loop_counts_means(da, 64)
+    assert np.allclose(hp_values.data, means, rtol=1e-6)
+
+    rsh = RS_Healpix.from_dataarray(da, nside=64, sparse=True)
+    assert rsh.hp.dtype == np.float32 and rsh.counts.dtype == np.float32
+    stack = RS_Healpix.from_list([RS_Healpix.from_dataarray(da, nside=64)]*2)
+    assert stack.hp.dtype == np.float32
+
+    acc = HealpixAccumulator(64)
+    acc.add_dataarray(da)
+    assert acc.sum.dtype == np.float64
+    assert acc.mean().dtype == np.float32
+
+    # Stacks sum in float64 (float32 drops the 1s next to 2**24)
+    arrs = [np.ma.masked_array(np.array([2.**24, 1.], dtype=np.float32),
+                               mask=[False, True])]
+    arrs += [np.ma.masked_array(np.ones(2, dtype=np.float32))]*2
+    mean = hp_combine.average_masked_arrays(arrs)
+    assert mean.dtype == np.float32
+    assert mean[0] == np.float32((2.**24 + 2) / 3)
+    assert mean[1] == 1.
+    pixels, mean = hp_combine.average_sparse([np.arange(2)]*3, arrs)
+    assert mean.dtype == np.float32
+    assert mean[0] == np.float32((2.**24 + 2) / 3)
+
@@ -0,0 +1,167 @@
+""" Test routines for the netcdf module """
+
+import tracemalloc
+
+import pytest
+
+import numpy as np
+import xarray
+import dask.array
+
+from remote_sensing.netcdf import sst as nc_sst
+from remote_sensing.netcdf import utils as nc_utils
+from remote_sensing.netcdf import qc
+
+
+def test_load_chunked(tmp_path):
+    """ Chunked loading gives the eager arrays, lazily """
+    rng = np.random.default_rng(3)
+    lats = np.linspace(18., 23., 40)
+    lons = np.linspace(127., 134., 60)
+    ds = xarray.Dataset(
+        {'sea_surface_temperature': (('lat', 'lon'), 
+            298. + rng.normal(size=(40, 60)), {'units': 'kelvin'}),
+         'quality_level': (('lat', 'lon'), rng.integers(0, 6, size=(40, 60)))},
+        coords={'lat': lats, 'lon': lons})
+    filename = str(tmp_path / 'sst.nc')
+    ds.expand_dims(time=[np.datetime64('2025-02-07')]).to_netcdf(filename)
+
+    sst, qual, lat, lon, time = nc_sst.load(filename, verbose=False)
+    c_sst, c_qual, c_lat, c_lon, c_time = nc_sst.load(
+        filename, verbose=False, chunks=dict(lat=10, lon=20))
+
+    assert isinstance(c_sst, dask.array.Array)
+    assert c_sst.numblocks == (4, 3)
+    assert np.allclose(c_sst.compute(), sst)
+    assert np.array_equal(c_qual.compute(), qual)
+    assert np.array_equal(c_lat, lat) and c_time == time
+
+
+def fake_qc_inputs(shape=(70, 90), seed=5):
+    """ SST (deg C) with NaNs, quality levels and packed flags """
+    rng = np.random.default_rng(seed)
+    sst = (25. + 6*rng.normal(size=shape)).astype(np.float32)
+    sst[rng.random(size=shape) < 0.2] = np.nan
+    qual = rng.integers(0, 6, size=shape).astype(np.int8)
+    flags = rng.integers(-2**15, 2**15, size=shape).astype(np.int16)
+    return sst, qual, flags
+
+
+def test_build_mask():
+    """ All the criteria are in the union;  inputs are untouched """
+    sst, qual, _ = fake_qc_inputs()
+    sst0, qual0 = sst.copy(), qual.copy()
+
+    mask = nc_utils.build_mask(sst, qual, qual_thresh=4, lower_qual=False,
+                               temp_bounds=(-2, 30))
+    expected = np.isnan(sst) | (qual < 4) | (sst <= -2) | (sst > 30)
+    assert np.array_equal(mask, expected)
+    assert np.array_equal(sst, sst0, equal_nan=True)
+    assert np.array_equal(qual, qual0)
+
+    # Lower quality is better
+    mask = nc_utils.build_mask(sst, qual, qual_thresh=2)
+    expected = np.isnan(sst) | (qual > 2) | (sst <= -2) | (sst > 33)
+    assert np.array_equal(mask, expected)
+
+
+def test_qc_engine():
+    """ Fused, chunked rules match the direct expressions """
+    sst, qual, flags = fake_qc_inputs()
+    bits = (1<<1) | (1<<15)
+    engine = qc.QCEngine([qc.NaNRule(), qc.QualityRule(3),
+                          qc.BoundsRule(-2., 32.), qc.FlagRule(bits)],
+                         chunk_size=500)
+    expected = np.isnan(sst) | (qual < 3) | (sst <= -2) | (sst > 32) \
+        | ((flags.astype(np.int32) & bits) != 0)
+
+    assert np.array_equal(engine.mask(data=sst, qual=qual, flags=flags),
+                          expected)
+    # Non-contiguous
+    assert np.array_equal(engine.mask(data=sst.T, qual=qual.T, flags=flags.T),
+                          expected.T)
+    # Lazy
+    lazy = engine.mask(data=dask.array.from_array(sst, chunks=(20, 30)),
+                       qual=xarray.DataArray(qual), flags=flags)
+    assert isinstance(lazy, dask.array.Array)
+    assert np.array_equal(lazy.compute(), expected)
+
+    with pytest.raises(IOError):
+        engine.mask(data=sst, qual=qual)
+
+
+def test_qc_engine_memory():
+    """ Scratch space is chunk-sized, also with a leading time axis """
+    sst, qual, flags = fake_qc_inputs(shape=(1, 400, 500))
+    engine = qc.QCEngine([qc.NaNRule(), qc.QualityRule(3),
+                          qc.FlagRule((1<<1) | (1<<15))], chunk_size=1000)
+    expected = np.isnan(sst) | (qual < 3) \
+        | ((flags.astype(np.int32) & ((1<<1) | (1<<15))) != 0)
+
+    tracemalloc.start()
+    mask = engine.mask(data=sst, qual=qual, flags=flags)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert mask.shape == (1, 400, 500)
+    assert np.array_equal(mask, expected)
+    # The mask, and little more
+    assert peak < 1.5*mask.nbytes
+
+
+def test_sensor_qc(capsys):
+    """ Registry lookup, l2p_flags decoding and the cached mask """
+    sst, qual, flags = fake_qc_inputs()
+    ds = xarray.Dataset(
+        {'sea_surface_temperature': (('lat', 'lon'), sst),
+         'quality_level': (('lat', 'lon'), qual),
+         'l2p_flags': (('lat', 'lon'), flags, 
+            {'flag_meanings': 'microwave land ice land not_water',
+             'flag_masks': np.array([1, 2, 4, 2048, -32768], dtype=np.int16)})},
+        attrs={'sensor': 'AHI'})
+
+    # Both land bits and the (signed) top bit
+    assert qc.flag_bitmask(ds.l2p_flags, ['land']) == 2 | 2048
+    assert qc.flag_bitmask(ds.l2p_flags, ['not_water']) == 2**15
+    with pytest.raises(ValueError):
+        qc.flag_bitmask(ds.l2p_flags, ['cloud'])
+
+    # By default, the quality threshold only (as before the registry)
+    bad = nc_utils.gen_mask_for_dataset(ds, 'sea_surface_temperature')
+    assert np.array_equal(bad.values, qual < 5)
+
+    # Land and ice on request
+    ds = ds.drop_vars(qc.mask_variable)
+    default = qc.registry['AHI']
+    qc.register('AHI', qc.SensorQC(min_quality=5, bad_flags=['land', 'ice']))
+    try:
+        bad = nc_utils.gen_mask_for_dataset(ds, 'sea_surface_temperature')
+    finally:
+        qc.register('AHI', default)
+    expected = (qual < 5) | ((flags.astype(np.int32) & (2 | 4 | 2048)) != 0)
+    assert np.array_equal(bad.values, expected)
+
+    # Cached with the dataset, and follows slicing
+    assert qc.mask_variable in ds
+    sub = ds.isel(lat=slice(10, 20))
+    assert np.array_equal(nc_utils.gen_mask_for_dataset(
+        sub, 'sea_surface_temperature').values, expected[10:20])
+
+    # By collection, ahead of the sensor
+    ds = ds.drop_vars(qc.mask_variable)
+    ds.attrs['id'] = 'TEST-L3C'
+    qc.register('TEST-L3C', qc.SensorQC(min_quality=3))
+    try:
+        bad = nc_utils.gen_mask_for_dataset(ds, 'sea_surface_temperature')
+        assert np.array_equal(bad.values, qual < 3)
+    finally:
+        qc.registry.pop('TEST-L3C')
+
+    # Unknown sensor, reported only if verbose
+    ds = ds.drop_vars(qc.mask_variable)
+    ds.attrs = {'sensor': 'MODIS'}
+    assert nc_utils.gen_mask_for_dataset(ds, 'sea_surface_temperature') is None
+    assert capsys.readouterr().out == ''
+    assert nc_utils.gen_mask_for_dataset(ds, 'sea_surface_temperature',
+                                         verbose=True) is None
+    assert 'MODIS' in capsys.readouterr().out
+
@@ -0,0 +1,144 @@
+""" Test routines for the streaming pipeline """
+
+import time
+import argparse
+
+import pytest
+
+import numpy as np
+
+from remote_sensing.operations import pipeline
+from remote_sensing.operations import merged_sst_to_kmz
+from remote_sensing.download import granules as rs_granules
+from remote_sensing.healpix import ingest
+from remote_sensing.tests.test_healpix import fake_grid, fake_swath
+
+
+def slow(item, delay:float=0.1):
+    time.sleep(delay)
+    return item
+
+
+def odd_squared(item):
+    return item**2 if item % 2 else None
+
+
+def test_overlap():
+    """ Stages run at once:  the time is that of the slowest """
+    pipe = pipeline.Pipeline(range(6))
+    pipe.add(slow, name='download', delay=0.1)
+    pipe.add(slow, name='bin', delay=0.1)
+    t0 = time.perf_counter()
+    results = pipe.run()
+    elapsed = time.perf_counter() - t0
+    assert sorted(results) == list(range(6))
+    # 1.2s in sequence
+    assert elapsed < 1.
+    assert [stage.nitems for stage in pipe.stages] == [6, 6]
+    assert repr(pipe) == '<Pipeline: download -> bin>'
+
+    # More workers for the slow stage
+    pipe = pipeline.Pipeline(range(8))
+    pipe.add(slow, workers=4, delay=0.2)
+    t0 = time.perf_counter()
+    assert sorted(pipe.run()) == list(range(8))
+    assert time.perf_counter() - t0 < 1.2
+
+
+def test_processes():
+    """ Process stages, dropped items and merging """
+    pipe = pipeline.Pipeline([1, None, 2, 3, 4, 5])
+    pipe.add(odd_squared, workers=2, processes=True)
+    assert sorted(pipe.run()) == [1, 9, 25]
+    assert pipe.stages[0].nitems == 5
+    assert pipe.run(merge=lambda total, x: total + x) == 35
+
+
+def test_stop(monkeypatch):
+    """ Breaking out stops the source;  errors are raised """
+    monkeypatch.setattr(pipeline, 'queue_size', 1)
+    listed = []
+    closed = []
+    def source():
+        try:
+            for item in range(100):
+                listed.append(item)
+                yield item
+        finally:
+            closed.append(True)
+
+    pipe = pipeline.Pipeline(source())
+    pipe.add(slow, delay=0.05)
+    for item in pipe:
+        break
+    assert closed == [True]
+    assert len(listed) < 10
+
+    def bad(item):
+        if item == 3:
+            raise ValueError("Bad granule")
+        return item
+    pipe = pipeline.Pipeline(range(10))
+    pipe.add(bad, workers=2)
+    with pytest.raises(ValueError):
+        pipe.run()
+
+
+def test_ingest(tmp_path):
+    """ Binned in processes as the files come, matching ingest_files() """
+    files = []
+    for seed in range(4):
+        da = fake_grid(seed=seed)
+        da.attrs['units'] = 'celsius'
+        filename = str(tmp_path / f'granule_{seed}.nc')
+        da.expand_dims(time=[np.datetime64('2025-02-07')]).to_dataset(
+            name='sst').to_netcdf(filename)
+        files.append(filename)
+
+    pipe = pipeline.Pipeline(files)
+    pipe.add(slow, workers=2, name='download', delay=0.05)
+    pipe.add(ingest.ingest_file, workers=2, processes=True, name='bin',
+             variable='sst', time_isel=0)
+    acc = pipe.run(merge=lambda total, acc: total.merge(acc))
+    serial = ingest.ingest_files(files, 'sst', time_isel=0)
+    assert sorted(acc.filenames) == files
+    assert np.array_equal(np.sort(acc.pixels), serial.pixels)
+    assert acc.count.sum() == serial.count.sum()
+    assert np.isclose(acc.sum.sum(), serial.sum.sum())
+
+
+def test_merged_sst(tmp_path, monkeypatch):
+    """ Each source is binned with its own loading """
+    local = {}
+    def granules(collection, args):
+        name = 'amsr2' if collection.startswith('AMSR2') else 'h09'
+        files = []
+        for seed in range(3):
+            filename = str(tmp_path / f'{name}_{seed}.nc')
+            da = fake_swath(seed=seed) if name == 'amsr2' else \
+                fake_grid(seed=seed)
+            da.attrs['units'] = 'celsius'
+            da.expand_dims(time=[np.datetime64('2025-02-07')]).to_dataset(
+                name='sea_surface_temperature').to_netcdf(filename)
+            url = f'https://archive/{collection}/{name}_{seed}.nc'
+            local[url] = filename
+            files.append(rs_granules.Granule(f'G{seed}-{name}', url))
+        return iter(files)
+    monkeypatch.setattr(merged_sst_to_kmz, 'newest_granules', granules)
+    monkeypatch.setattr(merged_sst_to_kmz.podaac, 'download_granule',
+                        lambda granule, **kwargs: local[granule.url])
+
+    args = argparse.Namespace(namsr2=1, nh09=2, download_workers=2,
+                              workers=2, clobber=True, verbose=False)
+    amsr2_acc, h09_acc = merged_sst_to_kmz.ingest_pipeline(args, None)
+    assert amsr2_acc.filenames == [str(tmp_path / 'amsr2_0.nc')]
+    assert sorted(h09_acc.filenames) == [str(tmp_path / f'h09_{seed}.nc') 
+                                         for seed in range(2)]
+    # As binned one source at a time
+    amsr2 = ingest.ingest_files(amsr2_acc.filenames, 'sea_surface_temperature',
+                                **merged_sst_to_kmz.amsr2_kwargs)
+    assert amsr2_acc.nside == amsr2.nside
+    assert amsr2_acc.count.sum() == amsr2.count.sum()
+    h09 = ingest.ingest_files(h09_acc.filenames, 'sea_surface_temperature',
+                              **merged_sst_to_kmz.h09_kwargs)
+    assert h09_acc.count.sum() == h09.count.sum()
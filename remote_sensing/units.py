@@ -1,9 +1,12 @@
 """ Fuss about with units """
 
+from remote_sensing import dtypes
+
 
 def kelvin_to_celsius(da):
-    """Convert temperature DataArray from Kelvin to Celsius."""
-    return (da - 273.15).assign_attrs({
+    """Convert temperature DataArray from Kelvin to Celsius.
+    The result is in the value dtype of the dtypes policy."""
+    return (dtypes.as_values(da) - 273.15).assign_attrs({
         **da.attrs,
         'units': '°C',
         'long_name': da.attrs.get('long_name', 'Temperature') + ' in Celsius'